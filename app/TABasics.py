@@ -20,7 +20,10 @@
 #  Created by Berend Schotanus on 09-Oct-12.
 #
 
-import webapp2, json, random
+import webapp2, json, random, time, zlib, cPickle, threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import logging
 
@@ -30,6 +33,346 @@ from ffe.gae                import task_name
 from google.appengine.ext   import db
 from google.appengine.api   import memcache, taskqueue
 
+# Memcache keys of TAModel instances are prefixed with the generation of their kind,
+# an instance rereads the generation of a kind after GENERATION_CHECK_INTERVAL seconds.
+GENERATION_CHECK_INTERVAL = 10
+GENERATIONS_NAMESPACE = 'generations'
+_generations = {}
+# kinds to bump at the end of the current batch of writes, per request thread
+_batch = threading.local()
+
+
+def kind_generation(kind):
+    """
+    Provides the current generation of a kind
+    """
+    now = time.time()
+    generation, checked = _generations.get(kind, (None, 0))
+    if generation is None or now - checked > GENERATION_CHECK_INTERVAL:
+        generation = memcache.get(kind, namespace=GENERATIONS_NAMESPACE)
+        if generation is None:
+            memcache.add(kind, random.randint(1, 2 ** 30), namespace=GENERATIONS_NAMESPACE)
+            generation = memcache.get(kind, namespace=GENERATIONS_NAMESPACE)
+            if generation is None:
+                return 0
+        _generations[kind] = (generation, now)
+    return generation
+
+
+def bump_generation(kind):
+    """
+    Invalidates all memcached instances of a kind, or within batched_generation_bumps when the batch is done
+    """
+    pending = getattr(_batch, 'kinds', None)
+    if pending is not None:
+        pending.add(kind)
+        return
+    generation = memcache.incr(kind, namespace=GENERATIONS_NAMESPACE, initial_value=random.randint(1, 2 ** 30))
+    _generations[kind] = (generation, time.time())
+    logging.info('Invalidate memcache for %s, generation %s' % (kind, generation))
+
+
+@contextmanager
+def batched_generation_bumps():
+    """
+    Collects the generation bumps of a batch of writes, each kind is bumped once at the end of the outermost batch
+    """
+    if getattr(_batch, 'kinds', None) is not None:
+        yield
+        return
+    _batch.kinds = set()
+    try:
+        yield
+    finally:
+        kinds, _batch.kinds = _batch.kinds, None
+        for kind in sorted(kinds):
+            bump_generation(kind)
+
+
+# ====== Instance-local cache ======================================================================
+
+LOCAL_CACHE_SIZE = 200
+LOCAL_CACHE_TTL = 60
+_local_caches = {}
+
+
+class LocalCache(object):
+    """
+    LocalCache keeps the most recently used objects of a kind in this instance.
+    Objects expire after ttl seconds, or when the generation of the kind changes.
+    """
+
+    def __init__(self, kind, size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL, generation_kind=None):
+        self.kind = kind
+        self.generation_kind = generation_kind or kind
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        generation = kind_generation(self.generation_kind)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                value, expires, entry_generation = entry
+                if expires > now and entry_generation == generation:
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+    def set(self, key, value):
+        entry = (value, time.time() + self.ttl, kind_generation(self.generation_kind))
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'kind': self.kind, 'size': self.size, 'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': float(self.hits) / requests if requests else None}
+
+
+def local_cache(kind, size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL, generation_kind=None):
+    """
+    Provides the LocalCache for a kind, the other parameters only apply when the cache is created
+    """
+    cache = _local_caches.get(kind)
+    if cache is None:
+        cache = _local_caches.setdefault(kind, LocalCache(kind, size, ttl, generation_kind))
+    return cache
+
+
+def local_cache_stats():
+    return [_local_caches[kind].stats for kind in sorted(_local_caches)]
+
+
+def clear_local_caches():
+    """
+    Clears all instance-local state of the cache layer
+    """
+    for cache in _local_caches.values():
+        cache.clear()
+    _generations.clear()
+
+
+# The xml catalog of a kind is written in parts, starting with XML_DECLARATION
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Queries are read in pages of QUERY_PAGE_SIZE entities, continuing from the cursor of the previous page.
+QUERY_PAGE_SIZE = 500
+
+
+def query_batches(query, page_size=QUERY_PAGE_SIZE):
+    """
+    Generates the results of a db query in lists of at most page_size items
+    """
+    while True:
+        batch = query.fetch(page_size)
+        if batch:
+            yield batch
+        if len(batch) < page_size:
+            break
+        query.with_cursor(query.cursor())
+
+
+# Values are pickled by the cache layer itself, compressed above COMPRESSION_THRESHOLD bytes
+# and split into chunks of CHUNK_SIZE bytes when they do not fit in a single memcache value.
+COMPRESSION_THRESHOLD = 16 * 1024
+CHUNK_SIZE = 1000 * 1000
+_cache_stats = {'writes': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'compressed': 0, 'chunked': 0, 'failures': 0,
+                'reads': 0, 'hits': 0, 'incomplete': 0}
+
+
+def cache_stats():
+    """
+    Provides the statistics of the cache layer in this instance
+    """
+    stats = dict(_cache_stats)
+    if stats['stored_bytes']:
+        stats['compression_ratio'] = float(stats['raw_bytes']) / stats['stored_bytes']
+    else:
+        stats['compression_ratio'] = None
+    return stats
+
+
+def pack_cache_value(key, value, chunks):
+    """
+    Provides the envelope in which value is stored under key, chunks of oversized values are added to chunks.
+    Envelopes are ('p', pickled value), ('z', compressed pickled value) or ('c', compressed, token, nr_of_chunks)
+    """
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    _cache_stats['writes'] += 1
+    _cache_stats['raw_bytes'] += len(data)
+    compressed = len(data) > COMPRESSION_THRESHOLD
+    if compressed:
+        data = zlib.compress(data)
+        _cache_stats['compressed'] += 1
+    _cache_stats['stored_bytes'] += len(data)
+    if len(data) <= CHUNK_SIZE:
+        return ('z', data) if compressed else ('p', data)
+
+    _cache_stats['chunked'] += 1
+    token = '%08x' % random.getrandbits(32)
+    nr_of_chunks = 0
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunks['%s#%s#%d' % (key, token, nr_of_chunks)] = data[start:start + CHUNK_SIZE]
+        nr_of_chunks += 1
+    return ('c', compressed, token, nr_of_chunks)
+
+
+def unpack_cache_value(envelope, chunks=None):
+    if not isinstance(envelope, tuple):
+        return envelope
+    kind = envelope[0]
+    if kind == 'p':
+        return cPickle.loads(envelope[1])
+    if kind == 'z':
+        return cPickle.loads(zlib.decompress(envelope[1]))
+    if kind == 'c' and chunks is not None:
+        data = ''.join(chunks)
+        if envelope[1]:
+            data = zlib.decompress(data)
+        return cPickle.loads(data)
+
+
+def chunk_keys(key, envelope):
+    if isinstance(envelope, tuple) and envelope[0] == 'c':
+        kind, compressed, token, nr_of_chunks = envelope
+        return ['%s#%s#%d' % (key, token, index) for index in range(nr_of_chunks)]
+
+
+def cache_write(key, value, namespace=None):
+    """
+    Stores value in memcache, compressed and chunked when needed
+    """
+    cache_write_multi({key: value}, namespace=namespace)
+
+
+def cache_write_multi(mapping, key_prefix='', namespace=None):
+    envelopes = {}
+    chunks = {}
+    packed = {}
+    for key, value in mapping.iteritems():
+        envelope = packed.get(id(value))
+        if envelope is None or envelope[0] == 'c':
+            envelope = pack_cache_value(key_prefix + key, value, chunks)
+            packed[id(value)] = envelope
+        envelopes[key] = envelope
+    failed = []
+    if chunks:
+        failed = memcache.set_multi(chunks, namespace=namespace)
+    if failed:
+        logging.warning('Failed to store %d chunks in memcache' % len(failed))
+        _cache_stats['failures'] += len(envelopes)
+        memcache.delete_multi(envelopes.keys(), key_prefix=key_prefix, namespace=namespace)
+        return
+    failed = memcache.set_multi(envelopes, key_prefix=key_prefix, namespace=namespace)
+    if failed:
+        logging.warning('Failed to store %s in memcache' % ', '.join(failed))
+        _cache_stats['failures'] += len(failed)
+
+
+def cache_read(key, namespace=None):
+    """
+    Provides the value stored with cache_write, or None
+    """
+    return cache_read_multi([key], namespace=namespace).get(key)
+
+
+def cache_read_multi(keys, key_prefix='', namespace=None):
+    _cache_stats['reads'] += len(keys)
+    envelopes = memcache.get_multi(keys, key_prefix=key_prefix, namespace=namespace)
+    needed_chunks = {}
+    for key, envelope in envelopes.iteritems():
+        keys_for_chunks = chunk_keys(key_prefix + key, envelope)
+        if keys_for_chunks:
+            needed_chunks[key] = keys_for_chunks
+    chunks = {}
+    if needed_chunks:
+        chunks = memcache.get_multi(sum(needed_chunks.values(), []), namespace=namespace)
+
+    result = {}
+    for key, envelope in envelopes.iteritems():
+        if key in needed_chunks:
+            if not all(chunk_key in chunks for chunk_key in needed_chunks[key]):
+                _cache_stats['incomplete'] += 1
+                continue
+            value = unpack_cache_value(envelope, [chunks[chunk_key] for chunk_key in needed_chunks[key]])
+        else:
+            value = unpack_cache_value(envelope)
+        if value is not None:
+            result[key] = value
+    _cache_stats['hits'] += len(result)
+    return result
+
+
+def cas_update(key, update, namespace=None, attempts=5):
+    """
+    Replaces the value under key by update(value) with compare-and-set, value is None when the key is absent.
+    update must return the value it was given when nothing has to change.
+    :return: True when the update was stored or not needed
+    """
+    client = memcache.Client()
+    for attempt in range(attempts):
+        value = client.gets(key, namespace=namespace)
+        new_value = update(value)
+        if new_value is value:
+            return True
+        if value is None:
+            if client.add(key, new_value, namespace=namespace):
+                return True
+        elif client.cas(key, new_value, namespace=namespace):
+            return True
+    return False
+
+
+# A request that misses the cache takes a lease before rebuilding a value, other requests wait for the rebuilt
+# value for at most LEASE_ATTEMPTS * LEASE_WAIT seconds, or serve a stale copy when their kind allows that.
+# Stale copies are kept under STALE_PREFIX and the generation of their kind, invalidating the kind retires them.
+LEASE_SECONDS = 10
+LEASE_ATTEMPTS = 5
+LEASE_WAIT = 0.05
+STALE_PREFIX = 'stale:'
+
+
+def acquire_lease(key, namespace=None):
+    return memcache.add('lease:' + key, 1, time=LEASE_SECONDS, namespace=namespace)
+
+
+def release_lease(key, namespace=None):
+    memcache.delete('lease:' + key, namespace=namespace)
+
+
+def wait_for_value(key, namespace=None, accept=None):
+    """
+    Waits for another request to store a value under key
+    :param accept: optional function that must return True for an acceptable value
+    """
+    for attempt in range(LEASE_ATTEMPTS):
+        time.sleep(LEASE_WAIT)
+        value = cache_read(key, namespace=namespace)
+        if value is not None and (accept is None or accept(value)):
+            return value
+
 
 class JSONProperty(db.TextProperty):
     
@@ -48,6 +391,9 @@ class JSONProperty(db.TextProperty):
 
 class TAModel(db.Model):
 
+    # Kinds that may serve a stale copy to requests waiting for a rebuild
+    serves_stale = False
+
     # Object lifecycle:
     @classmethod
     def new(cls, id=None, code=None, country='nl'):
@@ -65,14 +411,39 @@ class TAModel(db.Model):
             class_name = cls.__name__
         if not id:
             id = '%s.%s' % (country, code)
-        self = memcache.get(id, namespace=class_name)
+        self = cache_read(cls.cache_prefix(class_name) + id, namespace=class_name)
         if not self:
+            self = cls.fetch_uncached(id, class_name, now)
+            if not self and create:
+                self = cls.new(id)
+        return self
+
+    @classmethod
+    def fetch_uncached(cls, id, class_name, now=None):
+        """
+        Fetches an object that was not found in memcache.
+        Only the request holding the lease fetches from the datastore, others wait for the cached result
+        or serve a stale copy if the kind allows that.
+        """
+        key = cls.cache_prefix(class_name) + id
+        leased = acquire_lease(key, namespace=class_name)
+        if not leased:
+            self = None
+            if getattr(db.class_for_kind(class_name), 'serves_stale', False):
+                self = cache_read(STALE_PREFIX + key, namespace=class_name)
+            if not self:
+                self = wait_for_value(key, namespace=class_name)
+            if self:
+                return self
+            logging.info('Fetch %s %s without lease' % (class_name, id))
+        try:
             self = db.get(db.Key.from_path(class_name, id))
             if self:
                 self.awake_from_fetch(now)
                 self.cache_set()
-            elif create:
-                self = cls.new(id)
+        finally:
+            if leased:
+                release_lease(key, namespace=class_name)
         return self
 
     def awake_from_create(self):
@@ -88,15 +459,38 @@ class TAModel(db.Model):
         Provides a list with ids for all instances of this class, in alphabetical order
         :rtype : list
         """
-        memcache_key = '%s_ids' % cls.__name__
-        ids_list = memcache.get(memcache_key)
+        memcache_key = '%s%s_ids' % (cls.cache_prefix(), cls.__name__)
+        ids_list = cache_read(memcache_key)
         if not ids_list:
-            ids_list = []
-            for key in db.Query(cls, keys_only=True).fetch(1000):
-                ids_list.append(key.name())
-            memcache.set(memcache_key, ids_list)
+            ids_list = list(cls.iter_ids())
+            cache_write(memcache_key, ids_list)
         return ids_list
 
+    @classmethod
+    def iter_batches(cls, page_size=QUERY_PAGE_SIZE, keys_only=False):
+        """
+        Generates all instances of this class (or their keys) in lists of at most page_size items
+        """
+        return query_batches(db.Query(cls, keys_only=keys_only), page_size)
+
+    @classmethod
+    def iter_ids(cls, page_size=QUERY_PAGE_SIZE):
+        """
+        Generates the ids for all instances of this class, in alphabetical order
+        """
+        for keys in cls.iter_batches(page_size, keys_only=True):
+            for key in keys:
+                yield key.name()
+
+    @classmethod
+    def iter_objects(cls, page_size=QUERY_PAGE_SIZE):
+        """
+        Generates all instances of this class, in alphabetical order of their ids
+        """
+        for batch in cls.iter_batches(page_size):
+            for object in batch:
+                yield object
+
     @classmethod
     def active_ids(cls):
         """
@@ -108,7 +502,7 @@ class TAModel(db.Model):
 
     @classmethod
     def reset_ids(cls):
-        memcache.delete('%s_ids' % cls.__name__)
+        memcache.delete('%s%s_ids' % (cls.cache_prefix(), cls.__name__))
 
     @classmethod
     def dictionary_from_list(cls, the_list):
@@ -119,7 +513,7 @@ class TAModel(db.Model):
 
     @classmethod
     def objects_dictionary(cls):
-        return cls.dictionary_from_list(db.Query(cls).fetch(1000))
+        return cls.dictionary_from_list(cls.iter_objects())
 
     @classmethod
     def paginatedObjects(cls, page=1, length=20):
@@ -133,10 +527,21 @@ class TAModel(db.Model):
     @classmethod
     def xml_catalog(cls):
         document = XMLDocument(cls.__name__)
-        for object in db.Query(cls).fetch(1000):
+        for object in cls.iter_objects():
             document.root.add(object.xml)
         return document
 
+    @classmethod
+    def iter_xml_catalog(cls, page_size=QUERY_PAGE_SIZE):
+        """
+        Generates the xml catalog in parts: the opening root tag, the rendered elements of each batch of objects
+        and the closing root tag, so only one batch is held in memory
+        """
+        yield '%s\n<%s>\n' % (XML_DECLARATION, cls.__name__)
+        for batch in cls.iter_batches(page_size):
+            yield ''.join(object.xml.write(lf=True) for object in batch)
+        yield '</%s>\n' % cls.__name__
+
     @property
     def id(self):
         return self.key().name()
@@ -154,15 +559,65 @@ class TAModel(db.Model):
         return '/%s/%s' % (self.__class__.__name__, self.id)
     
     # Managing cache:
+    @classmethod
+    def cache_prefix(cls, kind=None):
+        """
+        Provides the prefix for memcache keys of the kind, the kind defaults to the class name
+        """
+        return '%d:' % kind_generation(kind or cls.__name__)
+
+    @classmethod
+    def invalidate_cache(cls):
+        """
+        Invalidates all memcached instances of the class, including its list of ids
+        """
+        bump_generation(cls.__name__)
+
+    @classmethod
+    def cache_get_multi(cls, ids):
+        return cache_read_multi(ids, key_prefix=cls.cache_prefix(), namespace=cls.__name__)
+
+    @classmethod
+    def objects_for_keys(cls, keys):
+        """
+        Provides a dictionary id > object for the given datastore keys,
+        read from memcache where possible, the remaining ones are fetched from the datastore in one batch
+        """
+        objects = cls.cache_get_multi([key.name() for key in keys])
+        missing_keys = [key for key in keys if key.name() not in objects]
+        if missing_keys:
+            for object in db.get(missing_keys):
+                if object:
+                    objects[object.id] = object
+        return objects
+
+    @classmethod
+    def cache_set_multi(cls, objects_dictionary):
+        cache_write_multi(objects_dictionary, key_prefix=cls.cache_prefix(), namespace=cls.__name__)
+
+    @classmethod
+    def cache_delete_multi(cls, ids):
+        memcache.delete_multi(ids, key_prefix=cls.cache_prefix(), namespace=cls.__name__)
+
     def cache_set(self):
-        memcache.set(self.id, self, namespace=self.key().kind())
+        kind = self.key().kind()
+        key = self.cache_prefix(kind) + self.id
+        mapping = {key: self}
+        if self.serves_stale:
+            mapping[STALE_PREFIX + key] = self
+        cache_write_multi(mapping, namespace=kind)
+
+    def cache_delete(self):
+        kind = self.key().kind()
+        key = self.cache_prefix(kind) + self.id
+        memcache.delete_multi([key, STALE_PREFIX + key], namespace=kind)
 
     def put(self):
         db.Model.put(self)
         self.cache_set()
 
     def delete(self):
-        memcache.delete(self.id, namespace=self.key().kind())
+        self.cache_delete()
         db.Model.delete(self)
 
     def instruction_task(self, url, instruction, issue_time_cet, expected=None, random_s=False):
@@ -202,7 +657,11 @@ class TAResourceHandler(webapp2.RequestHandler):
         format = self.request.get('format')
         if format == 'xml':
             self.response.content_type = 'application/xml'
-            self.response.out.write(self.xml)
+            if self.resource:
+                self.response.out.write(self.xml)
+            else:
+                for part in self.resourceClass.iter_xml_catalog():
+                    self.response.out.write(part)
         else:
             self.response.content_type = 'application/json'
             self.response.out.write(self.json)
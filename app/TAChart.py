@@ -21,70 +21,491 @@
 #
 
 import webapp2
-import logging, math
+import logging, math, json
 
-from datetime               import timedelta
+from array                  import array
+from collections            import defaultdict
+from itertools              import izip
 from google.appengine.ext   import db
-from google.appengine.api   import memcache
 
 from TABasics               import TAModel, TAResourceHandler, JSONProperty
 from TAScheduledPoint       import Direction
 
+
+# ====== Chart Data ==============================================================================
+
+class ChartTables:
+    pattern, delay, platform = range(3)
+    s = ['pattern', 'delay', 'platform']
+
+
+class Histogram(object):
+    """
+    Counts occurrences of integer values in consecutive bins of width one.
+    counts[i] holds the number of occurrences of the value base + i.
+    """
+
+    def __init__(self, base=0, counts=None):
+        self.base = base
+        self.counts = array('l', counts or [])
+
+    # Inserting data
+
+    def add(self, value, count=1):
+        self.cover(value, value)
+        self.counts[value - self.base] += count
+
+    def add_counts(self, dictionary):
+        """
+        Adds a dictionary with value > count items, extending the bins only once
+        """
+        if not dictionary:
+            return
+        self.cover(min(dictionary), max(dictionary))
+        counts = self.counts
+        base = self.base
+        for value, count in dictionary.iteritems():
+            counts[value - base] += count
+
+    def merge(self, other):
+        if not other.counts:
+            return
+        self.cover(other.base, other.base + len(other.counts) - 1)
+        counts = self.counts
+        offset = other.base - self.base
+        for index, count in enumerate(other.counts):
+            counts[offset + index] += count
+
+    def cover(self, low, high):
+        """
+        Extends the bins, so that values from low up to and including high can be counted
+        """
+        if not self.counts:
+            self.base = low
+            self.counts.extend([0] * (high - low + 1))
+            return
+        if low < self.base:
+            self.counts[0:0] = array('l', [0] * (self.base - low))
+            self.base = low
+        end = self.base + len(self.counts)
+        if high >= end:
+            self.counts.extend([0] * (high - end + 1))
+
+    # Statistics
+
+    @property
+    def values(self):
+        return xrange(self.base, self.base + len(self.counts))
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def items(self):
+        return [(value, count) for value, count in izip(self.values, self.counts) if count]
+
+    def mean(self):
+        total = self.total
+        if not total:
+            return None
+        return float(sum(value * count for value, count in izip(self.values, self.counts))) / total
+
+    def deviation(self):
+        total = self.total
+        if not total:
+            return None
+        mean = self.mean()
+        squares = sum(count * (value - mean) ** 2 for value, count in izip(self.values, self.counts))
+        return math.sqrt(squares / total)
+
+    def mode(self):
+        """
+        Provides the most common value and the number of its occurrences
+        """
+        if not self.counts:
+            return None, 0
+        maximum = max(self.counts)
+        return self.base + self.counts.index(maximum), maximum
+
+    def percentile(self, percentage):
+        """
+        Provides the lowest value below which (inclusive) the given percentage of occurrences was counted
+        """
+        total = self.total
+        if not total:
+            return None
+        limit = total * percentage / 100.0
+        cumulative = 0
+        for value, count in izip(self.values, self.counts):
+            cumulative += count
+            if count and cumulative >= limit:
+                return value
+
+    # Serializing and deserializing
+
+    @property
+    def repr(self):
+        if self.counts:
+            return [self.base] + self.counts.tolist()
+        else:
+            return []
+
+    @classmethod
+    def fromRepr(cls, array_repr):
+        if array_repr:
+            return cls(array_repr[0], array_repr[1:])
+        else:
+            return cls()
+
+
+class PointChart(object):
+    """
+    Histograms with the operational data of one scheduledPoint, for each table in each direction
+    """
+
+    def __init__(self, histograms=None):
+        if histograms is None:
+            histograms = [Histogram() for index in range(2 * len(ChartTables.s))]
+        self.histograms = histograms
+
+    def histogram(self, table, direction):
+        return self.histograms[2 * table + direction]
+
+    @property
+    def repr(self):
+        return [histogram.repr for histogram in self.histograms]
+
+    @classmethod
+    def fromRepr(cls, histograms_repr):
+        return cls([Histogram.fromRepr(array_repr) for array_repr in histograms_repr])
+
+
+class ChartData(object):
+    """
+    Point charts for a set of scheduledPoints, together with the interned table of platform names
+    to which the platform histograms refer
+    """
+
+    def __init__(self, points=None, platforms=None):
+        self.points = points or {}
+        self.platforms = platforms or []
+        self._platform_indexes = None
+
+    def point_chart(self, point_id, create=False):
+        point_chart = self.points.get(point_id, None)
+        if point_chart is None and create:
+            point_chart = PointChart()
+            self.points[point_id] = point_chart
+        return point_chart
+
+    def platform_index(self, platform):
+        if self._platform_indexes is None:
+            self._platform_indexes = dict((name, index) for index, name in enumerate(self.platforms))
+        index = self._platform_indexes.get(platform, None)
+        if index is None:
+            index = len(self.platforms)
+            self.platforms.append(platform)
+            self._platform_indexes[platform] = index
+        return index
+
+    def insert_point_chart(self, point_id, point_chart, platforms):
+        """
+        Inserts a point chart from another ChartData, of which the platform names are given
+        """
+        for direction in (Direction.down, Direction.up):
+            index = 2 * ChartTables.platform + direction
+            histogram = Histogram()
+            histogram.add_counts(dict((self.platform_index(platforms[platform]), count)
+                                      for platform, count in point_chart.histograms[index].items()))
+            point_chart.histograms[index] = histogram
+        self.points[point_id] = point_chart
+
+    @property
+    def repr(self):
+        points = {}
+        for point_id, point_chart in self.points.iteritems():
+            points[point_id] = point_chart.repr
+        return {'platforms': self.platforms, 'points': points}
+
+    @classmethod
+    def fromRepr(cls, dictionary):
+        points = {}
+        for point_id, histograms_repr in dictionary.get('points', {}).iteritems():
+            points[point_id] = PointChart.fromRepr(histograms_repr)
+        return cls(points, dictionary.get('platforms', []))
+
+    @classmethod
+    def from_tables_dictionary(cls, dictionary):
+        """
+        Converts charts that were stored as nested dictionaries, with string-formatted values as keys
+        """
+        self = cls()
+        for table in range(len(ChartTables.s)):
+            for direction in (Direction.down, Direction.up):
+                for point_id, histogram in dictionary.get(table_name(table, direction), {}).iteritems():
+                    target = self.point_chart(point_id, create=True).histogram(table, direction)
+                    for key, count in histogram.iteritems():
+                        if table == ChartTables.platform:
+                            target.add(self.platform_index(key), count)
+                        elif table == ChartTables.delay:
+                            target.add(delay_bucket(float(key)), count)
+                        else:
+                            target.add(int(key), count)
+        return self
+
+
+class ChartDataProperty(db.TextProperty):
+
+    def validate(self, value):
+        return value
+
+    def get_value_for_datastore(self, model_instance):
+        data = super(ChartDataProperty, self).get_value_for_datastore(model_instance)
+        if data is None:
+            return None
+        return db.Text(json.dumps(data.repr, separators=(',', ':')))
+
+    def make_value_from_datastore(self, value):
+        data = None
+        if value is not None:
+            data = ChartData.fromRepr(json.loads(str(value)))
+        return super(ChartDataProperty, self).make_value_from_datastore(data)
+
+
 # ====== Chart Model ============================================================================
 
+POINTS_PER_SHARD = 8
+
+
+class TAChartShard(TAModel):
+    """
+    Holds the chart data for a block of POINTS_PER_SHARD points of a TAChart
+    """
+
+    # Stored attributes:
+    _chartData      = ChartDataProperty()
+
+    # Object lifecycle:
+    @classmethod
+    def new(cls, id):
+        object = cls(key_name=id)
+        object._chartData = ChartData()
+        return object
+
+    @property
+    def data(self):
+        if self._chartData is None:
+            self._chartData = ChartData()
+        return self._chartData
+
+
 class TAChart(TAModel):
+    """
+    TAChart is the manifest of the chart of a series over one week. It records in which block every point
+    is stored; the histograms themselves are stored in a TAChartShard per block, fetched only when needed.
+    """
     
     # Stored attributes:
     _routePoints    = JSONProperty()
     _dataDictionary = JSONProperty()
+    _chartData      = ChartDataProperty()
+    _pointBlocks    = JSONProperty()
+
+    # Transient attributes
+    _shards         = None
+    _dirty_blocks   = None
 
     # Object lifecycle:
     @classmethod
     def new(cls, id):
         object = cls(key_name=id)
-        object._dataDictionary = {}
+        object._pointBlocks = {}
         return object
 
+    def awake_from_fetch(self, now):
+        if self._pointBlocks is None:
+            self._pointBlocks = {}
+        legacy_data = self._chartData
+        if legacy_data is None and self._dataDictionary:
+            legacy_data = ChartData.from_tables_dictionary(self._dataDictionary)
+        if legacy_data is not None:
+            for point_id, point_chart in legacy_data.points.iteritems():
+                self.data_for_point(point_id, create=True).insert_point_chart(point_id, point_chart,
+                                                                              legacy_data.platforms)
+            self._chartData = None
+            self._dataDictionary = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_shards', None)
+        state.pop('_dirty_blocks', None)
+        return state
+
+    # Managing shards:
+
+    @property
+    def point_blocks(self):
+        if self._pointBlocks is None:
+            self._pointBlocks = {}
+        return self._pointBlocks
+
+    def shard_id(self, block):
+        return '%s_%d' % (self.id, block)
+
+    def data_for_point(self, point_id, create=False):
+        """
+        Provides the ChartData of the shard in which the point is stored
+        :param create: when True, the point is assigned to a block and its shard is marked for storage
+        """
+        block = self.point_blocks.get(point_id, None)
+        if block is None:
+            if not create:
+                return None
+            block = len(self.point_blocks) // POINTS_PER_SHARD
+            self.point_blocks[point_id] = block
+        self.load_shards([block])
+        shard = self._shards.get(block, None)
+        if shard is None:
+            if not create:
+                return None
+            shard = TAChartShard.new(self.shard_id(block))
+            self._shards[block] = shard
+        if create:
+            self._dirty_blocks.add(block)
+        return shard.data
+
+    def load_shards(self, blocks=None):
+        """
+        Fetches the shards for the given blocks (default: all blocks) that have not been fetched yet,
+        from memcache when possible and from the datastore otherwise.
+        """
+        if self._shards is None:
+            self._shards = {}
+            self._dirty_blocks = set()
+        if blocks is None:
+            blocks = set(self.point_blocks.itervalues())
+        missing = [self.shard_id(block) for block in blocks if block not in self._shards]
+        if not missing:
+            return
+        shards = TAChartShard.cache_get_multi(missing)
+        uncached = [shard_id for shard_id in missing if shard_id not in shards]
+        if uncached:
+            for shard in db.get([db.Key.from_path('TAChartShard', shard_id) for shard_id in uncached]):
+                if shard is not None:
+                    shard.cache_set()
+                    shards[shard.id] = shard
+        for shard in shards.itervalues():
+            self._shards[int(shard.id.rsplit('_', 1)[1])] = shard
+
+    @property
+    def modified_objects(self):
+        """
+        Provides the chart itself and the shards that were changed, to be stored in the datastore
+        """
+        objects = [self]
+        if self._dirty_blocks:
+            for block in sorted(self._dirty_blocks):
+                objects.append(self._shards[block])
+        return objects
+
+    def cache_set(self):
+        TAModel.cache_set(self)
+        if self._dirty_blocks:
+            for block in self._dirty_blocks:
+                self._shards[block].cache_set()
+
+    def put(self):
+        db.put(self.modified_objects)
+        self.cache_set()
+        if self._dirty_blocks:
+            self._dirty_blocks = set()
+
+    def delete(self):
+        blocks = set(self.point_blocks.itervalues())
+        shard_ids = [self.shard_id(block) for block in blocks]
+        TAChartShard.cache_delete_multi(shard_ids)
+        db.delete([db.Key.from_path('TAChartShard', shard_id) for shard_id in shard_ids])
+        TAModel.delete(self)
+
     # Inserting data:
     
     def add_mission(self, mission):
-        for stop in mission.stops:
-            if stop.station_id:
-                self.addPatternTime(stop.station_id, stop.up, mission.pattern_minutes_at_stop(stop))
-                self.addDelay(stop.station_id, stop.up, stop.delay_dep)
-                self.addPlatform(stop.station_id, stop.up, stop.platform)
+        self.ingest_series(None, [mission])
+
+    def ingest_series(self, series, missions):
+        """
+        Adds the operational data of a stream of missions in one pass.
+        Occurrences are tallied per point, in the order of the point index of the series,
+        and merged into the chart only once for every point.
+        :param series: the TASeries the missions belong to (None if unknown)
+        :param missions: an iterable with TAMission objects
+        :return: a dictionary station_id > tally, with the occurrences that were added for every histogram
+        """
+        station_ids = []
+        if series is not None:
+            station_ids = [point.station_id for point in series.points]
+        slots = dict((station_id, index) for index, station_id in enumerate(station_ids))
+        tallies = [None] * len(station_ids)
+        nr_of_histograms = 2 * len(ChartTables.s)
+
+        for mission in missions:
+            offset = mission.offset_cet
+            for stop in mission.stops:
+                station_id = stop.station_id
+                if not station_id:
+                    continue
+                slot = slots.get(station_id, None)
+                if slot is None:
+                    slot = len(station_ids)
+                    slots[station_id] = slot
+                    station_ids.append(station_id)
+                    tallies.append(None)
+                tally = tallies[slot]
+                if tally is None:
+                    tally = [defaultdict(int) for index in range(nr_of_histograms)]
+                    tallies[slot] = tally
+                up = stop.up
+                tally[2 * ChartTables.pattern + up][(stop.departure - offset).seconds // 60] += 1
+                tally[2 * ChartTables.delay + up][delay_bucket(stop.delay_dep)] += 1
+                platform = stop.platform
+                if platform and '-' not in platform:
+                    tally[2 * ChartTables.platform + up][platform.lower()] += 1
+
+        contributions = {}
+        for slot, tally in enumerate(tallies):
+            if tally is None:
+                continue
+            contributions[station_ids[slot]] = tally
+            data = self.data_for_point(station_ids[slot], create=True)
+            for direction in (Direction.down, Direction.up):
+                platforms = tally[2 * ChartTables.platform + direction]
+                tally[2 * ChartTables.platform + direction] = dict((data.platform_index(name), count)
+                                                                   for name, count in platforms.iteritems())
+            point_chart = data.point_chart(station_ids[slot], create=True)
+            for histogram, counts in zip(point_chart.histograms, tally):
+                histogram.add_counts(counts)
+        return contributions
     
     def addPatternTime(self, pointID, up, data):
-        self.addOccurrence(patternTable(up), pointID, data)
+        self.histogramForPoint(ChartTables.pattern, pointID, up, create=True).add(int(data))
 
     def addDelay(self, pointID, up, data):
-        self.addOccurrence(delayTable(up), pointID, data)
+        self.histogramForPoint(ChartTables.delay, pointID, up, create=True).add(delay_bucket(data))
     
     def addPlatform(self, pointID, up, data):
         if not data: return
         if '-' in data: return
-        data = data.lower()
-        self.addOccurrence(platformTable(up), pointID, data)
-
-    def addOccurrence(self, tableName, pointID, data):
-        histogram = self.histogramForPoint(tableName, pointID)
-        data = str(data)
-        histogram[data] = histogram.get(data, 0) + 1
-
-    def histogramForPoint(self, tableName, pointID):
-        table = self.tableWithName(tableName)
-        histogram = table.get(pointID, None)
-        if histogram == None:
-            histogram = {}
-            table[pointID] = histogram
-        return histogram
-
-    def tableWithName(self, tableName):
-        table = self._dataDictionary.get(tableName, None)
-        if table == None:
-            table = {}
-            self._dataDictionary[tableName] = table
-        return table
+        platform_index = self.data_for_point(pointID, create=True).platform_index(data.lower())
+        self.histogramForPoint(ChartTables.platform, pointID, up, create=True).add(platform_index)
+
+    def histogramForPoint(self, table, pointID, direction, create=False):
+        data = self.data_for_point(pointID, create)
+        if data is None:
+            return Histogram()
+        point_chart = data.point_chart(pointID, create)
+        if point_chart is None:
+            return Histogram()
+        return point_chart.histogram(table, direction)
 
     # Applying data to correct scheduledPoints
     
@@ -95,10 +516,10 @@ class TAChart(TAModel):
         self.processPlatformStats(point, Direction.down)
 
     def processPatternStats(self, point, direction):
-        histogram = self.histogramForPoint(patternTable(direction), point.station_id)
-        if histogram:
+        histogram = self.histogramForPoint(ChartTables.pattern, point.station_id, direction)
+        if histogram.total:
             arrival, departure = point.times_in_direction(direction)
-            delta = int(check_value(departure, histogram)) - departure
+            delta = check_value(departure, histogram) - departure
             if delta == 0:
                 pass
             elif -30 < delta < 30:
@@ -113,15 +534,14 @@ class TAChart(TAModel):
                                 (point.id, delta, direction))
     
     def processPlatformStats(self, point, direction):
-        histogram = self.histogramForPoint(platformTable(direction), point.station_id)
-        count = 0.0
-        for value in histogram.itervalues():
-            count += value
+        histogram = self.histogramForPoint(ChartTables.platform, point.station_id, direction)
+        count = float(histogram.total)
         if count:
+            platform_names = self.data_for_point(point.station_id).platforms
             platforms = []
-            for key, value in histogram.iteritems():
+            for index, value in histogram.items():
                 if value / count > 0.35:
-                    platforms.append(key)
+                    platforms.append(platform_names[index])
             platforms.sort()
             if platforms != point.platform_list[direction]:
                 point.platform_list[direction] = platforms
@@ -130,21 +550,31 @@ class TAChart(TAModel):
     # Statistics
 
     def delayHist(self, pointID, direction):
-        return self.histogramForPoint(delayTable(direction), pointID)
+        return self.histogramForPoint(ChartTables.delay, pointID, direction)
 
     def delayStats(self, pointID, direction):
-        histogram = self.histogramForPoint(delayTable(direction), pointID)
-        count = 0
-        total = 0.0
-        for key, value in histogram.iteritems():
-            count += value
-            total += float(key) * value
-        if count == 0: return None, None
-        avarage = total / count
-        for key, value in histogram.iteritems():
-            total += value * ((float(key) - avarage) ** 2)
-        deviation = math.sqrt(total / count)
-        return avarage, deviation
+        histogram = self.delayHist(pointID, direction)
+        return histogram.mean(), histogram.deviation()
+
+    @property
+    def tables_dictionary(self):
+        """
+        Provides the charted data as nested dictionaries: table name > point id > value > count
+        """
+        self.load_shards()
+        dictionary = {}
+        for shard in self._shards.itervalues():
+            data = shard.data
+            for point_id, point_chart in data.points.iteritems():
+                for table in range(len(ChartTables.s)):
+                    for direction in (Direction.down, Direction.up):
+                        items = point_chart.histogram(table, direction).items()
+                        if not items:
+                            continue
+                        if table == ChartTables.platform:
+                            items = [(data.platforms[index], count) for index, count in items]
+                        dictionary.setdefault(table_name(table, direction), {})[point_id] = dict(items)
+        return dictionary
 
 # ====== Chart Handler ===========================================================================
 
@@ -154,37 +584,26 @@ class TAChartHandler(TAResourceHandler):
 
 # ====== Table names =============================================================================
 
-def patternTable(up):
-    if up:  return 'pattern_up'
-    else:   return 'pattern_down'
-
-def delayTable(up):
-    if up:  return 'delay_up'
-    else:   return 'delay_down'
-
-def platformTable(up):
-    if up:  return 'platform_up'
-    else:   return 'platform_down'
+def table_name(table, up):
+    if up:  return '%s_up' % ChartTables.s[table]
+    else:   return '%s_down' % ChartTables.s[table]
 
 
 # ====== Helper functions =========================================================================
 
+def delay_bucket(delay):
+    """
+    Delays are counted in whole minutes, early departures and long delays are kept as they are
+    """
+    return int(math.floor(delay))
+
 def check_value(originalValue, histogram):
-    foundValue, counter = most_common_item(histogram)
+    foundValue, counter = histogram.mode()
     if counter < 10:
         return originalValue
     else:
         return foundValue
 
-def most_common_item(histogram):
-    maxValue = 0
-    foundKey = None
-    for key, value in histogram.iteritems():
-        if value > maxValue:
-            foundKey = key
-            maxValue = value
-    return (foundKey, maxValue)
-
 
 # ====== WSGI Application ========================================================================
 
@@ -27,15 +27,22 @@ import math, logging
 from ffe                import markup
 from ffe.gae            import counter_dict
 
+from TABasics           import cache_stats, local_cache_stats
 from TAScheduledPoint   import Direction
 from TSStation          import TSStation
 from TASeries           import TASeries
 from TAMission          import TAMission, MissionStatuses
+from TAStop             import names_for_station_ids
+from TARollup           import TARollup, ROLLING_WEEKS
+from TAMapper           import TAMapperJob
 
 MENU_LIST = (('Home', '/console'),
              ('Stations', '/console/stations'),
              ('Series', '/console/series'))
 
+TREND_WEEKS = 6
+MAPPER_JOBS_SHOWN = 10
+
 
 # URL Handlers
 
@@ -71,6 +78,38 @@ class ConsoleHandler(webapp2.RequestHandler):
             row.add_to_cell(0, key)
             row.add_to_cell(1, str(value))
 
+        document.main.add(markup.heading(2, 'Memcache (deze instance)'))
+        table = document.add_table('cache_table', ['naam', 'waarde'])
+        for key, value in sorted(cache_stats().items()):
+            row = table.add_row()
+            row.add_to_cell(0, key)
+            if isinstance(value, float):
+                row.add_to_cell(1, '%.2f' % value)
+            else:
+                row.add_to_cell(1, str(value))
+
+        table = document.add_table('local_cache_table', ['soort', 'objecten', 'hits', 'misses', 'verdrongen', 'hit ratio'])
+        for stats in local_cache_stats():
+            row = table.add_row()
+            row.add_to_cell(0, stats['kind'])
+            row.add_to_cell(1, '%d / %d' % (stats['entries'], stats['size']))
+            row.add_to_cell(2, str(stats['hits']))
+            row.add_to_cell(3, str(stats['misses']))
+            row.add_to_cell(4, str(stats['evictions']))
+            if stats['hit_ratio'] is not None:
+                row.add_to_cell(5, '%.2f' % stats['hit_ratio'])
+
+        document.main.add(markup.heading(2, 'Bulkopdrachten'))
+        table = document.add_table('mapper_table', ['opdracht', 'status', 'verwerkt', 'batches', 'fouten', 'per seconde'])
+        for job in TAMapperJob.all().order('-started').fetch(MAPPER_JOBS_SHOWN):
+            row = table.add_row()
+            row.add_to_cell(0, job.id)
+            row.add_to_cell(1, ('bezig', 'klaar', 'mislukt')[job.status])
+            row.add_to_cell(2, str(job.processed))
+            row.add_to_cell(3, str(job.batches))
+            row.add_to_cell(4, str(job.failures))
+            row.add_to_cell(5, '%.1f' % job.throughput)
+
         self.response.out.write(document.write())
 
 
@@ -365,6 +404,7 @@ class ScheduleHandler(webapp2.RequestHandler):
                 label = '%d treinen in serie %s' % (the_series.nr_of_missions, the_series.name)
                 document.add_reference('/console/missions?kind=active&series=%s' % the_series.id, label)
             table = document.add_table('stops_table', ['s', 'A', 'V', 'dV', 'station', 'perron'])
+            station_names = names_for_station_ids([the_stop.station_id for the_stop in the_mission.stops])
             for the_stop in the_mission.stops:
                 row = table.add_row()
                 row.add_to_cell(0, the_stop.status)
@@ -375,7 +415,8 @@ class ScheduleHandler(webapp2.RequestHandler):
                     row.add_to_cell(3, '+%d' % delay)
                 else:
                     row.add_to_cell(3, '-')
-                row.add_link_to_cell(4, '/console/departures?station=%s' % the_stop.station.code, the_stop.station.name)
+                row.add_link_to_cell(4, '/console/departures?station=%s' % the_stop.station_code,
+                                     station_names.get(the_stop.station_id))
                 if the_stop.platformChange:
                     row.add_to_cell(5, '%s <<' % the_stop.platform)
                 else:
@@ -398,31 +439,30 @@ class ScheduleHandler(webapp2.RequestHandler):
 
             document = ConsoleDocument('Treinserie %s (%s)' % (the_series.name, label))
             document.add_reference('/console/schedule?series=%s&direction=%s' % (series_id, reverse),reverse_label)
-            table = document.add_table('stops_table', ['km', 'station', 'aankomst', 'vertrek', 'perron', 'Jan', 'Feb'])
+            rollup = TARollup.get(series_id)
+            table = document.add_table('stops_table', ['km', 'station', 'aankomst', 'vertrek', 'perron',
+                                                       '%d weken' % ROLLING_WEEKS, 'trend'])
             for point in points_list:
                 row = table.add_row()
                 row.add_to_cell(0, '%.1f' % point.km)
                 row.add_to_cell(1, point.stationName)
                 if up:
+                    direction = Direction.up
                     row.add_to_cell(2, str(point.upArrival))
                     row.add_to_cell(3, str(point.upDeparture))
-                    row.add_to_cell(4, point.platform_string(Direction.up))
-                    avarage, delay = point.delayStats(Direction.up, 1)
-                    if avarage != None:
-                        row.add_to_cell(5, '%.1f - %.1f' % (avarage, delay))
-                    avarage, delay = point.delayStats(Direction.up, 2)
-                    if avarage != None:
-                        row.add_to_cell(6, '%.1f - %.1f' % (avarage, delay))
                 else:
+                    direction = Direction.down
                     row.add_to_cell(2, str(point.downArrival))
                     row.add_to_cell(3, str(point.downDeparture))
-                    row.add_to_cell(4, point.platform_string(Direction.down))
-                    avarage, delay = point.delayStats(Direction.down, 1)
-                    if avarage != None:
-                        row.add_to_cell(5, '%.1f - %.1f' % (avarage, delay))
-                    avarage, delay = point.delayStats(Direction.down, 2)
-                    if avarage != None:
-                        row.add_to_cell(6, '%.1f - %.1f' % (avarage, delay))
+                row.add_to_cell(4, point.platform_string(direction))
+                if rollup:
+                    stats = rollup.rolling_statistics(point.station_id, direction)
+                    if stats['count']:
+                        row.add_to_cell(5, '%.1f - %.1f (%.0f%%)' % (stats['mean'], stats['deviation'],
+                                                                     100 * stats['punctuality']))
+                    trend = rollup.trend(point.station_id, direction)[-TREND_WEEKS:]
+                    row.add_to_cell(6, ' '.join('-' if week['mean'] is None else '%.1f' % week['mean']
+                                                for label, week in trend))
             self.response.out.write(document.write())
 
 
@@ -29,10 +29,13 @@ from google.appengine.api   import memcache, taskqueue
 
 from ffe                    import config
 from ffe.gae                import issue_tasks, task_name
-from ffe.ffe_time           import now_utc
+from ffe.ffe_time           import now_utc, now_cet
 from TSStation              import TSStation
 from TASeries               import TASeries
-from TAMission              import TAMission
+from TAMission              import TAMission, sweep_tallies
+from TAScheduledPoint       import TAScheduledPoint
+from TASnapshot             import compile_snapshot, store_snapshot
+from TAMapper               import TAMapper, TAMapperJob, register_mapper, start_mapper
 
 
 class TARequestHandler(webapp2.RequestHandler):
@@ -53,6 +56,22 @@ class TARequestHandler(webapp2.RequestHandler):
         elif self.instruction == 'remove_orphans':
             self.remove_orphans()
 
+        elif self.instruction == 'flush_aliases':
+            self.flush_aliases()
+
+        elif self.instruction == 'compile_snapshot':
+            store_snapshot(compile_snapshot())
+
+        elif self.instruction == 'sweep_tallies':
+            sweep_tallies(now_cet())
+
+        elif self.instruction == 'run_mapper':
+            job = TAMapperJob.get(self.request.get('job'))
+            if job:
+                job.run_slice()
+            else:
+                logging.warning('Mapper job %s not found' % self.request.get('job'))
+
     @staticmethod
     def create_and_issue_tasks(target_class, period, instruction):
         tasks = []
@@ -74,13 +93,35 @@ class TARequestHandler(webapp2.RequestHandler):
 
     @staticmethod
     def remove_orphans():
-        mission_keys = db.Query(TAMission, keys_only=True).filter('series_id =', 'orphan').fetch(1000)
-        mission_ids = []
-        for key in mission_keys:
-            mission_ids.append(key.name())
-        logging.info('Remove %d orphan missions' % len(mission_keys))
-        memcache.delete_multi(mission_ids, namespace='TAMission')
-        db.delete(mission_keys)
+        start_mapper(RemoveOrphansMapper.name)
+
+    @staticmethod
+    def flush_aliases():
+        aliases = TAScheduledPoint.pop_pending_aliases()
+        if not aliases:
+            return
+        series_ids = set(series_id for series_id, name in aliases.itervalues())
+        updated_objects = []
+        updated_points = {}
+        for series_id in series_ids:
+            series = TASeries.get(series_id)
+            if not series:
+                continue
+            changes = False
+            for point in series.points:
+                series_id, name = aliases.get(point.id, (None, None))
+                if name and point.stationName != name:
+                    point.stationName = name
+                    updated_points[point.id] = point
+                    updated_objects.append(point)
+                    changes = True
+            if changes:
+                series.pack_points()
+                series.cache_set()
+                updated_objects.append(series)
+        logging.info('Store %d learned aliases' % len(updated_points))
+        TAScheduledPoint.cache_set_multi(updated_points)
+        db.put(updated_objects)
 
     @property
     def instruction(self):
@@ -91,6 +132,21 @@ class TARequestHandler(webapp2.RequestHandler):
         return self._instruction
 
 
+# ====== Mappers ==========================================================================
+
+@register_mapper
+class RemoveOrphansMapper(TAMapper):
+    name = 'remove_orphans'
+    page_size = 500
+
+    def query(self):
+        return db.Query(TAMission, keys_only=True).filter('series_id =', 'orphan')
+
+    def process_batch(self, mission_keys):
+        TAMission.cache_delete_multi([key.name() for key in mission_keys])
+        db.delete(mission_keys)
+
+
 # WSGI Application
 
 URL_SCHEMA = [('/TAManager.*', TARequestHandler)]
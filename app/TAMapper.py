@@ -0,0 +1,208 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TAMapper.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+import logging, random, time
+
+from google.appengine.ext   import db
+from google.appengine.api   import taskqueue
+
+from ffe.ffe_time           import now_utc
+from TABasics               import TAModel, JSONProperty
+
+MAPPER_PAGE_SIZE = 100
+
+# a slice of work stops taking new batches after SLICE_SECONDS and continues in a task
+SLICE_SECONDS = 20
+
+# a job that failed MAX_FAILURES times is given up, a failed batch is retried after RETRY_COUNTDOWN seconds
+MAX_FAILURES = 5
+RETRY_COUNTDOWN = 30
+
+_mappers = {}
+
+
+def register_mapper(mapper_class):
+    """
+    Class decorator that makes a mapper available to jobs under its name
+    """
+    _mappers[mapper_class.name] = mapper_class
+    return mapper_class
+
+
+def start_mapper(name, **params):
+    """
+    Creates a job for the mapper with name and runs its first slice within the current request.
+    :return: the TAMapperJob, its status tells whether the work is already done
+    """
+    job = TAMapperJob.new('%s_%s_%04d' % (name, now_utc().strftime('%Y%m%d%H%M%S'), random.randint(0, 9999)))
+    job.mapper_name = name
+    job.params = params
+    job.started = now_utc()
+    job.run_slice()
+    return job
+
+
+class JobStatuses:
+    running, done, failed = range(3)
+
+
+# ====== Mapper ==========================================================================
+
+class TAMapper(object):
+    """
+    A mapper processes all entities of a query in batches of page_size.
+    Subclasses provide a name, a query and the processing of a batch,
+    and are made available with the register_mapper decorator.
+    A failed batch is processed again, so process_batch should store its results in one final step.
+    """
+
+    name = None
+    page_size = MAPPER_PAGE_SIZE
+
+    def __init__(self, job):
+        self.job = job
+        self.params = job.params
+
+    def query(self):
+        """
+        Provides the db query of the entities to process, a mapper without a query has nothing to do
+        """
+        pass
+
+    def process_batch(self, batch):
+        pass
+
+    def finish(self):
+        """
+        Called once, after the last batch was processed
+        """
+        pass
+
+
+# ====== Mapper Job ==========================================================================
+
+class TAMapperJob(TAModel):
+    """
+    TAMapperJob keeps the progress of a mapper: the cursor after the last processed batch,
+    the number of processed entities and the time spent, so the work can continue in a new task.
+    """
+
+    # Stored attributes:
+    mapper_name     = db.StringProperty()
+    _params         = JSONProperty()
+    cursor          = db.TextProperty()
+    status          = db.IntegerProperty(default=JobStatuses.running)
+    processed       = db.IntegerProperty(default=0)
+    batches         = db.IntegerProperty(default=0)
+    failures        = db.IntegerProperty(default=0)
+    elapsed         = db.FloatProperty(default=0.0)
+    started         = db.DateTimeProperty()
+    updated         = db.DateTimeProperty()
+    last_error      = db.TextProperty()
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = {}
+        return self._params
+
+    @params.setter
+    def params(self, dictionary):
+        self._params = dictionary
+
+    @property
+    def throughput(self):
+        """
+        Provides the number of processed entities per second
+        """
+        if self.elapsed:
+            return self.processed / self.elapsed
+        return 0.0
+
+    # Running the job
+
+    def run_slice(self, seconds=SLICE_SECONDS):
+        """
+        Processes batches from the last checkpoint on, until the work is done or seconds have passed,
+        at least one batch is processed.
+        A failed batch is retried from the same checkpoint in a task, until MAX_FAILURES is reached.
+        """
+        if self.status != JobStatuses.running:
+            return
+        mapper = _mappers[self.mapper_name](self)
+        start_time = time.time()
+        while self.status == JobStatuses.running:
+            batch_start = time.time()
+            try:
+                self.run_batch(mapper)
+            except Exception as error:
+                logging.exception('Mapper %s failed' % self.id)
+                self.failures += 1
+                self.last_error = '%s: %s' % (error.__class__.__name__, error)
+                if self.failures >= MAX_FAILURES:
+                    logging.error('Give up mapper %s after %d failures' % (self.id, self.failures))
+                    self.status = JobStatuses.failed
+                self.checkpoint(time.time() - batch_start)
+                self.issue_continuation(RETRY_COUNTDOWN)
+                return
+            self.checkpoint(time.time() - batch_start)
+            if time.time() - start_time >= seconds:
+                break
+        if self.status == JobStatuses.running:
+            self.issue_continuation()
+        else:
+            logging.info('Mapper %s processed %d entities in %d batches (%.1f/s)' %
+                         (self.id, self.processed, self.batches, self.throughput))
+
+    def run_batch(self, mapper):
+        query = mapper.query()
+        if query is None:
+            batch = []
+        else:
+            if self.cursor:
+                query.with_cursor(self.cursor)
+            batch = query.fetch(mapper.page_size)
+        if batch:
+            mapper.process_batch(batch)
+        self.processed += len(batch)
+        self.batches += 1
+        if len(batch) < mapper.page_size:
+            mapper.finish()
+            self.status = JobStatuses.done
+        else:
+            self.cursor = query.cursor()
+
+    def checkpoint(self, seconds):
+        self.elapsed += seconds
+        self.updated = now_utc()
+        self.put()
+
+    def issue_continuation(self, countdown=0):
+        if self.status != JobStatuses.running:
+            return
+        task = taskqueue.Task(name='mapper_%s_%d_%d' % (self.id, self.batches, self.failures),
+                              url='/TAManager/run_mapper', params={'job': self.id}, method='GET',
+                              countdown=countdown)
+        try:
+            task.add()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
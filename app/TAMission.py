@@ -20,18 +20,82 @@
 #  Created by Berend Schotanus on 21-Feb-13.
 #
 
-import json, logging, random
+import json, logging, random, bisect
 
 from google.appengine.ext   import db
+from google.appengine.api   import memcache, taskqueue
 from datetime               import datetime, time, timedelta
 
 from ffe                    import config
 from ffe.gae                import increase_counter, issue_tasks
 from ffe.markup             import XMLElement
 from ffe.ffe_time           import now_cet, mark_cet
-from TABasics               import TAModel
+from TABasics               import TAModel, cas_update
 from TAStop                 import TAStop, StopStatuses, repr_list_from_stops
 
+# Live statistics count the missions of a day by status, and the running missions by delay in whole minutes
+# from 0 up to DELAY_BUCKET_LIMIT, in counters spread over LIVE_STATS_SHARDS shards by mission number.
+# Each mission keeps the entry it was counted with, a new tally moves its count from the counters of that entry
+# to those of the new one. Running missions with delayed stops are kept on the delay board of their shard.
+# A shard whose counters were lost from memcache is counted again from the datastore. Missions due for a
+# status change are kept in windows of SWEEP_MINUTES and are tallied again by a task after their window has passed.
+LIVE_STATS_NAMESPACE = 'live_statistics'
+LIVE_STATS_SHARDS = 5
+DELAY_BUCKET_LIMIT = 90
+SWEEP_MINUTES = 10
+
+
+class MissionTiming(object):
+    """
+    MissionTiming keeps the times of the stops of a mission in parallel arrays,
+    as seconds after the departure of the first stop, with the delays of the stops
+    and a station > index dictionary.
+    """
+
+    def __init__(self, stops):
+        self.size = len(stops)
+        self.base = None
+        if stops:
+            self.base = stops[0].departure or stops[0].arrival
+        self.arrival = [self.seconds(stop.arrival) for stop in stops]
+        self.departure = [self.seconds(stop.departure) for stop in stops]
+        self.delay = [stop.delay_dep for stop in stops]
+        self.station_index = {}
+        for index, stop in enumerate(stops):
+            self.station_index.setdefault(stop.station_id, index)
+        self.latest_departure = [0.0] * self.size
+        self.update_estimates()
+
+    def seconds(self, moment):
+        if moment is None:
+            return None
+        return int((moment - self.base).total_seconds())
+
+    def update_estimates(self, start=0):
+        """
+        Recalculates, from index start on, the latest estimated departure of each stop and the stops before it
+        """
+        latest = self.latest_departure[start - 1] if start > 0 else float('-inf')
+        for index in range(start, self.size):
+            departure = self.departure[index]
+            if departure is None:
+                departure = self.arrival[index]
+            latest = max(latest, departure + self.delay[index] * 60)
+            self.latest_departure[index] = latest
+
+    def set_delay(self, index, delay):
+        self.delay[index] = delay
+        self.update_estimates(index)
+
+    def next_index(self, now):
+        """
+        Provides the index of the first stop with an estimated departure after now, or None
+        """
+        index = bisect.bisect_right(self.latest_departure, (now - self.base).total_seconds())
+        if index < self.size:
+            return index
+
+
 # ========== Mission Model ==========================================================================
 
 
@@ -90,6 +154,11 @@ class TAMission(TAModel):
     needs_datastore_put = False
     issue_time          = None
     tasks               = None
+    tally_date          = None
+    tally_entry         = None
+    tally_due           = None
+    _status_cache       = None
+    _timing             = None
 
     # ------ Object lifecycle ---------------------------------------------
 
@@ -341,6 +410,20 @@ class TAMission(TAModel):
     @stops.setter
     def stops(self, stops):
         self._stops = stops
+        self.invalidate_timing()
+
+    @property
+    def timing(self):
+        if self._timing is None:
+            self._timing = MissionTiming(self.stops)
+        return self._timing
+
+    def invalidate_timing(self):
+        """
+        Must be called after stops were added or removed, or their scheduled times were changed
+        """
+        self._timing = None
+        self._status_cache = None
 
     @property
     def first_stop(self):
@@ -367,7 +450,7 @@ class TAMission(TAModel):
     def destination(self):
         if not self.last_stop:
             return 'no stops'
-        last_station = self.last_stop.station.name
+        last_station = self.last_stop.station_name
         announced_destination = self.last_stop.destination
         if last_station == announced_destination:
             return last_station
@@ -383,9 +466,9 @@ class TAMission(TAModel):
             all_stops.append(new_stop)
         if all_stops:
             all_stops[-1].status = StopStatuses.finalDestination
-            last_station = all_stops[-1].station
+            last_station = all_stops[-1].station_name
             for stop in all_stops:
-                stop.destination = last_station.name
+                stop.destination = last_station
         self.stops = all_stops
 
     def update_stop(self, updated):
@@ -395,6 +478,8 @@ class TAMission(TAModel):
         status, delay = self.status_at_time(now)
         if status == MissionStatuses.arrived:
             logging.info('Update was ignored because mission has already arrived')
+            if self.tally(now):
+                self.cache_set()
             return
 
         changes = False
@@ -444,6 +529,7 @@ class TAMission(TAModel):
                             self.issue_time += timedelta(seconds=config.INTERVAL_BETWEEN_UPDATE_MSG)
                             self.tasks.append(self.instruction_task(next_stop.station_url, 'prio', self.issue_time))
                         existing.delay_dep = updated.delay_dep
+                        self.timing.set_delay(index, updated.delay_dep)
                     changes = True
 
                 if existing.platform != updated.platform and updated.platform is not None:
@@ -478,6 +564,7 @@ class TAMission(TAModel):
                     delta = updated.departure - existing.departure
                     existing.arrival += delta
                     existing.departure = updated.departure
+                    self.invalidate_timing()
                     changes = True
 
             issue_tasks(self.tasks)
@@ -487,6 +574,7 @@ class TAMission(TAModel):
             if updated.status == StopStatuses.announced or updated.status == StopStatuses.extra:
                 self.anterior_stops(updated)
                 changes = True
+        tallied = self.tally(now)
         if changes:
             increase_counter('mission_changes')
             self.put()
@@ -496,8 +584,11 @@ class TAMission(TAModel):
                 self.cache_set()
             else:
                 increase_counter('mission_no_changes')
+                if tallied:
+                    self.cache_set()
 
     def remove_stop(self, index):
+        self.invalidate_timing()
         if index == 0:
             if len(self.stops) == 1 or len(self.stops) == 2 and self.stops[1].status == StopStatuses.finalDestination:
                 self.stops = []
@@ -508,7 +599,7 @@ class TAMission(TAModel):
                 logging.info('Mission origin changed to %s' % self.origin_id)
                 del self.stops[0]
         else:
-            station_name = self.stops[index].station.name
+            station_name = self.stops[index].station_name
             is_destination = False
             i = index - 1
             while i >= 0:
@@ -552,20 +643,22 @@ class TAMission(TAModel):
         """
         Updates the delay for index and higher
         """
+        timing = self.timing
+        first_index = index
         stop = self.stops[index]
         stop.delay_dep = delay
+        timing.delay[index] = delay
         self.delay = delay
 
         index += 1
-        while index < len(self.stops):
-            previous_stop = stop
+        while index < timing.size:
             stop = self.stops[index]
-            riding_time = stop.arrival - previous_stop.departure
-            margin = (riding_time.seconds * config.RIDING_TIME_MARGIN) / 60
+            riding_time = timing.arrival[index] - timing.departure[index - 1]
+            margin = (riding_time * config.RIDING_TIME_MARGIN) / 60
             if stop.status == StopStatuses.planned or stop.status == StopStatuses.announced:
-                stop_time = stop.departure - stop.arrival
-                if stop_time.seconds > config.MINIMUM_STOP_TIME:
-                    margin += (stop_time.seconds - config.MINIMUM_STOP_TIME) / 60
+                stop_time = timing.departure[index] - timing.arrival[index]
+                if stop_time > config.MINIMUM_STOP_TIME:
+                    margin += (stop_time - config.MINIMUM_STOP_TIME) / 60
             delay -= margin
             if delay < 0:
                 if increasing:
@@ -574,24 +667,23 @@ class TAMission(TAModel):
             if increasing:
                 if delay > stop.delay_dep:
                     stop.delay_dep = delay
+                    timing.delay[index] = delay
             else:
                 if delay < stop.delay_dep:
                     stop.delay_dep = delay
+                    timing.delay[index] = delay
             index += 1
+        timing.update_estimates(first_index)
 
     def index_for_stop(self, searched_stop):
-        for index, stop in enumerate(self.stops):
-            if searched_stop.station_id == stop.station_id:
-                return index
-        return None
+        return self.timing.station_index.get(searched_stop.station_id)
 
     def next_stop_index(self, now=None):
         if not now:
             now = now_cet()
-        for index in range(len(self.stops)):
-            if now < self.stops[index].est_departure:
-                return index
-        return None
+        if not self.stops:
+            return None
+        return self.timing.next_index(now)
 
     def anterior_stops(self, new_stop):
         series = self.series
@@ -637,11 +729,12 @@ class TAMission(TAModel):
                 current_stops = []
 
             # search for more scheduledPoints that are not yet in the mission:
+            new_stops = []
             index = found_index
             limit = series.index_for_station(self.origin_id)
             while True:
                 logging.info('New stop = %s' % new_stop.station_id)
-                self.stops.append(new_stop)
+                new_stops.append(new_stop)
                 if limit is None:
                     break
                 if self.up:
@@ -658,8 +751,7 @@ class TAMission(TAModel):
                 new_stop = self.create_stop_from_point(point)
                 new_stop.destination = destination
 
-            # replace stops list:
-            self.sort_stops()
+            self.insert_stops(new_stops)
             if self.first_stop.station_id == found_point.station_id:
                 logging.info('Origin = %s', found_point.station_id)
                 self.origin_id = found_point.station_id
@@ -673,18 +765,24 @@ class TAMission(TAModel):
             # stop sent by TAStation does not have arrival information
             new_stop.arrival = new_stop.departure
             new_stop.delay_arr = new_stop.delay_dep
-            self.stops.append(new_stop)
-            self.sort_stops()
+            self.insert_stops([new_stop])
 
-    def sort_stops(self):
-        t = []
-        for stop in self.stops:
-            t.append((stop.departure, stop))
-        t.sort()
-        result = []
-        for theTime, stop in t:
-            result.append(stop)
-        self.stops = result
+    def insert_stops(self, new_stops):
+        """
+        Inserts new_stops in the stops of the mission, ordered by departure.
+        A stop with the same departure as existing stops is inserted after them.
+        """
+        new_stops = sorted(new_stops, key=lambda stop: stop.departure)
+        stops = self.stops
+        if not stops or new_stops[-1].departure < stops[0].departure:
+            self.stops = new_stops + stops
+            return
+        departures = [stop.departure for stop in stops]
+        for stop in new_stops:
+            index = bisect.bisect_right(departures, stop.departure)
+            departures.insert(index, stop.departure)
+            stops.insert(index, stop)
+        self.invalidate_timing()
 
     def update_destination(self, destination):
         series = self.series
@@ -767,25 +865,60 @@ class TAMission(TAModel):
     # ------ managing status ----------------------------------------
 
     def status_at_time(self, now=None):
+        """
+        Provides status and delay of the mission at now.
+        The result is cached together with the period in which it is valid and the stop attributes it depends on.
+        """
         if len(self.stops) == 0:
             return MissionStatuses.inactive, 0.0
 
         if now is None:
             now = now_cet()
-        if now > self.est_arrival_cet:
-            return MissionStatuses.arrived, self.last_stop.delay_dep
-
-        index = self.next_stop_index(now)
-        stop = self.stops[index]
-        if stop.status == StopStatuses.canceled:
-            return MissionStatuses.canceled, stop.delay_dep
-        if index == 0:
-            if stop.status == StopStatuses.announced:
-                return MissionStatuses.announced, stop.delay_dep
+        cache = self._status_cache
+        if cache is not None:
+            index, valid_from, valid_until, guard, status, delay = cache
+            if (valid_from is None or valid_from <= now) and (valid_until is None or now < valid_until):
+                if guard == self.status_guard(index):
+                    return status, delay
+                self._timing = None
+
+        est_arrival = self.est_arrival_cet
+        if now > est_arrival:
+            index = None
+            valid_from = est_arrival + timedelta(microseconds=1)
+            valid_until = None
+            status, delay = MissionStatuses.arrived, self.last_stop.delay_dep
+        else:
+            index = self.next_stop_index(now)
+            stop = self.stops[index]
+            valid_from = self.stops[index - 1].est_departure if index > 0 else None
+            valid_until = min(stop.est_departure, est_arrival + timedelta(microseconds=1))
+            if stop.status == StopStatuses.canceled:
+                status, delay = MissionStatuses.canceled, stop.delay_dep
+            elif index == 0:
+                if stop.status == StopStatuses.announced:
+                    status, delay = MissionStatuses.announced, stop.delay_dep
+                else:
+                    status, delay = MissionStatuses.inactive, 0.0
             else:
-                return MissionStatuses.inactive, 0.0
+                status, delay = MissionStatuses.running, stop.delay_dep
+
+        self._status_cache = (index, valid_from, valid_until, self.status_guard(index), status, delay)
+        return status, delay
 
-        return MissionStatuses.running, stop.delay_dep
+    def status_guard(self, index):
+        """
+        Provides the attributes of the stops that determine the status of the mission, while the next stop is at index
+        """
+        last_stop = self.stops[-1]
+        guard = (len(self.stops), id(last_stop), last_stop.arrival, last_stop.departure, last_stop.delay_dep)
+        if index is not None:
+            stop = self.stops[index]
+            guard += (id(stop), stop.status, stop.departure, stop.delay_dep)
+            if index > 0:
+                previous_stop = self.stops[index - 1]
+                guard += (id(previous_stop), previous_stop.departure, previous_stop.delay_dep)
+        return guard
 
     def activate_mission(self, now=None):
         if now is None:
@@ -799,6 +932,102 @@ class TAMission(TAModel):
         else:
             self.awake_stops()
             self.check_mission_announcements(now)
+        self.tally(now)
+
+    def tally(self, now):
+        """
+        Moves the count of the mission to its status at now, and to the bucket of its delay while it is running.
+        Running missions with delayed stops are kept on the delay board of their shard, and the mission
+        is registered for a new tally when its status will change without an update.
+        :return: True when the tallied entry changed
+        """
+        if self.nominalDate is None:
+            return False
+        entry = self.live_entry(now)
+        if self.tally_date == self.nominalDate and self.tally_entry == entry:
+            return False
+
+        key_prefix = live_statistics_prefix(self.nominalDate)
+        shard = self.number % LIVE_STATS_SHARDS
+        counted = []
+
+        def update(previous):
+            counted[:] = [previous]
+            return previous if previous == entry else entry
+
+        if not cas_update('%sentry_%s' % (key_prefix, self.id), update, namespace=LIVE_STATS_NAMESPACE):
+            logging.warning('Could not tally mission %s' % self.id)
+            return False
+        previous = counted[0]
+        if previous is None and self.tally_date == self.nominalDate:
+            previous = self.tally_entry
+        if previous != entry:
+            offsets = dict((key, -1) for key in counter_keys(previous, shard))
+            for key in counter_keys(entry, shard):
+                offsets[key] = offsets.get(key, 0) + 1
+            offsets = dict((key, offset) for key, offset in offsets.iteritems() if offset)
+            if offsets:
+                memcache.offset_multi(offsets, key_prefix=key_prefix, namespace=LIVE_STATS_NAMESPACE,
+                                      initial_value=0)
+            delays = entry[2]
+            if (previous and previous[2]) != delays:
+
+                def update_board(board):
+                    if (board or {}).get(self.id) == delays:
+                        return board
+                    board = dict(board or {})
+                    if delays:
+                        board[self.id] = delays
+                    else:
+                        del board[self.id]
+                    return board
+
+                if not cas_update('%sdelays_%d' % (key_prefix, shard), update_board, namespace=LIVE_STATS_NAMESPACE):
+                    logging.warning('Could not put the delays of mission %s on the board' % self.id)
+
+        due = self.next_status_change(entry[0])
+        if due is not None and due != self.tally_due:
+            key = '%sdue_%d' % (key_prefix, sweep_window(self.nominalDate, due))
+            if not cas_update(key, lambda mission_ids: (mission_ids or []) + [self.id],
+                              namespace=LIVE_STATS_NAMESPACE):
+                logging.warning('Could not register mission %s for a new tally' % self.id)
+                due = None
+        self.tally_date = self.nominalDate
+        self.tally_entry = entry
+        self.tally_due = due
+        return True
+
+    def live_entry(self, now):
+        """
+        Provides the entry of the mission at now for the live statistics: (status, delay_bucket, delays),
+        the delay bucket and the delays of the stops are None unless the mission is running
+        """
+        status, delay = self.status_at_time(now)
+        if status != MissionStatuses.running:
+            return status, None, None
+        return status, '%.0f' % max(0, min(delay, DELAY_BUCKET_LIMIT)), self.stop_delays()
+
+    def stop_delays(self):
+        """
+        Provides the delays of the delayed stops as a dictionary station_id > (delay_arr, delay_dep), or None
+        """
+        delays = {}
+        for stop in self.stops:
+            if stop.delay_arr or stop.delay_dep:
+                delays[stop.station_id] = (stop.delay_arr, stop.delay_dep)
+        return delays or None
+
+    def next_status_change(self, status):
+        """
+        Provides the time at which the status of the mission changes when no updates are received
+        """
+        if not self.stops:
+            return None
+        if status in (MissionStatuses.inactive, MissionStatuses.announced):
+            return self.stops[0].est_departure
+        if status in (MissionStatuses.running, MissionStatuses.canceled):
+            return self.est_arrival_cet
+        return None
 
     def check_mission_announcements(self, issue_time):
         tasks = []
@@ -837,7 +1066,7 @@ class TAMission(TAModel):
 
     # Archiving
     def remove(self):
-        memcache.delete(self.id, namespace='TAMission')
+        self.cache_delete()
 
 
 # ====== Helper functions ======================================================================
@@ -882,3 +1111,163 @@ def optimize_od_ids(dictionary):
             if array[index] != max_value:
                 optimized_dict[str(index)] = array[index]
         return optimized_dict
+
+
+def live_statistics_prefix(date):
+    return '%s:' % date.isoformat()
+
+
+def counter_keys(entry, shard):
+    """
+    Provides the keys of the counters that count a live statistics entry, none for entry None
+    """
+    if entry is None:
+        return []
+    status, delay_bucket, delays = entry
+    keys = ['status_%d_%d' % (status, shard)]
+    if delay_bucket is not None:
+        keys.append('delay_%s_%d' % (delay_bucket, shard))
+    return keys
+
+
+def all_counter_keys(shard):
+    """
+    Provides the keys of all status and delay counters of a shard
+    """
+    return ['status_%d_%d' % (status, shard) for status in range(len(MissionStatuses.s))] + \
+           ['delay_%d_%d' % (minutes, shard) for minutes in range(DELAY_BUCKET_LIMIT + 1)]
+
+
+def sweep_window(date, moment):
+    midnight = mark_cet(datetime.combine(date, time(0)))
+    return int((moment - midnight).total_seconds() // 60) // SWEEP_MINUTES
+
+
+def passed_windows(now):
+    """
+    Provides the date of the live statistics at now and the sweep windows of that date that have passed
+    but were not swept yet
+    """
+    date = (now - timedelta(hours=3)).date()
+    last_window = sweep_window(date, now) - 1
+    swept_window = memcache.get(live_statistics_prefix(date) + 'swept', namespace=LIVE_STATS_NAMESPACE)
+    if swept_window is None:
+        swept_window = -1
+    return date, range(swept_window + 1, last_window + 1)
+
+
+def sweep_tallies(now):
+    """
+    Tallies the missions again that were due for a status change in windows that have passed
+    """
+    date, windows = passed_windows(now)
+    if not windows:
+        return
+    key_prefix = live_statistics_prefix(date)
+    due_lists = memcache.get_multi(['due_%d' % window for window in windows], key_prefix=key_prefix,
+                                   namespace=LIVE_STATS_NAMESPACE)
+    mission_ids = set()
+    for due_list in due_lists.itervalues():
+        mission_ids.update(due_list)
+    if mission_ids:
+        keys = [db.Key.from_path('TAMission', mission_id) for mission_id in mission_ids]
+        tallied = {}
+        for mission in TAMission.objects_for_keys(keys).itervalues():
+            if mission.tally(now):
+                tallied[mission.id] = mission
+        TAMission.cache_set_multi(tallied)
+    memcache.set(key_prefix + 'swept', windows[-1], namespace=LIVE_STATS_NAMESPACE)
+
+
+def request_sweep(now):
+    """
+    Schedules the sweep_tallies task of TAManager when a sweep window has passed, one task per window
+    """
+    date, windows = passed_windows(now)
+    if not windows:
+        return
+    task = taskqueue.Task(name='sweep_tallies_%s_%d' % (date.strftime('%Y%m%d'), windows[-1]),
+                          url='/TAManager/sweep_tallies', method='GET')
+    try:
+        task.add()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def recount_shards(date, shards, now):
+    """
+    Counts the missions of date in shards again from the datastore, after their counters were lost from memcache
+    """
+    logging.warning('Recount live statistics of %s for shards %s' % (date, shards))
+    values = {}
+    for shard in shards:
+        values.update((key, 0) for key in all_counter_keys(shard))
+        values['delays_%d' % shard] = {}
+        values['counted_%d' % shard] = True
+    for keys in TAMission.iter_batches(keys_only=True):
+        keys = [key for key in keys if int(key.name().split('.')[1]) % LIVE_STATS_SHARDS in shards]
+        for mission in TAMission.objects_for_keys(keys).itervalues():
+            if mission.nominalDate != date:
+                continue
+            shard = mission.number % LIVE_STATS_SHARDS
+            entry = mission.live_entry(now)
+            values['entry_%s' % mission.id] = entry
+            for key in counter_keys(entry, shard):
+                values[key] += 1
+            if entry[2]:
+                values['delays_%d' % shard][mission.id] = entry[2]
+    memcache.set_multi(values, key_prefix=live_statistics_prefix(date), namespace=LIVE_STATS_NAMESPACE)
+
+
+def read_shards(date, shard_keys, now):
+    """
+    Reads the live statistics values of all shards of date, shards that were lost from memcache are counted again first
+    :param shard_keys: function that provides the keys to read for a shard
+    :return: a dictionary key > value and the list of shard numbers that were read
+    """
+    key_prefix = live_statistics_prefix(date)
+    shards = range(LIVE_STATS_SHARDS)
+    all_keys = ['counted_%d' % shard for shard in shards]
+    for shard in shards:
+        all_keys.extend(shard_keys(shard))
+    values = memcache.get_multi(all_keys, key_prefix=key_prefix, namespace=LIVE_STATS_NAMESPACE)
+    missing = [shard for shard in shards if 'counted_%d' % shard not in values]
+    if missing:
+        recount_shards(date, missing, now)
+        values = memcache.get_multi(all_keys, key_prefix=key_prefix, namespace=LIVE_STATS_NAMESPACE)
+    return values, shards
+
+
+def live_statistics(now):
+    """
+    Provides the histograms of mission statuses and delays of running missions, read from the counters.
+    A task is requested to tally the missions again that were due for a status change in windows that have passed.
+    """
+    request_sweep(now)
+    date = (now - timedelta(hours=3)).date()
+    values, shards = read_shards(date, all_counter_keys, now)
+    status_hist = {}
+    delay_hist = {}
+    for status, name in enumerate(MissionStatuses.s):
+        count = sum(values.get('status_%d_%d' % (status, shard), 0) for shard in shards)
+        if count:
+            status_hist[name] = count
+    for minutes in range(DELAY_BUCKET_LIMIT + 1):
+        count = sum(values.get('delay_%d_%d' % (minutes, shard), 0) for shard in shards)
+        if count:
+            delay_hist[str(minutes)] = count
+    return {'status': status_hist, 'delay': delay_hist}
+
+
+def live_delays(date, now=None):
+    """
+    Provides the delays of the running missions of date, from the delay boards:
+    a dictionary mission_id > {station_id: (delay_arr, delay_dep)}, with delays in minutes
+    """
+    if now is None:
+        now = now_cet()
+    values, shards = read_shards(date, lambda shard: ['delays_%d' % shard], now)
+    result = {}
+    for shard in shards:
+        result.update(values.get('delays_%d' % shard) or {})
+    return result
@@ -0,0 +1,293 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TAPlanner.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+TAPlanner plans journeys with transfers through the whole network, with the Connection Scan Algorithm.
+
+The connections of the missions that run on a weekday, from each stop to the next, are derived from the
+TimetableSnapshot and kept in parallel arrays ordered by departure. A query scans these arrays once,
+from its start time until the destination is reached, so its cost depends on the number of connections
+in the searched time span and not on the number of series that serve the origin.
+"""
+
+import bisect, logging
+
+from datetime               import timedelta
+
+from ffe                    import config
+from TABasics               import kind_generation
+from TAMission              import live_delays
+from TASnapshot             import load_snapshot, NO_STRING, NO_MINUTES
+from TASeries               import request_snapshot
+from TSStation              import TSStation
+
+# stations without a transfer time of their own need DEFAULT_TRANSFER_MINUTES to change trains,
+# a journey may take at most MAX_JOURNEY_MINUTES
+DEFAULT_TRANSFER_MINUTES = 3
+MAX_JOURNEY_MINUTES = 6 * 60
+MAX_JOURNEY_OPTIONS = 4
+UNREACHED = float('inf')
+
+
+class NetworkPlanner(object):
+    """
+    NetworkPlanner keeps the connections of all missions that run on one weekday.
+    Stations and missions are numbered, connection i departs from station origins[i] at departures[i]
+    and arrives at station destinations[i] at arrivals[i], with mission trips[i], times in minutes after midnight.
+    """
+
+    def __init__(self, snapshot, weekday, transfer_minutes=None):
+        self.weekday = weekday
+        self.station_ids = []
+        self.station_indexes = {}
+        self.mission_ids = []
+        connections = self.read_connections(snapshot, weekday)
+        connections.sort()
+        if connections:
+            self.departures, self.arrivals, self.origins, self.destinations, self.trips = \
+                [list(column) for column in zip(*connections)]
+        else:
+            self.departures, self.arrivals, self.origins, self.destinations, self.trips = [], [], [], [], []
+
+        self.trip_indexes = dict((mission_id, trip) for trip, mission_id in enumerate(self.mission_ids))
+        self.trip_connections = [[] for mission_id in self.mission_ids]
+        for index, trip in enumerate(self.trips):
+            self.trip_connections[trip].append(index)
+
+        transfer_minutes = transfer_minutes or {}
+        self.transfer_minutes = [transfer_minutes.get(station_id, DEFAULT_TRANSFER_MINUTES)
+                                 for station_id in self.station_ids]
+        logging.info('Planner for weekday %d with %d connections of %d missions between %d stations' %
+                     (weekday, len(self.departures), len(self.mission_ids), len(self.station_ids)))
+
+    def station_index(self, station_id):
+        index = self.station_indexes.get(station_id)
+        if index is None:
+            index = len(self.station_ids)
+            self.station_ids.append(station_id)
+            self.station_indexes[station_id] = index
+        return index
+
+    def read_connections(self, snapshot, weekday):
+        """
+        Provides (departure, arrival, origin, destination, trip) tuples for the missions that run on weekday,
+        a mission stops at the points of its series from its origin to its destination, like TAMission.awake_stops
+        """
+        point_stations = snapshot.column('point_station', snapshot.nr_of_points)
+        times = dict((column, snapshot.column(column, snapshot.nr_of_points))
+                     for column in ('point_up_arrival', 'point_up_departure',
+                                    'point_down_arrival', 'point_down_departure'))
+        first_points = snapshot.column('series_first_point', snapshot.nr_of_series)
+        nr_of_points = snapshot.column('series_nr_of_points', snapshot.nr_of_series)
+        mission_ids = snapshot.column('mission_id', snapshot.nr_of_missions)
+        mission_series = snapshot.column('mission_series', snapshot.nr_of_missions)
+        offsets = snapshot.column('mission_offset', snapshot.nr_of_missions)
+        origins = snapshot.column('mission_origins', 7 * snapshot.nr_of_missions)
+        destinations = snapshot.column('mission_destinations', 7 * snapshot.nr_of_missions)
+
+        connections = []
+        for mission in xrange(snapshot.nr_of_missions):
+            origin = origins[7 * mission + weekday]
+            destination = destinations[7 * mission + weekday]
+            offset = offsets[mission]
+            if origin == NO_STRING or destination == NO_STRING or offset == NO_MINUTES:
+                continue
+            first = first_points[mission_series[mission]]
+            stations = point_stations[first:first + nr_of_points[mission_series[mission]]]
+            if origin not in stations or destination not in stations:
+                continue
+            from_index = first + stations.index(origin)
+            to_index = first + stations.index(destination)
+            if from_index <= to_index:
+                indexes = range(from_index, to_index + 1)
+            else:
+                indexes = range(from_index, to_index - 1, -1)
+
+            mission_id = snapshot.string(mission_ids[mission])
+            if int(mission_id.split('.')[1]) % 2:
+                arrivals, departures = times['point_up_arrival'], times['point_up_departure']
+            else:
+                arrivals, departures = times['point_down_arrival'], times['point_down_departure']
+            trip = len(self.mission_ids)
+            self.mission_ids.append(mission_id)
+            previous = None
+            for index in indexes:
+                if arrivals[index] == NO_MINUTES or departures[index] == NO_MINUTES:
+                    continue
+                station = self.station_index(snapshot.string(point_stations[index]))
+                if previous is not None:
+                    connections.append((offset + departures[previous], offset + arrivals[index],
+                                        previous_station, station, trip))
+                previous, previous_station = index, station
+        return connections
+
+    def delayed_connections(self, delays):
+        """
+        Provides (departure, arrival, connection) tuples, ordered by departure, for the missions in delays,
+        with the delays applied.
+        :param delays: dictionary mission_id > {station_id: (delay_arr, delay_dep)}, as from TAMission.live_delays
+        """
+        result = []
+        for mission_id, stop_delays in delays.iteritems():
+            trip = self.trip_indexes.get(mission_id)
+            if trip is None:
+                continue
+            for index in self.trip_connections[trip]:
+                delay_dep = stop_delays.get(self.station_ids[self.origins[index]], (0, 0))[1]
+                delay_arr = stop_delays.get(self.station_ids[self.destinations[index]], (0, 0))[0]
+                result.append((self.departures[index] + delay_dep, self.arrivals[index] + delay_arr, index))
+        result.sort()
+        return result
+
+    def journey(self, origin_id, destination_id, start, delays=None):
+        """
+        Provides the journey that arrives first at the destination, departing at or after start (in minutes),
+        as a list of (mission_id, from_id, departure, to_id, arrival) legs, or None when there is none
+        within MAX_JOURNEY_MINUTES.
+        """
+        origin = self.station_indexes.get(origin_id)
+        target = self.station_indexes.get(destination_id)
+        if origin is None or target is None or origin == target:
+            return None
+
+        departures, arrivals, origins, destinations, trips = \
+            self.departures, self.arrivals, self.origins, self.destinations, self.trips
+        transfer_minutes = self.transfer_minutes
+        arrival = [UNREACHED] * len(self.station_ids)
+        ready = [UNREACHED] * len(self.station_ids)
+        reached_by = [None] * len(self.station_ids)
+        boarded = {}
+        arrival[origin] = ready[origin] = start
+        best = start + MAX_JOURNEY_MINUTES
+
+        # delayed missions are scanned from their own list, merged into the scheduled connections by departure
+        delayed = self.delayed_connections(delays) if delays else []
+        delayed_trips = set(trips[connection[2]] for connection in delayed)
+        nr_delayed = len(delayed)
+        next_delayed = 0
+        next_scheduled = bisect.bisect_left(departures, start)
+        nr_scheduled = len(departures)
+
+        while True:
+            if next_delayed < nr_delayed and (next_scheduled >= nr_scheduled or
+                                              delayed[next_delayed][0] <= departures[next_scheduled]):
+                departure, arrival_time, index = delayed[next_delayed]
+                next_delayed += 1
+                if departure < start:
+                    continue
+            elif next_scheduled < nr_scheduled:
+                index = next_scheduled
+                next_scheduled += 1
+                if trips[index] in delayed_trips:
+                    continue
+                departure = departures[index]
+                arrival_time = arrivals[index]
+            else:
+                break
+            if departure >= best:
+                break
+
+            trip = trips[index]
+            entry = boarded.get(trip)
+            if entry is None:
+                if ready[origins[index]] > departure:
+                    continue
+                entry = boarded[trip] = (index, departure)
+            station = destinations[index]
+            if arrival_time < arrival[station]:
+                arrival[station] = arrival_time
+                ready[station] = arrival_time + transfer_minutes[station]
+                reached_by[station] = (entry, index, arrival_time)
+                if station == target:
+                    best = arrival_time
+
+        if reached_by[target] is None:
+            return None
+        legs = []
+        station = target
+        while station != origin:
+            (entry_index, departure), exit_index, arrival_time = reached_by[station]
+            legs.append((self.mission_ids[trips[entry_index]], self.station_ids[origins[entry_index]], departure,
+                         self.station_ids[station], arrival_time))
+            station = origins[entry_index]
+        legs.reverse()
+        return legs
+
+
+# ====== Network planners ==========================================================================
+
+_planners = {}
+
+
+def service_weekday(date):
+    """
+    Provides the weekday of the timetable that runs on date, official holidays run the timetable of sunday
+    """
+    if date in config.OFFICIAL_HOLIDAYS:
+        return 6
+    return date.weekday()
+
+
+def network_planner(weekday):
+    """
+    Provides the NetworkPlanner for weekday, built from the current snapshot and transfer times
+    and kept in this instance until either of them changes, or None when no snapshot has been compiled yet
+    """
+    snapshot = load_snapshot()
+    if snapshot is None:
+        logging.warning('No timetable snapshot available, request a new one')
+        request_snapshot()
+        return None
+    generations = (kind_generation('TASnapshot'), kind_generation('TSStation'))
+    planner = _planners.get(weekday)
+    if planner is None or planner[0] != generations:
+        planner = (generations, NetworkPlanner(snapshot, weekday, TSStation.transfer_minutes_index()))
+        _planners[weekday] = planner
+    return planner[1]
+
+
+def plan_journeys(origin_id, destination_id, start_time, time_span, live=True):
+    """
+    Provides up to MAX_JOURNEY_OPTIONS journeys that depart within time_span after start_time,
+    each as a list of legs (mission_id, from_id, departure, to_id, arrival), with datetimes,
+    or None when no timetable snapshot is available.
+    :param live: apply the delays of running missions
+    """
+    date = start_time.date()
+    planner = network_planner(service_weekday(date))
+    if planner is None:
+        return None
+    delays = live_delays(date) if live else None
+    midnight = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = (start_time - midnight).seconds // 60
+    end = start + time_span.seconds // 60
+
+    journeys = []
+    while start <= end and len(journeys) < MAX_JOURNEY_OPTIONS:
+        legs = planner.journey(origin_id, destination_id, start, delays)
+        if legs is None or legs[0][2] > end:
+            break
+        journeys.append([(mission_id, from_id, midnight + timedelta(minutes=departure),
+                          to_id, midnight + timedelta(minutes=arrival))
+                         for mission_id, from_id, departure, to_id, arrival in legs])
+        start = int(legs[0][2]) + 1
+    return journeys
@@ -0,0 +1,194 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TAPositions.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+TAPositions computes the positions of all running missions at one instant.
+
+A PositionEngine is built on the NetworkPlanner of a weekday and the NetworkGraph of the atlas. Every pair of
+consecutive stops gets a segment: the km and coordinates of the stations and junctions on the shortest path by rail
+between them, computed once per pair. An array parallel to the connections keeps the segment of each connection.
+The missions that are running at an instant are found in one pass over the connections that departed shortly
+before it, their positions are interpolated by km along the segment, for the part of the running time that has
+passed. Stops without a path in the graph are joined by a straight line.
+"""
+
+import bisect, logging
+
+from TAMission              import live_delays
+from TAPlanner              import network_planner, service_weekday
+from TSStationPosition      import TSStationPosition
+from TSNetwork              import network_graph
+
+COORDINATE_DIGITS = 5
+
+
+class PositionEngine(object):
+    """
+    PositionEngine interpolates the positions of running missions along the connections of a NetworkPlanner
+    """
+
+    def __init__(self, planner, coordinates, network=None):
+        """
+        :param coordinates: dictionary station_id > (lat, lon)
+        :param network: NetworkGraph to follow the railway between the stops, or None for straight lines
+        """
+        self.planner = planner
+        self.coordinates = coordinates
+        self.network = network
+        self.segments = []
+        self.segment_indexes = []
+        pair_segments = {}
+        for origin, destination in zip(planner.origins, planner.destinations):
+            segment_index = pair_segments.get((origin, destination))
+            if segment_index is None:
+                segment = self.segment(planner.station_ids[origin], planner.station_ids[destination])
+                segment_index = len(self.segments) if segment is not None else -1
+                if segment is not None:
+                    self.segments.append(segment)
+                pair_segments[(origin, destination)] = segment_index
+            self.segment_indexes.append(segment_index)
+
+        # a connection is the current one of its mission until the next connection departs,
+        # so the current connections of an instant departed at most window minutes before it
+        self.window = 0
+        self.last_connections = set()
+        for connections in planner.trip_connections:
+            if not connections:
+                continue
+            for index, next_index in zip(connections[:-1], connections[1:]):
+                self.window = max(self.window, planner.departures[next_index] - planner.departures[index])
+            self.last_connections.add(connections[-1])
+            self.window = max(self.window, planner.arrivals[connections[-1]] - planner.departures[connections[-1]])
+
+    def segment(self, origin_id, destination_id):
+        """
+        Provides the segment between two stations as parallel lists of km, lat and lon,
+        along the railway when the network has a path, or None when a station has no coordinates
+        """
+        if self.network is not None:
+            geometry = self.network.path_geometry(origin_id, destination_id)
+            if geometry is not None:
+                return geometry
+        start = self.coordinates.get(origin_id)
+        end = self.coordinates.get(destination_id)
+        if start is None or end is None:
+            return None
+        return [0.0, 1.0], [start[0], end[0]], [start[1], end[1]]
+
+    def current_connections(self, minute, delays=None):
+        """
+        Provides (connection, departure, arrival) tuples for the current connection of each mission at minute,
+        the last connection of a mission is current until it arrives
+        """
+        planner = self.planner
+        departures, arrivals, trips = planner.departures, planner.arrivals, planner.trips
+        current = {}
+        for index in xrange(bisect.bisect_left(departures, minute - self.window),
+                            bisect.bisect_right(departures, minute)):
+            current[trips[index]] = index
+        result = [(index, departures[index], arrivals[index]) for index in current.itervalues()]
+
+        if delays:
+            # a delayed mission is placed by its delayed connections only, even when none of them departed yet
+            delayed_trips = set(planner.trip_indexes[mission_id] for mission_id in delays
+                                if mission_id in planner.trip_indexes)
+            delayed_current = {}
+            for departure, arrival, index in planner.delayed_connections(delays):
+                if departure <= minute:
+                    delayed_current[trips[index]] = (index, departure, arrival)
+            result = [item for item in result if trips[item[0]] not in delayed_trips]
+            result.extend(delayed_current.itervalues())
+
+        last_connections = self.last_connections
+        return [(index, departure, arrival) for index, departure, arrival in result
+                if arrival > minute or index not in last_connections]
+
+    def positions(self, minute, delays=None):
+        """
+        Provides the ids, latitudes and longitudes of the running missions at minute, as three parallel lists
+        """
+        current = [item for item in self.current_connections(minute, delays)
+                   if self.segment_indexes[item[0]] >= 0]
+        indexes = [index for index, departure, arrival in current]
+        fractions = [min(1.0, (minute - departure) / float(arrival - departure)) if arrival > departure else 1.0
+                     for index, departure, arrival in current]
+        points = [interpolate(self.segments[self.segment_indexes[index]], fraction)
+                  for index, fraction in zip(indexes, fractions)]
+        latitudes = [round(lat, COORDINATE_DIGITS) for lat, lon in points]
+        longitudes = [round(lon, COORDINATE_DIGITS) for lat, lon in points]
+        mission_ids = [self.planner.mission_ids[self.planner.trips[index]] for index in indexes]
+        return mission_ids, latitudes, longitudes
+
+
+def interpolate(segment, fraction):
+    """
+    Provides the (lat, lon) at fraction of the length of a segment, interpolated by km between its points
+    """
+    kms, latitudes, longitudes = segment
+    km = fraction * kms[-1]
+    index = max(0, min(bisect.bisect_right(kms, km) - 1, len(kms) - 2))
+    if index + 1 >= len(kms) or kms[index + 1] <= kms[index]:
+        return latitudes[index], longitudes[index]
+    part = (km - kms[index]) / (kms[index + 1] - kms[index])
+    return (latitudes[index] + part * (latitudes[index + 1] - latitudes[index]),
+            longitudes[index] + part * (longitudes[index + 1] - longitudes[index]))
+
+
+# ====== Position engines ==========================================================================
+
+_engines = {}
+
+
+def position_engine(weekday):
+    """
+    Provides the PositionEngine for weekday, kept in this instance as long as its planner, coordinates and network
+    are current, or None when no timetable snapshot is available
+    """
+    planner = network_planner(weekday)
+    if planner is None:
+        return None
+    coordinates = TSStationPosition.station_coordinates()
+    network = network_graph()
+    engine = _engines.get(weekday)
+    if engine is None or engine.planner is not planner or engine.coordinates is not coordinates \
+            or engine.network is not network:
+        engine = PositionEngine(planner, coordinates, network)
+        _engines[weekday] = engine
+        logging.info('Position engine for weekday %d covers %d minutes of connections' % (weekday, engine.window))
+    return engine
+
+
+def mission_positions(now, live=True):
+    """
+    Provides the positions of all running missions at now, as a dictionary with parallel lists of ids, lat and lon,
+    or None when no timetable snapshot is available
+    :param live: apply the delays of running missions
+    """
+    date = now.date()
+    engine = position_engine(service_weekday(date))
+    if engine is None:
+        return None
+    delays = live_delays(date) if live else None
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    minute = (now - midnight).seconds / 60.0
+    mission_ids, latitudes, longitudes = engine.positions(minute, delays)
+    return {'now': now.strftime('%Y-%m-%dT%H:%M:%S'), 'ids': mission_ids, 'lat': latitudes, 'lon': longitudes}
@@ -30,6 +30,9 @@ from ffe.ffe_time       import now_cet, utc_from_cet, cet_from_string
 from TASeries           import TASeries
 from TAMission          import TAMission
 from TAScheduledPoint   import TAScheduledPoint, Direction
+from TAPlanner          import plan_journeys
+from TAPositions        import mission_positions
+from TSSpatialIndex     import station_grid
 
 # WSGI Handler classes
 
@@ -56,6 +59,13 @@ class TAPublicHandler(webapp2.RequestHandler):
         self.reject()
         return False
     
+    def validateFloat(self, string):
+        if len(string) <= 12:
+            if re.match(r'-?[0-9]{1,3}(\.[0-9]+)?$', string):
+                return True
+        self.reject()
+        return False
+
     def reject(self):
         self.error(404)
         self.response.out.write('''
@@ -68,6 +78,18 @@ class TAPublicHandler(webapp2.RequestHandler):
             </html>
             ''')
 
+    def unavailable(self):
+        self.error(503)
+        self.response.out.write('''
+            <html>
+            <head><title>503 Service Unavailable</title></head>
+            <body>
+            <h1>503 Service Unavailable</h1>
+            The timetable is being compiled, please try again later.<br /><br />
+            </body>
+            </html>
+            ''')
+
 
 class TrajectoryHandler(TAPublicHandler):
         
@@ -114,6 +136,98 @@ class TrajectoryHandler(TAPublicHandler):
         return {'origin':origin_id, 'destination':destination_id, 'options':array}
 
 
+class JourneyHandler(TAPublicHandler):
+
+    def get(self):
+        increase_counter('req_journey')
+        origin_id = self.request.get('from')
+        if not self.validateID(origin_id): return
+        destination_id = self.request.get('to')
+        if not self.validateID(destination_id): return
+
+        time_string = self.request.get('start', None)
+        if time_string is None:
+            start_time = now_cet()
+        else:
+            if not self.validateDatetime(time_string): return
+            start_time = cet_from_string(time_string)
+
+        span_string = self.request.get('span', None)
+        if span_string is None:
+            time_span = timedelta(hours=1)
+        else:
+            if not self.validateDigit(span_string): return
+            time_span = timedelta(hours=int(span_string))
+
+        live = self.request.get('live', '1') != '0'
+        journeys = plan_journeys(origin_id, destination_id, start_time, time_span, live)
+        if journeys is None:
+            self.unavailable()
+            return
+        output_string = json.dumps(self.journeys_dict(origin_id, destination_id, journeys))
+        self.response.out.write(output_string)
+
+    @staticmethod
+    def journeys_dict(origin_id, destination_id, journeys):
+        array = []
+        for legs in journeys:
+            legs_array = []
+            for mission_id, from_id, departure, to_id, arrival in legs:
+                legs_array.append({'id': mission_id, 'from': from_id, 'to': to_id,
+                                   'v': departure.strftime('%Y-%m-%dT%H:%M:%S'),
+                                   'a': arrival.strftime('%Y-%m-%dT%H:%M:%S')})
+            array.append({'legs': legs_array})
+        return {'origin': origin_id, 'destination': destination_id, 'journeys': array}
+
+
+class PositionsHandler(TAPublicHandler):
+
+    def get(self):
+        increase_counter('req_positions')
+        now_string = self.request.get('now', None)
+        if now_string is None:
+            now = now_cet()
+        else:
+            if not self.validateDatetime(now_string): return
+            now = cet_from_string(now_string)
+        live = self.request.get('live', '1') != '0'
+        positions = mission_positions(now, live)
+        if positions is None:
+            self.unavailable()
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(positions, separators=(',', ':')))
+
+
+class StationsHandler(TAPublicHandler):
+
+    def get(self):
+        increase_counter('req_stations')
+        box_string = self.request.get('box', None)
+        if box_string is not None:
+            strings = box_string.split(',')
+            if len(strings) != 4:
+                self.reject()
+                return
+            for string in strings:
+                if not self.validateFloat(string): return
+            south, west, north, east = [float(string) for string in strings]
+            output = {'stations': station_grid().within(south, west, north, east)}
+        else:
+            lat_string = self.request.get('lat')
+            if not self.validateFloat(lat_string): return
+            lon_string = self.request.get('lon')
+            if not self.validateFloat(lon_string): return
+            k_string = self.request.get('k', '5')
+            if not self.validateDigit(k_string): return
+            if int(k_string) < 1:
+                self.reject()
+                return
+            nearest = station_grid().nearest(float(lat_string), float(lon_string), int(k_string))
+            output = {'stations': [{'id': station_id, 'km': round(distance, 3)} for distance, station_id in nearest]}
+        self.response.out.write(json.dumps(output))
+
+
 class MissionHandler(TAPublicHandler):
 
     def get(self):
@@ -195,14 +309,17 @@ class StatisticsHandler(TAPublicHandler):
         if now_string:
             now = cet_from_string(now_string)
         else:
-            now = now_cet()
+            now = None
         self.response.out.write(json.dumps(TASeries.statistics(now)))
 
 
 # WSGI Application
 
 URL_SCHEMA = [('/trajectory.*', TrajectoryHandler),
+              ('/journey.*', JourneyHandler),
               ('/mission.*', MissionHandler),
+              ('/positions', PositionsHandler),
+              ('/stations', StationsHandler),
               ('/departures.*', DeparturesHandler),
               ('/statistics', StatisticsHandler)]
 app = webapp2.WSGIApplication(URL_SCHEMA)
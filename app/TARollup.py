@@ -0,0 +1,149 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TARollup.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+import math
+
+from TABasics               import TAModel, JSONProperty
+from TAScheduledPoint       import Direction
+from TAChart                import ChartTables
+
+DAYS_KEPT = 28
+WEEKS_KEPT = 26
+ROLLING_WEEKS = 12
+
+# a departure is punctual when its delay, in whole minutes, is below PUNCTUALITY_LIMIT
+PUNCTUALITY_LIMIT = 3
+
+
+# ====== Rollup Model ==========================================================================
+
+class TARollup(TAModel):
+    """
+    TARollup keeps delay and punctuality summaries of a series per point and direction,
+    for the last days, the last weeks and over a rolling period of ROLLING_WEEKS weeks.
+    A summary is a list [count, total delay, total squared delay, punctual count], so summaries can be added.
+    """
+
+    # Stored attributes:
+    _summaries = JSONProperty()
+
+    @property
+    def summaries(self):
+        if not self._summaries:
+            self._summaries = {'days': [], 'weeks': [], 'rolling': {}}
+        return self._summaries
+
+    # Updating summaries
+
+    def add_day(self, label, contributions):
+        """
+        Adds the summaries of one day
+        :param label: the date in iso-format
+        :param contributions: a dictionary station_id > tally, as provided by TAChart.ingest_series
+        """
+        points = {}
+        for station_id, tally in contributions.iteritems():
+            points[station_id] = [summary_from_items(tally[2 * ChartTables.delay + direction].iteritems())
+                                  for direction in (Direction.down, Direction.up)]
+        self.insert_period('days', label, points, DAYS_KEPT)
+
+    def add_week(self, chart):
+        """
+        Adds the summaries of a closed chart and updates the rolling summaries
+        """
+        label = chart.id.rsplit('_', 1)[1]
+        chart.load_shards()
+        points = {}
+        for shard in chart._shards.itervalues():
+            for station_id, point_chart in shard.data.points.iteritems():
+                points[station_id] = [summary_from_items(point_chart.histogram(ChartTables.delay, direction).items())
+                                      for direction in (Direction.down, Direction.up)]
+        self.insert_period('weeks', label, points, WEEKS_KEPT)
+
+        rolling = {}
+        for label, points in self.summaries['weeks'][-ROLLING_WEEKS:]:
+            for station_id, summaries in points.iteritems():
+                totals = rolling.setdefault(station_id, [None, None])
+                for direction in (Direction.down, Direction.up):
+                    totals[direction] = add_summaries(totals[direction], summaries[direction])
+        self.summaries['rolling'] = rolling
+
+    def insert_period(self, period, label, points, limit):
+        entries = [entry for entry in self.summaries[period] if entry[0] != label]
+        entries.append([label, points])
+        entries.sort()
+        self.summaries[period] = entries[-limit:]
+
+    # Querying summaries
+
+    def trend(self, station_id, direction, period='weeks'):
+        """
+        Provides a list of (label, statistics) tuples, in chronological order
+        :param period: 'days' or 'weeks'
+        """
+        result = []
+        for label, points in self.summaries[period]:
+            summaries = points.get(station_id)
+            if summaries:
+                result.append((label, statistics(summaries[direction])))
+        return result
+
+    def rolling_statistics(self, station_id, direction):
+        summaries = self.summaries['rolling'].get(station_id)
+        if summaries:
+            return statistics(summaries[direction])
+        else:
+            return statistics(None)
+
+
+# ====== Helper functions =========================================================================
+
+def summary_from_items(items):
+    count = total = squares = punctual = 0
+    for delay, occurrences in items:
+        count += occurrences
+        total += delay * occurrences
+        squares += delay * delay * occurrences
+        if delay < PUNCTUALITY_LIMIT:
+            punctual += occurrences
+    if count:
+        return [count, total, squares, punctual]
+
+
+def add_summaries(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return [a + b for a, b in zip(first, second)]
+
+
+def statistics(summary):
+    """
+    Provides a dictionary with count, mean, deviation and punctuality (a fraction) for a summary
+    """
+    if not summary:
+        return {'count': 0, 'mean': None, 'deviation': None, 'punctuality': None}
+    count, total, squares, punctual = summary
+    mean = float(total) / count
+    variance = max(0.0, float(squares) / count - mean * mean)
+    return {'count': count, 'mean': mean, 'deviation': math.sqrt(variance), 'punctuality': float(punctual) / count}
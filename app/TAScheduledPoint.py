@@ -20,18 +20,25 @@
 #  Created by Berend Schotanus on 14-Nov-12.
 #
 
-import logging, json, re
+import logging, json, re, time
 import xml.sax
 from google.appengine.ext import db
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
 
 from ffe.markup     import XMLElement, XMLImporter
 from ffe.ffe_time   import string_from_minutes, minutes_from_string
-from TABasics       import TAModel
+from TABasics       import TAModel, kind_generation, bump_generation
 
 class Direction:
     down, up = range(2)
 
+# the station index is cached under the generation of this kind, invalidating the index bumps it
+STATION_INDEX_KIND = 'TAStationIndex'
+
+# learned aliases are collected in memcache and written by a flush task, at most once per ALIAS_FLUSH_INTERVAL seconds
+PENDING_ALIASES_KEY = 'pending_aliases'
+ALIAS_FLUSH_INTERVAL = 60
+
 
 class TAScheduledPoint(TAModel):
 
@@ -65,19 +72,90 @@ class TAScheduledPoint(TAModel):
 
     # Relations
 
+    _station_index = None
+
     @classmethod
     def series_ids_at_station(cls, station_id):
-        memcache_key = 'series_ids@%s' % station_id
-        result = memcache.get(memcache_key)
-        if result is None:
-            result = []
-            keys = db.Query(cls, keys_only=True).filter('station_id =', station_id).fetch(100)
-            for key in keys:
-                mo = cls.identifier_regex.match(key.name())
-                series_id = '%s.%s' % (mo.group(1), mo.group(2))
-                result.append(series_id)
-            memcache.set(memcache_key, result)
-        return result
+        return cls.station_index().get(station_id, [])
+
+    @classmethod
+    def station_index(cls):
+        """
+        Provides a dictionary station_id > list of series_ids for all stations.
+        The index is kept in this instance and in memcache, under the current generation of STATION_INDEX_KIND.
+        """
+        generation = kind_generation(STATION_INDEX_KIND)
+        if cls._station_index is not None and cls._station_index[0] == generation:
+            return cls._station_index[1]
+
+        memcache_key = 'station_index_%s' % generation
+        index = memcache.get(memcache_key)
+        if index is None:
+            index = cls.build_station_index()
+            memcache.set(memcache_key, index)
+        cls._station_index = (generation, index)
+        return index
+
+    @classmethod
+    def build_station_index(cls):
+        index = {}
+        for key in db.Query(cls, keys_only=True):
+            mo = cls.identifier_regex.match(key.name())
+            if mo is None:
+                logging.warning('Point %s is left out of the station index' % key.name())
+                continue
+            series_id = '%s.%s' % (mo.group(1), mo.group(2))
+            station_id = '%s.%s' % (mo.group(1), mo.group(3))
+            index.setdefault(station_id, []).append(series_id)
+        return index
+
+    @classmethod
+    def invalidate_station_index(cls):
+        bump_generation(STATION_INDEX_KIND)
+        cls._station_index = None
+
+    # Learning aliases
+
+    @classmethod
+    def learn_alias(cls, point, name):
+        """
+        Queues name as the stationName of point, to be written by the flush_aliases task
+        """
+        client = memcache.Client()
+        for attempt in range(3):
+            pending = client.gets(PENDING_ALIASES_KEY)
+            if pending is None:
+                if client.add(PENDING_ALIASES_KEY, {point.id: (point.series_id, name)}):
+                    break
+            else:
+                pending[point.id] = (point.series_id, name)
+                if client.cas(PENDING_ALIASES_KEY, pending):
+                    break
+        else:
+            logging.warning('Alias %s for point %s could not be queued' % (name, point.id))
+            return
+
+        bucket = int(time.time()) // ALIAS_FLUSH_INTERVAL
+        task = taskqueue.Task(name='flush_aliases_%d' % bucket, url='/TAManager/flush_aliases', method='GET',
+                              countdown=ALIAS_FLUSH_INTERVAL)
+        try:
+            task.add()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def pop_pending_aliases(cls):
+        """
+        Provides and removes the queued aliases as a dictionary point_id > (series_id, name)
+        """
+        client = memcache.Client()
+        for attempt in range(3):
+            pending = client.gets(PENDING_ALIASES_KEY)
+            if not pending:
+                return {}
+            if client.cas(PENDING_ALIASES_KEY, {}):
+                return pending
+        return {}
 
     # Scheduled times:
     @property
@@ -244,12 +322,17 @@ class ScheduleImporter(XMLImporter):
         if self.old_objects:
             objects = self.old_objects.values()
             logging.info('Delete %d scheduledPoints.' % len(objects))
-            memcache.delete_multi(TAScheduledPoint.dictionary_from_list(objects), namespace='TAScheduledPoint')
+            TAScheduledPoint.cache_delete_multi(TAScheduledPoint.dictionary_from_list(objects).keys())
             db.delete(objects)
         if self.updated_objects:
             objects = self.updated_objects.values()
             logging.info('Update %d scheduledPoints.' % len(objects))
-            memcache.set_multi(TAScheduledPoint.dictionary_from_list(objects), namespace='TAScheduledPoint')
+            TAScheduledPoint.cache_set_multi(TAScheduledPoint.dictionary_from_list(objects))
             db.put(objects)
         if self.old_objects or self.updated_objects:
-            self.series.reset_points()
+            old_ids = set(point.id for point in self.old_objects.itervalues())
+            points = dict((point.id, point) for point in self.series.points if point.id not in old_ids)
+            points.update(TAScheduledPoint.dictionary_from_list(self.updated_objects.itervalues()))
+            self.series.update_points(points.values())
+            self.series.put()
+            TAScheduledPoint.invalidate_station_index()
@@ -20,52 +20,73 @@
 #  Created by Berend Schotanus on 21-Feb-13.
 #
 
-import webapp2, logging, xml.sax, bisect
+import webapp2, logging, xml.sax, bisect, json, math
 
 from google.appengine.ext import db
-from google.appengine.api import memcache
-from datetime import timedelta, datetime
+from google.appengine.api import memcache, taskqueue
+from datetime import timedelta, datetime, time
 
 from ffe                import config
 from ffe.gae            import counter_dict, issue_tasks
 from ffe.markup         import XMLDocument, XMLElement
-from ffe.ffe_time       import now_utc, now_cet, mark_utc, minutes_from_string, cet_from_string, minutes_from_time, time_from_minutes
-from TABasics           import TAModel, TAResourceHandler
+from ffe.ffe_time       import now_utc, now_cet, mark_utc, minutes_from_string, cet_from_string, string_from_cet, minutes_from_time
+from TABasics           import TAModel, TAResourceHandler, JSONProperty, acquire_lease, release_lease, wait_for_value, \
+                               query_batches
 from TAScheduledPoint   import TAScheduledPoint, Direction
-from TAMission          import TAMission, MissionStatuses, round_mission_offset
+from TAMission          import TAMission, MissionStatuses, round_mission_offset, live_statistics
 from TSStation          import TSStation
-from TAStop             import TAStop
+from TAStop             import TAStop, names_for_station_ids
 from TAChart            import TAChart
+from TARollup           import TARollup
+from TAMapper           import TAMapper, JobStatuses, register_mapper, start_mapper
+
+# changes to the schedule request a new timetable snapshot,
+# the requests within one minute are compiled by one task after SNAPSHOT_COMPILE_DELAY seconds
+SNAPSHOT_COMPILE_DELAY = 60
 
 
 # ====== Series Model ==========================================================================
 
 class TASeries(TAModel):
     agent_url = '/TASeries'
+    serves_stale = True
 
     # Stored attributes:
     type = db.StringProperty(indexed=False)
+    _missionData = JSONProperty()
+    _timetable = JSONProperty()
 
     # Transient attributes
     _points                 = None
     _points_dict            = None
     _missions_list          = None
+    _mission_timetable      = None
 
     @classmethod
     def import_xml(cls, filename):
         fp = open(filename, 'r')
         xml.sax.parse(fp, SeriesImporter())
+        for kind in (TASeries, TAScheduledPoint, TAMission):
+            kind.invalidate_cache()
+        request_snapshot()
 
     def import_schedule(self):
         filename = 'series.data/%s.xml' % self.id
         logging.info('import %s' % filename)
         xml_string = open(filename, 'r').read()
         TAScheduledPoint.parse_schedule(xml_string, self)
+        request_snapshot()
     
     @classmethod
     def statistics(cls, now=None):
+        """
+        Provides histograms of the status of current missions and the delay of running missions.
+        Without now the live counters are read, with now all current missions are evaluated at that time.
+        """
         if now is None:
-            now = now_cet()
+            statistics = live_statistics(now_cet())
+            statistics['counter'] = counter_dict()
+            return statistics
         status_hist = {}
         delay_hist = {}
         for seriesID in TASeries.all_ids():
@@ -88,12 +109,36 @@ class TASeries(TAModel):
             return '%d00' % int(self.code)
 
     def load_points(self):
+        if self._timetable is None:
+            lease_key = 'points:%s' % self.id
+            if acquire_lease(lease_key, namespace='TASeries'):
+                try:
+                    self.query_points()
+                finally:
+                    release_lease(lease_key, namespace='TASeries')
+                return
+            series = wait_for_value(self.cache_prefix() + self.id, namespace='TASeries',
+                                    accept=lambda series: series._timetable is not None)
+            if series is None:
+                self.query_points()
+                return
+            self._timetable = series._timetable
+        self.index_points(self.unpack_points())
+        self.cache_set()
+
+    def query_points(self):
+        """
+        Reads the points of a series without a timetable from the datastore and packs them into the cached series,
+        the timetable is stored by the writers of the series
+        """
         query = db.Query(TAScheduledPoint).filter('series_id =', self.id).order('km')
         array = query.fetch(100)
         if not array:
             array = []
+        self.update_points(array)
+
+    def index_points(self, array):
         self._points = array
-        
         self._points_dict = {}
         for index in range(len(self._points)):
             point = self._points[index]
@@ -101,13 +146,65 @@ class TASeries(TAModel):
             name = point.stationName
             if name:
                 self._points_dict[name] = index
+
+    def update_points(self, array):
+        """
+        Replaces the points of the series and packs them into the timetable, the series must be stored by the caller
+        """
+        array.sort(key=lambda point: point.km)
+        self.index_points(array)
+        self.pack_points()
         self.cache_set()
 
     def reset_points(self):
         self._points = None
         self._points_dict = None
+        self._timetable = None
         self.cache_set()
 
+    def pack_points(self):
+        """
+        Packs the TAScheduledPoints of the series into the timetable stored with the series:
+        km and four minute offsets per point, station ids and platforms as indexes in interned lists.
+        """
+        stations = []
+        names = []
+        platforms = []
+        platform_indexes = {}
+        rows = []
+        for point in self._points:
+            row = [len(stations), point.km, point.upArrival, point.upDeparture, point.downArrival, point.downDeparture]
+            stations.append(point.station_id)
+            names.append(point.stationName)
+            for direction in (Direction.down, Direction.up):
+                indexes = []
+                for platform in point.platform_list[direction]:
+                    index = platform_indexes.get(platform)
+                    if index is None:
+                        index = len(platforms)
+                        platform_indexes[platform] = index
+                        platforms.append(platform)
+                    indexes.append(index)
+                row.append(indexes)
+            rows.append(row)
+        self._timetable = {'stations': stations, 'names': names, 'platforms': platforms, 'points': rows}
+
+    def unpack_points(self):
+        stations = self._timetable['stations']
+        names = self._timetable['names']
+        platforms = self._timetable['platforms']
+        array = []
+        for station, km, up_arrival, up_departure, down_arrival, down_departure, down_platforms, up_platforms \
+                in self._timetable['points']:
+            point = TAScheduledPoint.new_with(self.id, stations[station])
+            point.km = km
+            point.stationName = names[station]
+            point.scheduled_times = (up_arrival, up_departure, down_arrival, down_departure)
+            platform_list = [[platforms[index] for index in down_platforms], [platforms[index] for index in up_platforms]]
+            point.platformData = json.dumps(platform_list)
+            array.append(point)
+        return array
+
     @property
     def points(self):
         if self._points is None:
@@ -145,33 +242,61 @@ class TASeries(TAModel):
         else:
             station_name = point.stationName
             if station_name is None:
-                station = TAStation.get(point.station_id)
-                station_name = station.name
-                point.stationName = station_name
-                point.put()
+                station_name = names_for_station_ids([point.station_id]).get(point.station_id)
             return station_name
 
     @property
     def mission_lists(self):
         if self._missions_list is None:
-            down_array = []
-            up_array = []
-            query = db.Query(TAMission).filter('series_id =', self.id)
-            for mission in query.fetch(200):
-                if mission.up:
-                    up_array.append((mission.offset_time, mission.number))
-                else:
-                    down_array.append((mission.offset_time, mission.number))
-            up_array.sort()
-            down_array.sort()
-            self.mission_lists = [down_array, up_array]
+            if self._missionData is not None:
+                self._missions_list = [[(time(minutes // 60, minutes % 60), number) for minutes, number in data]
+                                       for data in self._missionData]
+            else:
+                # the rebuilt lists are stored by the next put of the series, a read does not write
+                self._missions_list = self.query_mission_lists()
+                self.store_mission_lists()
         return self._missions_list
 
     @mission_lists.setter
     def mission_lists(self, array):
         self._missions_list = array
+        self.store_mission_lists()
         self.cache_set()
 
+    def store_mission_lists(self):
+        self._missionData = [[[offset.hour * 60 + offset.minute, number] for offset, number in array]
+                             for array in self._missions_list]
+        self._mission_timetable = None
+
+    @property
+    def mission_timetable(self):
+        if self._mission_timetable is None:
+            self._mission_timetable = SeriesTimetable(self.mission_lists)
+        return self._mission_timetable
+
+    def query_mission_lists(self):
+        """
+        Rebuilds the mission lists from the keys of the missions of the series, the number in the key gives the
+        direction. The offset is not indexed: it is read from memcache where possible, only the offsets of the
+        remaining missions are fetched from the datastore, one page of keys at a time.
+        """
+        offsets = {}
+        query = db.Query(TAMission, keys_only=True).filter('series_id =', self.id)
+        for keys in query_batches(query):
+            for id, mission in TAMission.objects_for_keys(keys).iteritems():
+                offsets[id] = mission.offset_time
+        down_array = []
+        up_array = []
+        for id, offset in offsets.iteritems():
+            number = int(id.split('.')[1])
+            if number % 2:
+                up_array.append((offset, number))
+            else:
+                down_array.append((offset, number))
+        up_array.sort()
+        down_array.sort()
+        return [down_array, up_array]
+
     @property
     def planned_mission_ids(self):
         array = []
@@ -292,10 +417,13 @@ class TASeries(TAModel):
         expired_mission_ids = []
         expired_missions = []
         updated_points = {}
-        updated_objects = [chart]
+        updated_objects = []
         
-        for mission in (self.down_missions + self.up_missions):
-            chart.add_mission(mission)
+        missions = self.down_missions + self.up_missions
+        contributions = chart.ingest_series(self, missions)
+        rollup = TARollup.get(self.id, create=True)
+        rollup.add_day((now - timedelta(days=1)).date().isoformat(), contributions)
+        for mission in missions:
             if mission.supplementary:
                 expired_mission_ids.append(mission.id)
                 expired_missions.append(mission)
@@ -308,18 +436,23 @@ class TASeries(TAModel):
                 updated_objects.append(mission)
     
         if iso_day == 7:
+            chart.load_shards()
             for point in self.points:
                 chart.verifyPoint(point)
                 if point.needs_datastore_put:
                     updated_points[point.id] = point
                     updated_objects.append(point)
+            rollup.add_week(chart)
 
         self.mission_lists = new_missions_list
-        self.cache_set()
+        updated_objects.append(self)
         chart.cache_set()
-        memcache.delete_multi(expired_mission_ids, namespace='TAMission')
-        memcache.set_multi(updated_missions, namespace='TAMission')
-        memcache.set_multi(updated_points, namespace='TAScheduledPoint')
+        updated_objects.extend(chart.modified_objects)
+        rollup.cache_set()
+        updated_objects.append(rollup)
+        TAMission.cache_delete_multi(expired_mission_ids)
+        TAMission.cache_set_multi(updated_missions)
+        TAScheduledPoint.cache_set_multi(updated_points)
         db.delete(expired_missions)
         db.put(updated_objects)
 
@@ -345,10 +478,9 @@ class TASeries(TAModel):
             if identifier:
                 index = self.points_dict.get(identifier, None)
                 if index is not None:
-                    point = self.points[index]
-                    point.stationName = name_or_id
-                    point.put()
-                    self._points_dict = None
+                    self._points_dict[name_or_id] = index
+                    self.cache_set()
+                    TAScheduledPoint.learn_alias(self.points[index], name_or_id)
             if index is None:
                 logging.info('station %s not found in series %s' % (name_or_id, self.id))
         return index
@@ -372,17 +504,13 @@ class TASeries(TAModel):
         return result
 
     def delete_point(self, station_id):
-        expired_point = self.point_for_station(station_id)
-        if expired_point:
+        """
+        Revokes the stops of all missions at station_id and then deletes the point, in a mapper job
+        """
+        if self.point_for_station(station_id):
             logging.info('Delete point %s' % station_id)
-            tasks = []
-            issue_time_cet = now_cet()
-            for mission_id in self.all_mission_ids(Direction.up) + self.all_mission_ids(Direction.down):
-                issue_time_cet += timedelta(seconds=config.INTERVAL_BETWEEN_UPDATE_MSG)
-                tasks.append(self.stop_task(TAStop.revoked_stop(mission_id, station_id), issue_time_cet))
-            issue_tasks(tasks)
-            expired_point.delete()
-            self.reset_points()
+            start_mapper(DeletePointMapper.name, series=self.id, station=station_id,
+                         issue_time=string_from_cet(now_cet()))
         else:
             logging.warning('Point %s could not be found for deletion' % station_id)
 
@@ -395,7 +523,9 @@ class TASeries(TAModel):
         mission_tuple = (mission.offset_time, mission.number)
         if not mission_tuple in array:
             bisect.insort(array, mission_tuple)
-            self.cache_set()
+            self.store_mission_lists()
+            self.put()
+            request_snapshot()
 
     def all_mission_ids(self, direction):
         array = []
@@ -404,6 +534,12 @@ class TASeries(TAModel):
         return array
 
     def current_mission_ids(self, direction, now=None):
+        return ['%s.%d' % (self.country, number) for number in self.current_mission_numbers(direction, now)]
+
+    def current_mission_numbers(self, direction, now=None):
+        """
+        Provides the numbers of the missions in direction that may be running at now
+        """
         if now is None:
             now = now_cet()
         if direction == Direction.up:
@@ -417,15 +553,9 @@ class TASeries(TAModel):
         max_time = min_time.replace(hour=23, minute=59, second=59)
         if end_time > max_time: end_time = max_time
 
-        source = self.mission_lists[direction]
-        start_index = bisect.bisect_left(source, (start_time.time(), 0))
-        end_index = bisect.bisect_right(source, (end_time.time(), 999999), lo=start_index)
-        output = []
-        for index in range(start_index, end_index):
-            offset, number = source[index]
-            output.append('%s.%d' % (self.country, number))
-
-        return output
+        first_minute = int(math.ceil(seconds_of_day(start_time) / 60.0))
+        last_minute = int(seconds_of_day(end_time) // 60)
+        return self.mission_timetable.numbers_between(direction, first_minute, last_minute)
 
     def relevant_mission_tuples(self, originID, startTime, timeSpan, direction=None, destinationID=None):
         origin_point = self.point_for_station(originID)
@@ -439,20 +569,14 @@ class TASeries(TAModel):
             else:
                 direction = Direction.down
         
-        source = self.mission_lists[direction]
         departure = origin_point.departure_in_direction(direction)
-        
         start_minutes = minutes_from_time(startTime) - departure
         end_minutes = start_minutes + (timeSpan.seconds // 60)
-        start_search = time_from_minutes(max(0, start_minutes))
-        end_search = time_from_minutes(min(1439, end_minutes))
-        start_index = bisect.bisect_left(source, (start_search, 0))
-        end_index = bisect.bisect_right(source, (end_search, 999999), lo=start_index)
+        offsets = self.mission_timetable.offsets_between(direction, max(0, start_minutes), min(1439, end_minutes))
 
         output = []
-        for index in range(start_index, end_index):
-            offset, number = source[index]
-            base_time = startTime.replace(hour=offset.hour, minute=offset.minute)
+        for offset, number in offsets:
+            base_time = startTime.replace(hour=offset // 60, minute=offset % 60)
             departure_time = base_time + timedelta(minutes=departure)
             mission_id = '%s.%d' % (self.country, number)
             output.append((departure_time, mission_id))
@@ -460,36 +584,123 @@ class TASeries(TAModel):
         return output
 
     def change_offsets(self, deltaOffsets):
-        new_list = [[], []]
-        processed_objects   = []
-        processed_missions  = {}
-        processed_points    = {}
-        
+        """
+        Shifts the points of the series by deltaOffsets and the offsets of its missions in the opposite direction.
+        The missions are processed in a mapper job, that rebuilds the mission lists when it is done.
+        The job sets each mission to the offset computed here, so a batch that runs twice does not shift twice.
+        """
+        target_offsets = {}
+        for direction in (Direction.down, Direction.up):
+            delta = deltaOffsets[direction]
+            if not delta:
+                continue
+            for offset, number in self.mission_lists[direction]:
+                old_offset = datetime(2002, 2, 2).replace(hour=offset.hour, minute=offset.minute)
+                new_offset = round_mission_offset(old_offset - timedelta(minutes=delta))
+                target_offsets['%s.%d' % (self.country, number)] = new_offset.hour * 60 + new_offset.minute
+
+        processed_points = {}
         for point in self.points:
             point.upArrival += deltaOffsets[Direction.up]
             point.upDeparture += deltaOffsets[Direction.up]
             point.downArrival += deltaOffsets[Direction.down]
             point.downDeparture += deltaOffsets[Direction.down]
             processed_points[point.id] = point
-            processed_objects.append(point)
 
-        for direction in (Direction.up, Direction.down):
-            if deltaOffsets[direction]:
-                for missionID in self.all_mission_ids(direction):
-                    mission = TAMission.get(missionID)
-                    old_offset = datetime(2002, 2, 2).replace(hour=mission.offset_time.hour, minute=mission.offset_time.minute)
-                    new_offset = round_mission_offset(old_offset - timedelta(minutes=deltaOffsets[direction]))
-                    mission.offset_time = new_offset.time()
-                    new_list[direction].append((mission.offset_time, mission.number))
-                    processed_missions[missionID] = mission
-                    processed_objects.append(mission)
-
-        self._missions_list = new_list
-        memcache.set_multi(processed_points, namespace='TAScheduledPoint')
-        memcache.set_multi(processed_missions, namespace='TAMission')
-        db.put(processed_objects)
+        self.pack_points()
+        db.put(processed_points.values() + [self])
+        TAScheduledPoint.cache_set_multi(processed_points)
         self.cache_set()
 
+        request_snapshot()
+        job = start_mapper(ChangeOffsetsMapper.name, series=self.id, targets=target_offsets)
+        if job.status == JobStatuses.done:
+            self.mission_lists = TASeries.get(self.id).mission_lists
+
+
+# ====== Mappers ==========================================================================
+
+class SeriesMissionsMapper(TAMapper):
+    """
+    Base class for mappers over the keys of the missions of the series in params['series'].
+    Missions must be read with TAMission.objects_for_keys, the cached copy may be more recent than the stored one.
+    """
+
+    def query(self):
+        return db.Query(TAMission, keys_only=True).filter('series_id =', self.params['series'])
+
+    @property
+    def series(self):
+        return TASeries.get(self.params['series'])
+
+
+@register_mapper
+class OptimizeOdidsMapper(SeriesMissionsMapper):
+    name = 'optimize_odids'
+
+    def process_batch(self, mission_keys):
+        changed_missions = []
+        for mission in TAMission.objects_for_keys(mission_keys).itervalues():
+            mission.optimize_odIDs_dictionary()
+            if mission.needs_datastore_put:
+                changed_missions.append(mission)
+        db.put(changed_missions)
+        TAMission.cache_set_multi(TAMission.dictionary_from_list(changed_missions))
+
+
+@register_mapper
+class ChangeOffsetsMapper(SeriesMissionsMapper):
+    name = 'change_offsets'
+
+    def process_batch(self, mission_keys):
+        """
+        Sets the missions to their target offset in minutes, missions that already have it are left alone
+        """
+        target_offsets = self.params['targets']
+        changed_missions = []
+        for mission in TAMission.objects_for_keys(mission_keys).itervalues():
+            minutes = target_offsets.get(mission.id)
+            if minutes is None:
+                continue
+            offset = time(minutes // 60, minutes % 60)
+            if mission.offset_time != offset:
+                mission.offset_time = offset
+                changed_missions.append(mission)
+        db.put(changed_missions)
+        TAMission.cache_set_multi(TAMission.dictionary_from_list(changed_missions))
+
+    def finish(self):
+        series = self.series
+        series.mission_lists = series.query_mission_lists()
+        series.put()
+        request_snapshot()
+
+
+@register_mapper
+class DeletePointMapper(SeriesMissionsMapper):
+    name = 'delete_point'
+
+    def process_batch(self, mission_keys):
+        series = self.series
+        station_id = self.params['station']
+        issue_time_cet = cet_from_string(self.params['issue_time'])
+        tasks = []
+        for key in mission_keys:
+            issue_time_cet += timedelta(seconds=config.INTERVAL_BETWEEN_UPDATE_MSG)
+            tasks.append(series.stop_task(TAStop.revoked_stop(key.name(), station_id), issue_time_cet))
+        issue_tasks(tasks)
+        self.params['issue_time'] = string_from_cet(issue_time_cet)
+
+    def finish(self):
+        series = self.series
+        expired_point = series.point_for_station(self.params['station'])
+        if expired_point:
+            expired_point.delete()
+            series.update_points([point for point in series.points if point.station_id != expired_point.station_id])
+            series.put()
+            TAScheduledPoint.invalidate_station_index()
+            request_snapshot()
+
 
 # ====== Series Handler ==========================================================================
 
@@ -526,13 +737,7 @@ class TASeriesHandler(TAResourceHandler):
             self.response.out.write('<a href=\"/console/series?id=%s\">terug naar serie</a>' % self.resource.id)
 
         elif instruction == 'optimize_odids':
-            changed_missions = []
-            for mission in self.resource.up_missions + self.resource.down_missions:
-                mission.optimize_odIDs_dictionary()
-                if mission.needs_datastore_put:
-                    changed_missions.append(mission)
-            memcache.set_multi(TAMission.dictionary_from_list(changed_missions), namespace='TAMission')
-            db.put(changed_missions)
+            start_mapper(OptimizeOdidsMapper.name, series=self.resource.id)
             self.response.out.write('<a href=\"/console/missions?kind=pattern&series=%s\">terug naar serie</a>' %
                                     self.resource.id)
 
@@ -603,9 +808,11 @@ class SeriesImporter(xml.sax.handler.ContentHandler):
     
     def endElement(self, name):
         if name == 'series':
+            self.series.update_points(self.routePoints.values())
             self.series.put()
             for point in self.routePoints.itervalues():
                 point.put()
+            TAScheduledPoint.invalidate_station_index()
             self.series = None
             self.routePoints = None
         
@@ -615,6 +822,58 @@ class SeriesImporter(xml.sax.handler.ContentHandler):
     def characters(self, string):
         self.data.append(string.strip())
 
+# ====== Series Timetable ==========================================================================
+
+class SeriesTimetable(object):
+    """
+    SeriesTimetable keeps the offsets of the missions of a series, in minutes after midnight,
+    and their numbers in parallel arrays per direction, ordered by offset.
+    """
+
+    def __init__(self, mission_lists):
+        self.offsets = [[], []]
+        self.numbers = [[], []]
+        for direction in (Direction.down, Direction.up):
+            for offset, number in mission_lists[direction]:
+                self.offsets[direction].append(offset.hour * 60 + offset.minute)
+                self.numbers[direction].append(number)
+
+    def index_range(self, direction, first_minute, last_minute):
+        offsets = self.offsets[direction]
+        start = bisect.bisect_left(offsets, first_minute)
+        return start, bisect.bisect_right(offsets, last_minute, lo=start)
+
+    def numbers_between(self, direction, first_minute, last_minute):
+        """
+        Provides the numbers of the missions in direction with an offset from first_minute up to and including last_minute
+        """
+        start, end = self.index_range(direction, first_minute, last_minute)
+        return self.numbers[direction][start:end]
+
+    def offsets_between(self, direction, first_minute, last_minute):
+        """
+        Provides (offset, number) tuples for the missions in direction with an offset in the same range
+        """
+        start, end = self.index_range(direction, first_minute, last_minute)
+        return zip(self.offsets[direction][start:end], self.numbers[direction][start:end])
+
+
+def seconds_of_day(moment):
+    return moment.hour * 3600 + moment.minute * 60 + moment.second + moment.microsecond / 1000000.0
+
+
+def request_snapshot():
+    """
+    Schedules the compile_snapshot task of TAManager, requests within the same minute share one task
+    """
+    task = taskqueue.Task(name='compile_snapshot_%s' % now_utc().strftime('%Y%m%d%H%M'),
+                          url='/TAManager/compile_snapshot', method='GET', countdown=SNAPSHOT_COMPILE_DELAY)
+    try:
+        task.add()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
 # ====== Timetable Document ==========================================================================
 
 class TimetableDocument(XMLDocument):
@@ -0,0 +1,335 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TASnapshot.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+TASnapshot compiles the timetable of the whole network into one binary snapshot and reads it back.
+
+The snapshot is a struct-of-arrays: after the header follow the string pool and tables of series,
+points and missions, each table stored column by column as little-endian arrays.
+A TimetableSnapshot reads values directly from the buffer (a string or an mmap) with struct.unpack_from,
+so opening a snapshot does not copy or decode the tables.
+"""
+
+import bisect, logging, struct
+
+from google.appengine.ext   import db
+
+from TABasics               import TAModel, kind_generation, bump_generation, cache_read, cache_write
+from TASeries               import TASeries
+from TAMission              import TAMission
+
+SNAPSHOT_MAGIC = 'TTSN'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_CHUNK_SIZE = 900 * 1000
+
+NO_STRING = 0xFFFFFFFF
+NO_MINUTES = -1
+
+# header: magic, version, number of strings, series, points and missions, followed by the section offsets
+HEADER = struct.Struct('<4sHxxIIII')
+SECTIONS = ('string_offsets', 'string_data',
+            'series_id', 'series_type', 'series_first_point', 'series_nr_of_points',
+            'point_station', 'point_name', 'point_km',
+            'point_up_arrival', 'point_up_departure', 'point_down_arrival', 'point_down_departure',
+            'mission_id', 'mission_series', 'mission_offset', 'mission_origins', 'mission_destinations')
+SECTION_OFFSETS = struct.Struct('<%dI' % len(SECTIONS))
+COLUMN_FORMATS = {'series_id': 'I', 'series_type': 'I', 'series_first_point': 'I', 'series_nr_of_points': 'I',
+                  'point_station': 'I', 'point_name': 'I', 'point_km': 'f',
+                  'point_up_arrival': 'h', 'point_up_departure': 'h',
+                  'point_down_arrival': 'h', 'point_down_departure': 'h',
+                  'mission_id': 'I', 'mission_series': 'I', 'mission_offset': 'h',
+                  'mission_origins': 'I', 'mission_destinations': 'I'}
+
+
+# ====== Compiling ==========================================================================
+
+class StringPool(object):
+
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def index(self, string):
+        if string is None:
+            return NO_STRING
+        index = self.indexes.get(string)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(string)
+            self.indexes[string] = index
+        return index
+
+
+def compile_snapshot():
+    """
+    Compiles all series with their points and all missions that belong to a series into a snapshot
+    :rtype : str
+    """
+    pool = StringPool()
+    columns = dict((name, []) for name in COLUMN_FORMATS)
+    series_indexes = {}
+
+    for series in TASeries.iter_objects():
+        series_indexes[series.id] = len(columns['series_id'])
+        columns['series_id'].append(pool.index(series.id))
+        columns['series_type'].append(pool.index(series.type))
+        columns['series_first_point'].append(len(columns['point_station']))
+        columns['series_nr_of_points'].append(len(series.points))
+        for point in series.points:
+            columns['point_station'].append(pool.index(point.station_id))
+            columns['point_name'].append(pool.index(point.stationName))
+            columns['point_km'].append(point.km if point.km is not None else float('nan'))
+            for name, minutes in zip(('point_up_arrival', 'point_up_departure',
+                                      'point_down_arrival', 'point_down_departure'), point.scheduled_times):
+                columns[name].append(minutes if minutes is not None else NO_MINUTES)
+
+    missions = []
+    for mission in TAMission.iter_objects():
+        if mission.series_id in series_indexes:
+            missions.append(mission)
+    missions.sort(key=lambda mission: mission.id)
+    for mission in missions:
+        columns['mission_id'].append(pool.index(mission.id))
+        columns['mission_series'].append(series_indexes[mission.series_id])
+        offset = mission.offset_time
+        columns['mission_offset'].append(offset.hour * 60 + offset.minute if offset is not None else NO_MINUTES)
+        for weekday in range(7):
+            origin, destination = mission.get_odIDs_for_weekday(weekday)
+            columns['mission_origins'].append(pool.index(origin))
+            columns['mission_destinations'].append(pool.index(destination))
+
+    return pack_snapshot(pool.strings, columns)
+
+
+def pack_snapshot(strings, columns):
+    encoded = [string.encode('utf-8') for string in strings]
+    string_offsets = [0]
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+    sections = {'string_offsets': struct.pack('<%dI' % len(string_offsets), *string_offsets),
+                'string_data': ''.join(encoded)}
+    for name, code in COLUMN_FORMATS.iteritems():
+        values = columns[name]
+        sections[name] = struct.pack('<%d%s' % (len(values), code), *values)
+
+    offsets = []
+    position = HEADER.size + SECTION_OFFSETS.size
+    for name in SECTIONS:
+        position += -position % 4
+        offsets.append(position)
+        position += len(sections[name])
+
+    parts = [HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(strings), len(columns['series_id']),
+                         len(columns['point_station']), len(columns['mission_id'])),
+             SECTION_OFFSETS.pack(*offsets)]
+    position = HEADER.size + SECTION_OFFSETS.size
+    for name, offset in zip(SECTIONS, offsets):
+        parts.append('\0' * (offset - position))
+        parts.append(sections[name])
+        position = offset + len(sections[name])
+    return ''.join(parts)
+
+
+# ====== Reading ==========================================================================
+
+class TimetableSnapshot(object):
+    """
+    Provides series, point and mission lookups from a compiled snapshot
+    """
+
+    def __init__(self, buffer):
+        magic, version, self.nr_of_strings, self.nr_of_series, self.nr_of_points, self.nr_of_missions = \
+            HEADER.unpack_from(buffer, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot %r version %d' % (magic, version))
+        self.buffer = buffer
+        self.offsets = dict(zip(SECTIONS, SECTION_OFFSETS.unpack_from(buffer, HEADER.size)))
+
+    def value(self, column, index):
+        code = COLUMN_FORMATS[column]
+        return struct.unpack_from('<' + code, self.buffer, self.offsets[column] + index * struct.calcsize(code))[0]
+
+    def column(self, column, size):
+        """
+        Provides the first size values of column as a tuple, for reading whole tables at once
+        """
+        return struct.unpack_from('<%d%s' % (size, COLUMN_FORMATS[column]), self.buffer, self.offsets[column])
+
+    def string(self, index):
+        if index == NO_STRING:
+            return None
+        start, end = struct.unpack_from('<II', self.buffer, self.offsets['string_offsets'] + 4 * index)
+        data_offset = self.offsets['string_data']
+        return self.buffer[data_offset + start:data_offset + end].decode('utf-8')
+
+    def search(self, column, size, identifier):
+        """
+        Provides the index of identifier in column, that is sorted by the string values
+        """
+        keys = StringColumn(self, column, size)
+        index = bisect.bisect_left(keys, identifier)
+        if index < size and keys[index] == identifier:
+            return index
+
+    # Series
+
+    def series_ids(self):
+        return [self.string(self.value('series_id', index)) for index in range(self.nr_of_series)]
+
+    def series_index(self, series_id):
+        return self.search('series_id', self.nr_of_series, series_id)
+
+    def series(self, series_id):
+        """
+        Provides a dictionary with id, type and points of the series, or None
+        """
+        index = self.series_index(series_id)
+        if index is None:
+            return None
+        return {'id': series_id,
+                'type': self.string(self.value('series_type', index)),
+                'points': self.points(index)}
+
+    def points(self, series_index):
+        """
+        Provides the points of the series at series_index as (station_id, name, km, scheduled_times) tuples
+        """
+        first = self.value('series_first_point', series_index)
+        result = []
+        for index in range(first, first + self.value('series_nr_of_points', series_index)):
+            times = tuple(self.minutes(column, index) for column in ('point_up_arrival', 'point_up_departure',
+                                                                     'point_down_arrival', 'point_down_departure'))
+            km = self.value('point_km', index)
+            result.append((self.string(self.value('point_station', index)),
+                           self.string(self.value('point_name', index)),
+                           km if km == km else None,
+                           times))
+        return result
+
+    def minutes(self, column, index):
+        minutes = self.value(column, index)
+        if minutes != NO_MINUTES:
+            return minutes
+
+    # Missions
+
+    def mission(self, mission_id):
+        """
+        Provides a dictionary with series_id, offset in minutes and odIDs per weekday of the mission, or None
+        """
+        index = self.search('mission_id', self.nr_of_missions, mission_id)
+        if index is None:
+            return None
+        od_ids = []
+        for weekday in range(7):
+            od_ids.append([self.string(self.value('mission_origins', 7 * index + weekday)),
+                           self.string(self.value('mission_destinations', 7 * index + weekday))])
+        return {'id': mission_id,
+                'series_id': self.string(self.value('series_id', self.value('mission_series', index))),
+                'offset': self.minutes('mission_offset', index),
+                'od_ids': od_ids}
+
+
+class StringColumn(object):
+    """
+    Sequence view on a column of string indexes, as used for bisecting a sorted column
+    """
+
+    def __init__(self, snapshot, column, size):
+        self.snapshot = snapshot
+        self.column = column
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.snapshot.string(self.snapshot.value(self.column, index))
+
+
+# ====== Storing ==========================================================================
+
+class TASnapshot(TAModel):
+    """
+    TASnapshot stores one chunk of the current snapshot, the chunk with index 0 keeps the number of chunks
+    """
+
+    # Stored attributes:
+    data = db.BlobProperty()
+    nr_of_chunks = db.IntegerProperty(indexed=False)
+
+
+def store_snapshot(data):
+    chunks = []
+    for index, start in enumerate(range(0, len(data), SNAPSHOT_CHUNK_SIZE)):
+        chunk = TASnapshot(key_name='snapshot_%d' % index)
+        chunk.data = db.Blob(data[start:start + SNAPSHOT_CHUNK_SIZE])
+        chunks.append(chunk)
+    chunks[0].nr_of_chunks = len(chunks)
+    db.put(chunks)
+    bump_generation('TASnapshot')
+    logging.info('Stored snapshot of %d bytes in %d chunks' % (len(data), len(chunks)))
+
+
+_snapshot = (None, None)
+
+
+def load_snapshot():
+    """
+    Provides the current TimetableSnapshot, from instance memory, memcache or the datastore, or None
+    """
+    global _snapshot
+    generation = kind_generation('TASnapshot')
+    if _snapshot[0] == generation:
+        return _snapshot[1]
+    key = '%d:snapshot' % generation
+    data = cache_read(key, namespace='TASnapshot')
+    if data is None:
+        first = TASnapshot.get_by_key_name('snapshot_0')
+        if first is None:
+            return None
+        chunks = [first]
+        if first.nr_of_chunks > 1:
+            chunks += db.get([db.Key.from_path('TASnapshot', 'snapshot_%d' % index)
+                              for index in range(1, first.nr_of_chunks)])
+        data = ''.join(str(chunk.data) for chunk in chunks)
+        cache_write(key, data, namespace='TASnapshot')
+    snapshot = TimetableSnapshot(data)
+    _snapshot = (generation, snapshot)
+    return snapshot
+
+
+def write_snapshot(path):
+    """
+    Writes a compiled snapshot to a file, for use by offline tools
+    """
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(compile_snapshot())
+
+
+def open_snapshot(path):
+    """
+    Provides a TimetableSnapshot that reads from a memory mapped snapshot file
+    """
+    import mmap
+    with open(path, 'rb') as snapshot_file:
+        return TimetableSnapshot(mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ))
@@ -27,11 +27,13 @@ import xml.sax
 import json
 
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
+from google.appengine.api import taskqueue, memcache
 from ffe.gae import increase_counter
 from ffe.ffe_time import cet_from_string, string_from_cet, utc_from_cet
 from ffe.markup import XMLImporter
-from TABasics import task_name
+from TABasics import task_name, local_cache, kind_generation
+
+STATION_NAMES_CACHE_SIZE = 1000
 
 
 class StopStatuses:
@@ -110,7 +112,17 @@ class TAStop(object):
 
     @property
     def station(self):
-        return ndb.Key('TSStation', self.station_id).get()
+        cache = local_cache('TSStation')
+        station = cache.get(self.station_id)
+        if station is None:
+            station = ndb.Key('TSStation', self.station_id).get()
+            if station is not None:
+                cache.set(self.station_id, station)
+        return station
+
+    @property
+    def station_name(self):
+        return names_for_station_ids([self.station_id]).get(self.station_id)
 
     @property
     def station_url(self):
@@ -375,3 +387,36 @@ def repr_list_from_stops(stops_list):
     for stop in stops_list:
         repr_list.append(stop.repr)
     return repr_list
+
+
+def names_for_station_ids(station_ids):
+    """
+    Provides a dictionary station_id > name for the requested stations,
+    from the instance-local cache, memcache or (in one batch) the datastore
+    """
+    cache = local_cache('TSStation_names', size=STATION_NAMES_CACHE_SIZE, generation_kind='TSStation')
+    names = {}
+    missing = []
+    for station_id in set(station_ids):
+        name = cache.get(station_id)
+        if name is None:
+            missing.append(station_id)
+        else:
+            names[station_id] = name
+    if not missing:
+        return names
+
+    key_prefix = '%d:' % kind_generation('TSStation')
+    cached_names = memcache.get_multi(missing, key_prefix=key_prefix, namespace='TSStation_names')
+    uncached = [station_id for station_id in missing if station_id not in cached_names]
+    if uncached:
+        fetched_names = {}
+        for station in ndb.get_multi([ndb.Key('TSStation', station_id) for station_id in uncached]):
+            if station is not None:
+                fetched_names[station.key.id()] = station.name
+        memcache.set_multi(fetched_names, key_prefix=key_prefix, namespace='TSStation_names')
+        cached_names.update(fetched_names)
+    for station_id, name in cached_names.iteritems():
+        cache.set(station_id, name)
+        names[station_id] = name
+    return names
@@ -33,7 +33,7 @@ from ffe.ffe_time       import mark_cet, utc_from_cet, minutes_from_string, stri
 from TASeries           import TASeries
 from TAMission          import TAMission, round_mission_offset
 from TAStop             import TAStop, StopStatuses
-from TAScheduledPoint   import Direction
+from TAScheduledPoint   import TAScheduledPoint, Direction
 
 MENU_LIST = (('Home', '/console'),
              ('Series', '/console/series?page=1'),
@@ -99,8 +99,10 @@ class RepatternHandler(webapp2.RequestHandler):
                 processedObjects.append(point)
                 row.add_to_cell(5, 'aangepast')
 
+        series.pack_points()
         series.cache_set()
-        memcache.set_multi(processedPoints, namespace='TAScheduledPoint')
+        processedObjects.append(series)
+        TAScheduledPoint.cache_set_multi(processedPoints)
         db.put(processedObjects)
         self.response.out.write(self.doc.write())
 
@@ -194,8 +196,10 @@ class ReoffsetHandler(webapp2.RequestHandler):
         table = self.doc.add_table('adapted_missions', ['Missie', 'Offset'])
         self.processMissions(series.all_mission_ids(Direction.up), Direction.up, table)
         self.processMissions(series.all_mission_ids(Direction.down), Direction.down, table)
-        series.cache_set()
         self.saveChanges()
+        series.pack_points()
+        series.mission_lists = series.query_mission_lists()
+        series.put()
         
 #        self.writeReport(series)
         self.response.out.write(self.doc.write())
@@ -325,8 +329,8 @@ class ReoffsetHandler(webapp2.RequestHandler):
                                                  newOffset.strftime('%H:%M')))
 
     def saveChanges(self):
-        memcache.set_multi(self.processedPoints, namespace='TAScheduledPoint')
-        memcache.set_multi(self.processedMissions, namespace='TAMission')
+        TAScheduledPoint.cache_set_multi(self.processedPoints)
+        TAMission.cache_set_multi(self.processedMissions)
         db.put(self.processedObjects)
 
 
@@ -26,6 +26,7 @@ import logging
 import re
 from google.appengine.ext   import ndb
 from ffe.rest_resources import PublicResource
+from TABasics import bump_generation
 
 
 class TSJunction(PublicResource):
@@ -37,3 +38,14 @@ class TSJunction(PublicResource):
     coordinate = ndb.GeoPtProperty()
     same_direction = ndb.BooleanProperty(indexed=False)
     identifier_regex = re.compile('([a-z]{2})\.j_([0-9]{3})$')
+
+    # ------------ Object lifecycle ------------------------------------------------------------------------------------
+
+    def _post_put_hook(self, future):
+        super(TSJunction, self)._post_put_hook(future)
+        bump_generation('TSNetwork')
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(TSJunction, cls)._post_delete_hook(key, future)
+        bump_generation('TSNetwork')
@@ -0,0 +1,210 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TSNetwork.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+TSNetwork compiles the rail network of the atlas into a graph, for shortest paths and distances by rail.
+
+The nodes of the graph are stations and junctions. Along each TSRoute the stations, by their TSStationPosition,
+and the junctions on the route are ordered by km, consecutive nodes are linked by an edge weighted with the
+difference in km. A junction lies on two routes and so links them, a station on several routes does the same.
+The graph also keeps the coordinates of its nodes, to follow a path by rail on the map.
+"""
+
+import heapq, logging
+
+from TABasics               import kind_generation, cache_read, cache_write
+from TSStationPosition      import TSStationPosition
+from TSJunction             import TSJunction
+
+# TSStationPosition and TSJunction bump the generation of TSNetwork when they change,
+# batch writers wrap their puts in batched_generation_bumps to bump it once
+NETWORK_KIND = 'TSNetwork'
+
+# positions on this route are stations whose route is not known
+UNKNOWN_ROUTE_CODE = 'xx00'
+
+
+class NetworkGraph(object):
+    """
+    NetworkGraph keeps for each node, by number, a list of (neighbour, km) edges
+    """
+
+    def __init__(self, route_nodes, coordinates=None):
+        """
+        :param route_nodes: dictionary route_id > list of (km, node_id) for the stations and junctions on the route
+        :param coordinates: dictionary node_id > (lat, lon) for the nodes with a known location
+        """
+        self.coordinates = coordinates or {}
+        self.node_ids = []
+        self.node_indexes = {}
+        self.edges = []
+        for route_id in sorted(route_nodes):
+            nodes = sorted(route_nodes[route_id])
+            for (km, node_id), (next_km, next_id) in zip(nodes[:-1], nodes[1:]):
+                if node_id != next_id:
+                    self.add_edge(node_id, next_id, next_km - km)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def node_index(self, node_id):
+        index = self.node_indexes.get(node_id)
+        if index is None:
+            index = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.node_indexes[node_id] = index
+            self.edges.append([])
+        return index
+
+    def add_edge(self, node_id, other_id, km):
+        node = self.node_index(node_id)
+        other = self.node_index(other_id)
+        self.edges[node].append((other, km))
+        self.edges[other].append((node, km))
+
+    def search(self, source, target=None, max_km=None):
+        """
+        Dijkstra's search from node number source, until target is reached or no node within max_km remains
+        :return: dictionaries node > km and node > previous node, for the nodes that were reached
+        """
+        distances = {source: 0.0}
+        previous = {}
+        done = set()
+        queue = [(0.0, source)]
+        while queue:
+            km, node = heapq.heappop(queue)
+            if node in done:
+                continue
+            done.add(node)
+            if node == target:
+                break
+            for neighbour, edge_km in self.edges[node]:
+                new_km = km + edge_km
+                if max_km is not None and new_km > max_km:
+                    continue
+                if new_km < distances.get(neighbour, float('inf')):
+                    distances[neighbour] = new_km
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_km, neighbour))
+        return dict((node, distances[node]) for node in done), previous
+
+    def shortest_path(self, from_id, to_id):
+        """
+        Provides the shortest path by rail between two stations or junctions, as (km, [node ids]), or None
+        """
+        source = self.node_indexes.get(from_id)
+        target = self.node_indexes.get(to_id)
+        if source is None or target is None:
+            return None
+        distances, previous = self.search(source, target=target)
+        if target not in distances:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return distances[target], [self.node_ids[node] for node in path]
+
+    def distance(self, from_id, to_id):
+        """
+        Provides the distance by rail in km between two stations or junctions, or None when they are not connected
+        """
+        path = self.shortest_path(from_id, to_id)
+        if path is not None:
+            return path[0]
+
+    def distances_from(self, from_id, max_km=None):
+        """
+        Provides a dictionary node id > km for all stations and junctions within max_km by rail from from_id
+        """
+        source = self.node_indexes.get(from_id)
+        if source is None:
+            return {}
+        distances, previous = self.search(source, max_km=max_km)
+        return dict((self.node_ids[node], km) for node, km in distances.iteritems())
+
+    def path_geometry(self, from_id, to_id):
+        """
+        Provides the shortest path by rail between two nodes as parallel lists of km from from_id, lat and lon,
+        for the nodes on the path with known coordinates, or None when the path or the coordinates of its ends are unknown
+        """
+        path = self.shortest_path(from_id, to_id)
+        if path is None or from_id not in self.coordinates or to_id not in self.coordinates:
+            return None
+        kms = []
+        latitudes = []
+        longitudes = []
+        km = 0.0
+        previous = None
+        for node_id in path[1]:
+            node = self.node_indexes[node_id]
+            if previous is not None:
+                km += min(edge_km for neighbour, edge_km in self.edges[previous] if neighbour == node)
+            previous = node
+            coordinate = self.coordinates.get(node_id)
+            if coordinate is not None:
+                kms.append(km)
+                latitudes.append(coordinate[0])
+                longitudes.append(coordinate[1])
+        return kms, latitudes, longitudes
+
+
+def compile_network():
+    """
+    Compiles the NetworkGraph of all station positions and junctions
+    """
+    route_nodes = {}
+    coordinates = {}
+    for position in TSStationPosition.query().iter():
+        if position.route_code != UNKNOWN_ROUTE_CODE and position.km is not None:
+            route_nodes.setdefault(position.route_id, []).append((position.km, position.station_id))
+        if position.geo_point is not None:
+            coordinates.setdefault(position.station_id, position.coordinate)
+    for junction in TSJunction.query().iter():
+        for route_key, km in ((junction.route1_key, junction.km1), (junction.route2_key, junction.km2)):
+            if route_key is not None and km is not None:
+                route_nodes.setdefault(route_key.id(), []).append((km, junction.id_))
+        if junction.coordinate is not None:
+            coordinates[junction.id_] = (junction.coordinate.lat, junction.coordinate.lon)
+    graph = NetworkGraph(route_nodes, coordinates)
+    logging.info('Compiled network of %d nodes on %d routes' % (len(graph), len(route_nodes)))
+    return graph
+
+
+_graph = (None, None)
+
+
+def network_graph():
+    """
+    Provides the current NetworkGraph, from instance memory, memcache or compiled from the datastore
+    """
+    global _graph
+    generation = kind_generation(NETWORK_KIND)
+    if _graph[0] == generation:
+        return _graph[1]
+    key = '%d:graph' % generation
+    graph = cache_read(key, namespace=NETWORK_KIND)
+    if graph is None:
+        graph = compile_network()
+        cache_write(key, graph, namespace=NETWORK_KIND)
+    _graph = (generation, graph)
+    return graph
@@ -0,0 +1,150 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TSSpatialIndex.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+TSSpatialIndex finds stations by location: the nearest stations to a point and the stations within a bounding box.
+
+The stations are kept in a grid of cells of CELL_DEGREES, a query only visits the cells around its point or
+inside its box. Distances are computed with the equirectangular approximation,
+which is accurate enough over the distances between neighbouring stations.
+"""
+
+import math
+
+from TSStationPosition import TSStationPosition
+
+CELL_DEGREES = 0.1
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    x = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = lat2 - lat1
+    return KM_PER_DEGREE * math.sqrt(x * x + y * y)
+
+
+class StationGrid(object):
+    """
+    StationGrid keeps (station_id, lat, lon) tuples in cells, by row of latitude and column of longitude
+    """
+
+    def __init__(self, coordinates, cell_degrees=CELL_DEGREES):
+        self.coordinates = coordinates
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        for station_id, (lat, lon) in coordinates.iteritems():
+            self.cells.setdefault(self.cell(lat, lon), []).append((station_id, lat, lon))
+        if self.cells:
+            rows = [row for row, column in self.cells]
+            columns = [column for row, column in self.cells]
+            self.bounds = (min(rows), min(columns), max(rows), max(columns))
+            self.max_latitude = max(abs(lat) for lat, lon in coordinates.itervalues()) + cell_degrees
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def nearest(self, lat, lon, k=1, max_km=None):
+        """
+        Provides the k stations nearest to lat, lon as (distance_km, station_id) tuples, nearest first.
+        The cells are visited in rings around the cell of the point, until no unvisited cell can hold a nearer station.
+        """
+        if k < 1 or not self.cells:
+            return []
+        row, column = self.cell(lat, lon)
+        min_row, min_column, max_row, max_column = self.bounds
+        max_ring = max(row - min_row, max_row - row, column - min_column, max_column - column, 0)
+        # the smallest width of a cell in km, cells are narrowest at the highest latitude
+        narrowest = min(max(abs(lat), self.max_latitude), 89.0)
+        cell_km = self.cell_degrees * KM_PER_DEGREE * math.cos(math.radians(narrowest))
+        # the distance from the point to the nearest side of its own cell
+        fractions = (lat / self.cell_degrees - row, lon / self.cell_degrees - column)
+        margin = cell_km * min(fractions[0], 1 - fractions[0], fractions[1], 1 - fractions[1])
+        found = []
+        for ring in range(max_ring + 1):
+            # the distance to any cell of this ring is at least the margin plus (ring - 1) cell widths
+            reach = margin + (ring - 1) * cell_km if ring else 0.0
+            if len(found) >= k and found[k - 1][0] <= reach:
+                break
+            if max_km is not None and reach > max_km:
+                break
+            for cell in ring_cells(row, column, ring):
+                for station_id, station_lat, station_lon in self.cells.get(cell, ()):
+                    found.append((distance_km(lat, lon, station_lat, station_lon), station_id))
+            found.sort()
+            del found[k:]
+        if max_km is not None:
+            found = [item for item in found if item[0] <= max_km]
+        return found
+
+    def within(self, south, west, north, east):
+        """
+        Provides the ids of the stations inside the bounding box, ordered by id
+        """
+        if not self.cells:
+            return []
+        first_row, first_column = self.cell(south, west)
+        last_row, last_column = self.cell(north, east)
+        min_row, min_column, max_row, max_column = self.bounds
+        first_row, first_column = max(first_row, min_row), max(first_column, min_column)
+        last_row, last_column = min(last_row, max_row), min(last_column, max_column)
+        result = []
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                for station_id, lat, lon in self.cells.get((row, column), ()):
+                    if south <= lat <= north and west <= lon <= east:
+                        result.append(station_id)
+        result.sort()
+        return result
+
+
+def ring_cells(row, column, ring):
+    """
+    Provides the cells at ring steps around row, column
+    """
+    if ring == 0:
+        return [(row, column)]
+    cells = []
+    for offset in range(-ring, ring + 1):
+        cells.append((row - ring, column + offset))
+        cells.append((row + ring, column + offset))
+    for offset in range(-ring + 1, ring):
+        cells.append((row + offset, column - ring))
+        cells.append((row + offset, column + ring))
+    return cells
+
+
+_grid = None
+
+
+def station_grid():
+    """
+    Provides the StationGrid of all station coordinates, rebuilt when the generation of TSStation changes
+    """
+    global _grid
+    coordinates = TSStationPosition.station_coordinates()
+    if _grid is None or _grid.coordinates is not coordinates:
+        _grid = StationGrid(coordinates)
+    return _grid
@@ -22,7 +22,7 @@
 
 """TSStation is a subclass of TSEntry, ..."""
 
-import re, logging
+import re, logging, unicodedata
 from ffe import config
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
@@ -31,6 +31,7 @@ from ffe.ffe_time import cet_from_string
 from ffe.gae import remote_fetch
 from ffe.rest_resources import PublicResource, DataType, NoValidIdentifierError
 from TSStationPosition import TSStationPosition
+from TABasics import local_cache, bump_generation, kind_generation, batched_generation_bumps
 from TSStationAgent import TSStationAgent
 
 
@@ -47,12 +48,23 @@ class TSStation(PublicResource):
     importance = ndb.IntegerProperty()
     wiki_string = ndb.StringProperty(indexed=False)
     opened_string = ndb.StringProperty()
+    transfer_minutes = ndb.IntegerProperty()
 
     # ------------ Object lifecycle ------------------------------------------------------------------------------------
 
+    def _post_put_hook(self, future):
+        super(TSStation, self)._post_put_hook(future)
+        bump_generation(self.__class__.__name__)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(TSStation, cls)._post_delete_hook(key, future)
+        bump_generation(cls.__name__)
+
     def delete(self):
-        for position in self.positions:
-            position.delete()
+        with batched_generation_bumps():
+            for position in self.positions:
+                position.delete()
         super(TSStation, self).delete()
 
     # ------------ Object metadata -------------------------------------------------------------------------------------
@@ -67,6 +79,21 @@ class TSStation(PublicResource):
 
     # ------------ Finding instances -----------------------------------------------------------------------------------
 
+    @classmethod
+    def get(cls, identifier, *args, **kwargs):
+        """
+        Plain lookups by identifier are served from the instance-local cache when possible
+        """
+        if args or kwargs:
+            return super(TSStation, cls).get(identifier, *args, **kwargs)
+        cache = local_cache(cls.__name__)
+        station = cache.get(identifier)
+        if station is None:
+            station = super(TSStation, cls).get(identifier)
+            if station is not None:
+                cache.set(identifier, station)
+        return station
+
     @classmethod
     def active_ids(cls):
         memcache_key = '%s_active_ids' % cls.__name__
@@ -78,13 +105,54 @@ class TSStation(PublicResource):
             memcache.set(memcache_key, ids_list)
         return ids_list
 
+    _names_index = None
+
     @classmethod
     def id_for_name(cls, name):
         try:
             return cls.valid_identifier(name)
         except NoValidIdentifierError:
-            for key in cls.query().filter(TSStation.names == name).iter(keys_only=True):
-                return key.id()
+            return cls.names_index().get(normalized_name(name))
+
+    @classmethod
+    def names_index(cls):
+        """
+        Provides a dictionary normalized name > station id, covering all names and aliases of all stations.
+        The index is kept in this instance and in memcache, under the current generation of TSStation.
+        """
+        generation = kind_generation(cls.__name__)
+        if cls._names_index is not None and cls._names_index[0] == generation:
+            return cls._names_index[1]
+        memcache_key = '%s_names_%s' % (cls.__name__, generation)
+        index = memcache.get(memcache_key)
+        if index is None:
+            index = {}
+            for station in cls.query().iter(projection=[TSStation.names]):
+                index.setdefault(normalized_name(station.names[0]), station.key.id())
+            memcache.set(memcache_key, index)
+        cls._names_index = (generation, index)
+        return index
+
+    _transfer_index = None
+
+    @classmethod
+    def transfer_minutes_index(cls):
+        """
+        Provides a dictionary station id > minimum transfer time in minutes, for the stations that have one.
+        The index is kept like the names index.
+        """
+        generation = kind_generation(cls.__name__)
+        if cls._transfer_index is not None and cls._transfer_index[0] == generation:
+            return cls._transfer_index[1]
+        memcache_key = '%s_transfers_%s' % (cls.__name__, generation)
+        index = memcache.get(memcache_key)
+        if index is None:
+            index = {}
+            for station in cls.query(TSStation.transfer_minutes >= 0).iter(projection=[TSStation.transfer_minutes]):
+                index[station.key.id()] = station.transfer_minutes
+            memcache.set(memcache_key, index)
+        cls._transfer_index = (generation, index)
+        return index
 
     # ------------ Object properties -----------------------------------------------------------------------------------
 
@@ -172,7 +240,9 @@ class TSStation(PublicResource):
             xml_string = remote_fetch(url=config.NSAPI_STATIONS_URL,
                                       headers=config.NSAPI_HEADER,
                                       deadline=config.NSAPI_DEADLINE)
-        cls.update_multi(xml_string, DataType.xml)
+        with batched_generation_bumps():
+            cls.update_multi(xml_string, DataType.xml)
+            bump_generation(cls.__name__)
 
     def update_with_dictionary(self, dictionary):
         changes = False
@@ -211,6 +281,11 @@ class TSStation(PublicResource):
                 self.label_angle = label_angle
                 changes = True
 
+            transfer_minutes = dictionary.get('transferMinutes')
+            if transfer_minutes != self.transfer_minutes:
+                self.transfer_minutes = transfer_minutes
+                changes = True
+
             wiki_string = dictionary.get('wikiString')
             if wiki_string != self.wiki_string:
                 self.wiki_string = wiki_string
@@ -266,10 +341,11 @@ class TSStation(PublicResource):
                 changes = True
                 updated_positions.append(current_position)
         self._positions = None
-        for position in old_positions:
-            position.delete()
-        if updated_positions:
-            ndb.put_multi(updated_positions)
+        with batched_generation_bumps():
+            for position in old_positions:
+                position.delete()
+            if updated_positions:
+                ndb.put_multi(updated_positions)
         return changes
 
     # ------------ Writing content -------------------------------------------------------------------------------------
@@ -299,6 +375,9 @@ class TSStation(PublicResource):
         if self.importance is not None:
             dictionary['importance'] = self.importance
 
+        if self.transfer_minutes is not None:
+            dictionary['transferMinutes'] = self.transfer_minutes
+
         if self.wiki_string is not None:
             dictionary['wikiString'] = self.wiki_string
 
@@ -314,6 +393,19 @@ class TSStation(PublicResource):
         return dictionary
 
 
+# ====== Helper functions ==============================================================================================
+
+def normalized_name(name):
+    """
+    Provides name in lower case, without accents and with single spaces between words
+    """
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = ''.join(character for character in unicodedata.normalize('NFKD', name)
+                   if not unicodedata.combining(character))
+    return ' '.join(word for word in re.split(r'[\W_]+', name.lower(), flags=re.UNICODE) if word)
+
+
 # ====== XML Parser ====================================================================================================
 
 class StationImporter(XMLImporter):
@@ -24,12 +24,12 @@
 
 import logging, re
 from datetime import timedelta
-from google.appengine.api import memcache
 
 from ffe import config
 from ffe.gae import increase_counter, remote_fetch, issue_tasks
 from ffe.ffe_time import now_cet, cet_from_string
 from ffe.rest_resources import NoValidIdentifierError
+from TABasics import cache_read, cache_write
 from TAStop import TAStop
 
 
@@ -49,13 +49,13 @@ class TSStationAgent(object):
 
     @classmethod
     def get(cls, identifier):
-        self = memcache.get(identifier, namespace=cls.__name__)
+        self = cache_read(identifier, namespace=cls.__name__)
         if not self:
             self = cls(identifier)
         return self
 
     def cache_set(self):
-        memcache.set(self.id_, self, namespace=self.__class__.__name__)
+        cache_write(self.id_, self, namespace=self.__class__.__name__)
 
     # ------------ Object metadata -------------------------------------------------------------------------------------
 
@@ -25,7 +25,9 @@
 import re
 import logging
 from google.appengine.ext import ndb
+from google.appengine.api import memcache
 from ffe.rest_resources import Resource
+from TABasics import kind_generation, bump_generation
 
 
 class TSStationPosition(Resource):
@@ -51,6 +53,42 @@ class TSStationPosition(Resource):
         self.route_key = ndb.Key('TSRoute', route_id)
         return self
 
+    def _post_put_hook(self, future):
+        super(TSStationPosition, self)._post_put_hook(future)
+        bump_generation(self.__class__.__name__)
+        bump_generation('TSNetwork')
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(TSStationPosition, cls)._post_delete_hook(key, future)
+        bump_generation(cls.__name__)
+        bump_generation('TSNetwork')
+
+    # ------------ Finding instances -----------------------------------------------------------------------------------
+
+    _coordinates = None
+
+    @classmethod
+    def station_coordinates(cls):
+        """
+        Provides a dictionary station id > (lat, lon), with the first position of each station that has a geo_point.
+        The dictionary is kept in this instance and in memcache, under the current generations of TSStation
+        and of TSStationPosition, that changes with every position.
+        """
+        generation = (kind_generation('TSStation'), kind_generation(cls.__name__))
+        if cls._coordinates is not None and cls._coordinates[0] == generation:
+            return cls._coordinates[1]
+        memcache_key = '%s_coordinates_%s_%s' % ((cls.__name__,) + generation)
+        coordinates = memcache.get(memcache_key)
+        if coordinates is None:
+            coordinates = {}
+            for position in cls.query().iter():
+                if position.geo_point is not None:
+                    coordinates.setdefault(position.station_id, position.coordinate)
+            memcache.set(memcache_key, coordinates)
+        cls._coordinates = (generation, coordinates)
+        return coordinates
+
     # ------------ Object metadata -------------------------------------------------------------------------------------
 
     def __repr__(self):
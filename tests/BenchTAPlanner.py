@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  BenchTAPlanner.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+BenchTAPlanner.py measures the query time of the journey planner on a network of the size of the Dutch network:
+intercity lines between the main stations and sprinter lines that stop at the stations in between,
+running from 6:00 until midnight. It needs the same path as the tests.
+"""
+
+import random, sys, time
+
+from TASnapshot     import TimetableSnapshot, StringPool, COLUMN_FORMATS, pack_snapshot
+from TAPlanner      import NetworkPlanner
+
+TARGET_MS = 10.0
+NR_OF_QUERIES = 500
+
+# (stations, minutes between stations, minutes between missions)
+INTERCITY_LINES = [(['asd', 'ut', 'ht', 'ehv', 'std', 'mt'], 20, 30),
+                   (['gvc', 'ledn', 'shl', 'asd', 'amf', 'dv', 'es'], 15, 30),
+                   (['rtd', 'gd', 'ut', 'amf', 'zl', 'gn'], 18, 30),
+                   (['rtd', 'dt', 'gvc', 'ledn', 'hlm', 'asd'], 12, 15),
+                   (['vl', 'rsd', 'bd', 'tb', 'ehv'], 20, 30),
+                   (['asd', 'ut', 'ah', 'nm', 'zl', 'lw'], 22, 30),
+                   (['gvc', 'gd', 'ut', 'ah', 'zp', 'es'], 17, 30),
+                   (['shl', 'ut', 'ht', 'nm', 'ah', 'zl', 'hgv', 'gn'], 19, 30)]
+SPRINTER_STOPS = 6
+SPRINTER_MINUTES = 5
+SPRINTER_INTERVAL = 15
+FIRST_OFFSET = 6 * 60
+LAST_OFFSET = 23 * 60
+
+OD_PAIRS = [('asd', 'mt'), ('gvc', 'gn'), ('rtd', 'lw'), ('vl', 'es'), ('hlm', 'ehv'), ('ledn', 'zl'),
+            ('dt', 'nm'), ('tb', 'amf'), ('std', 'gn'), ('rsd', 'dv'), ('hgv', 'vl'), ('zp', 'shl')]
+
+
+def network_columns(seed=15):
+    """
+    Provides the string pool and the snapshot columns of a synthetic network
+    """
+    generator = random.Random(seed)
+    pool = StringPool()
+    columns = dict((name, []) for name in COLUMN_FORMATS)
+    missions = []
+
+    def add_series(series_id, stations, minutes, interval, number):
+        series_index = len(columns['series_id'])
+        columns['series_id'].append(pool.index(series_id))
+        columns['series_type'].append(pool.index('Intercity'))
+        columns['series_first_point'].append(len(columns['point_station']))
+        columns['series_nr_of_points'].append(len(stations))
+        duration = minutes * (len(stations) - 1)
+        for index, station in enumerate(stations):
+            up = index * minutes
+            down = duration - up
+            columns['point_station'].append(pool.index(station))
+            columns['point_name'].append(pool.index(station))
+            columns['point_km'].append(float(up))
+            columns['point_up_arrival'].append(up)
+            columns['point_up_departure'].append(up if index in (0, len(stations) - 1) else up + 1)
+            columns['point_down_arrival'].append(down)
+            columns['point_down_departure'].append(down if index in (0, len(stations) - 1) else down + 1)
+        first_offset = FIRST_OFFSET + generator.randint(0, interval - 1)
+        for offset in range(first_offset, LAST_OFFSET, interval):
+            for direction, origin, destination in ((1, stations[0], stations[-1]), (0, stations[-1], stations[0])):
+                missions.append(('nl.%d' % (number + direction), series_index, offset, origin, destination))
+                number += 2
+        return number
+
+    number = 1000
+    for line, (stations, minutes, interval) in enumerate(INTERCITY_LINES):
+        station_ids = ['nl.' + code for code in stations]
+        number = add_series('nl.%03d' % line, station_ids, minutes, interval, number)
+        for section, (first, last) in enumerate(zip(station_ids[:-1], station_ids[1:])):
+            between = ['nl.%s%s%d' % (first[3:], last[3:], stop) for stop in range(SPRINTER_STOPS)]
+            number = add_series('nl.%03d%d' % (line, section), [first] + between + [last],
+                                SPRINTER_MINUTES, SPRINTER_INTERVAL, number)
+
+    missions.sort()
+    for mission_id, series_index, offset, origin, destination in missions:
+        columns['mission_id'].append(pool.index(mission_id))
+        columns['mission_series'].append(series_index)
+        columns['mission_offset'].append(offset)
+        for weekday in range(7):
+            columns['mission_origins'].append(pool.index(origin))
+            columns['mission_destinations'].append(pool.index(destination))
+    return pool.strings, columns
+
+
+def main():
+    strings, columns = network_columns()
+    snapshot = TimetableSnapshot(pack_snapshot(strings, columns))
+    start = time.time()
+    planner = NetworkPlanner(snapshot, 0)
+    print 'Planner with %d connections between %d stations built in %.0f ms' % \
+          (len(planner.departures), len(planner.station_ids), 1000 * (time.time() - start))
+
+    generator = random.Random(47)
+    queries = []
+    for index in range(NR_OF_QUERIES):
+        origin, destination = generator.choice(OD_PAIRS)
+        if generator.random() < 0.5:
+            origin, destination = destination, origin
+        queries.append(('nl.' + origin, 'nl.' + destination, generator.randint(FIRST_OFFSET, 21 * 60)))
+
+    durations = []
+    unanswered = 0
+    for origin, destination, minute in queries:
+        start = time.time()
+        legs = planner.journey(origin, destination, minute)
+        durations.append(1000 * (time.time() - start))
+        if legs is None:
+            unanswered += 1
+    durations.sort()
+    median = durations[len(durations) // 2]
+    p95 = durations[int(len(durations) * 0.95)]
+    print '%d queries, %d without journey: median %.2f ms, 95th percentile %.2f ms, maximum %.2f ms' % \
+          (len(durations), unanswered, median, p95, durations[-1])
+    if p95 > TARGET_MS:
+        print 'The 95th percentile exceeds the target of %.0f ms' % TARGET_MS
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
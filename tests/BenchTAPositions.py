@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  BenchTAPositions.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+BenchTAPositions.py measures the time to compute the positions of all running missions,
+on the synthetic network of BenchTAPlanner.py. It needs the same path as the tests.
+"""
+
+import random, sys, time
+
+from TASnapshot         import TimetableSnapshot, pack_snapshot
+from TAPlanner          import NetworkPlanner
+from TAPositions        import PositionEngine
+from BenchTAPlanner     import network_columns
+
+NR_OF_INSTANTS = 100
+
+
+def main():
+    strings, columns = network_columns()
+    planner = NetworkPlanner(TimetableSnapshot(pack_snapshot(strings, columns)), 0)
+    generator = random.Random(48)
+    coordinates = dict((station_id, (generator.uniform(50.8, 53.4), generator.uniform(3.4, 7.2)))
+                       for station_id in planner.station_ids)
+    engine = PositionEngine(planner, coordinates)
+
+    durations = []
+    nr_of_missions = 0
+    for index in range(NR_OF_INSTANTS):
+        minute = generator.uniform(7 * 60, 20 * 60)
+        start = time.time()
+        mission_ids, latitudes, longitudes = engine.positions(minute)
+        durations.append(1000 * (time.time() - start))
+        nr_of_missions = max(nr_of_missions, len(mission_ids))
+    durations.sort()
+    print '%d instants, at most %d running missions: median %.2f ms, maximum %.2f ms' % \
+          (len(durations), nr_of_missions, durations[len(durations) // 2], durations[-1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  BenchTSSpatialIndex.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""
+BenchTSSpatialIndex.py compares the station grid with a full scan, for 400 stations spread over the Netherlands.
+It needs the same path as the tests.
+"""
+
+import random, sys, time
+
+from TSSpatialIndex     import StationGrid, distance_km
+
+NR_OF_STATIONS = 400
+NR_OF_QUERIES = 2000
+
+
+def main():
+    generator = random.Random(49)
+    coordinates = dict(('nl.s%d' % index, (generator.uniform(50.75, 53.45), generator.uniform(3.4, 7.2)))
+                       for index in range(NR_OF_STATIONS))
+    points = [(generator.uniform(50.75, 53.45), generator.uniform(3.4, 7.2)) for index in range(NR_OF_QUERIES)]
+
+    start = time.time()
+    grid = StationGrid(coordinates)
+    print 'Grid of %d stations built in %.1f ms' % (len(grid), 1000 * (time.time() - start))
+
+    start = time.time()
+    for lat, lon in points:
+        grid.nearest(lat, lon, 5)
+    grid_us = 1000000 * (time.time() - start) / NR_OF_QUERIES
+
+    start = time.time()
+    for lat, lon in points:
+        sorted((distance_km(lat, lon, station_lat, station_lon), station_id)
+               for station_id, (station_lat, station_lon) in coordinates.iteritems())[:5]
+    scan_us = 1000000 * (time.time() - start) / NR_OF_QUERIES
+
+    start = time.time()
+    for lat, lon in points:
+        grid.within(lat - 0.1, lon - 0.15, lat + 0.1, lon + 0.15)
+    box_us = 1000000 * (time.time() - start) / NR_OF_QUERIES
+
+    print 'nearest 5: %.0f us with the grid, %.0f us with a full scan; bounding box: %.0f us' % \
+          (grid_us, scan_us, box_us)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
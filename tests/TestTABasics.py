@@ -31,7 +31,8 @@ from google.appengine.ext   import db, testbed
 from ffe.gae                import read_counter, increase_counter, counter_dict
 from ffe.ffe_time           import UTC, CET, mark_utc, mark_cet, utc_from_cet, cet_from_utc
 
-from TABasics               import TAModel
+import TABasics
+from TABasics               import TAModel, LocalCache, cache_read, cache_write, cache_stats, clear_local_caches
 
 class TestFFEModules(unittest.TestCase):
     
@@ -84,6 +85,7 @@ class TestTAModel(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
 
@@ -107,7 +109,7 @@ class TestTAModel(unittest.TestCase):
 
         # Assert object can be memcached:
         object.cache_set()
-        cached_object = memcache.get('nl.test', namespace='TAModel')
+        cached_object = cache_read(TAModel.cache_prefix() + 'nl.test', namespace='TAModel')
         self.assertEqual(cached_object.id, 'nl.test')
 
         # Assert 'get' works for memcached objects:
@@ -122,7 +124,7 @@ class TestTAModel(unittest.TestCase):
         # Assert object can be deleted
         object.delete()
         requested_object = TAModel.get('nl.test')
-        cached_object = memcache.get('nl.test', namespace='TAModel')
+        cached_object = cache_read(TAModel.cache_prefix() + 'nl.test', namespace='TAModel')
         stored_object = db.get(db.Key.from_path('TAModel', 'nl.test'))
         self.assertEqual(requested_object, None)
         self.assertEqual(cached_object, None)
@@ -144,14 +146,99 @@ class TestTAModel(unittest.TestCase):
         self.assertEqual(len(ordered_ids), 10)
         self.assertEqual(ordered_ids[9], 'nl.obj9')
 
-        cached_ids = memcache.get('TAModel_ids')
+        cached_ids = cache_read(TAModel.cache_prefix() + 'TAModel_ids')
         self.assertEqual(cached_ids, ordered_ids)
 
+        batches = list(TAModel.iter_batches(page_size=4, keys_only=True))
+        self.assertEqual([len(keys) for keys in batches], [4, 4, 2])
+        self.assertEqual(list(TAModel.iter_ids(page_size=3)), ordered_ids)
+        self.assertEqual([object.id for object in TAModel.iter_objects(page_size=3)], ordered_ids)
+        self.assertEqual(sorted(TAModel.objects_dictionary().keys()), ordered_ids)
+
+        TAModel.invalidate_cache()
+        self.assertEqual(memcache.get(TAModel.cache_prefix() + 'TAModel_ids'), None,
+                         "Invalidating a kind must invalidate all its memcache keys")
+        self.assertEqual(TAModel.cache_get_multi(['nl.obj1', 'nl.obj2']), {})
+        self.assertEqual(TAModel.get('nl.obj1').id, 'nl.obj1')
+        self.assertEqual(TAModel.cache_get_multi(['nl.obj1', 'nl.obj2']).keys(), ['nl.obj1'])
+
         objects_for_page = TAModel.paginatedObjects(page=2, length=3)
         self.assertEqual(len(objects_for_page), 3)
         first_object = objects_for_page[0]
         self.assertEqual(first_object.id, 'nl.obj3')
 
+    def test_miss_lease(self):
+        object = TAModel.new(code='lease')
+        object.put()
+        key = TAModel.cache_prefix() + 'nl.lease'
+
+        # A request without the lease waits, and fetches the object itself when no other request stores it:
+        object.cache_delete()
+        memcache.add('lease:' + key, 1, namespace='TAModel')
+        self.assertEqual(TAModel.get('nl.lease').id, 'nl.lease')
+
+        # A request without the lease serves a stale copy, when the kind allows that:
+        TAModel.serves_stale = True
+        try:
+            object.cache_set()
+            memcache.delete(key, namespace='TAModel')
+            self.assertEqual(TAModel.get('nl.lease').id, 'nl.lease')
+            self.assertEqual(memcache.get(key, namespace='TAModel'), None,
+                             "A request serving a stale copy must not rebuild the cache")
+
+            # Invalidating the kind retires its stale copies:
+            object.cache_set()
+            TAModel.invalidate_cache()
+            key = TAModel.cache_prefix() + 'nl.lease'
+            memcache.add('lease:' + key, 1, namespace='TAModel')
+            TAModel.get('nl.lease')
+            self.assertNotEqual(memcache.get(key, namespace='TAModel'), None,
+                                "A stale copy of an invalidated kind must not be served")
+        finally:
+            TAModel.serves_stale = False
+
+    def test_cache_layer(self):
+        small_value = {'a': 1}
+        large_value = ['%06d' % index for index in range(50000)]
+        cache_write('small', small_value)
+        cache_write('large', large_value)
+        self.assertEqual(memcache.get('large')[0], 'z', "Large values must be compressed")
+        self.assertEqual(cache_read('small'), small_value)
+        self.assertEqual(cache_read('large'), large_value)
+
+        chunk_size = TABasics.CHUNK_SIZE
+        TABasics.CHUNK_SIZE = 1000
+        try:
+            cache_write('chunked', large_value)
+            envelope = memcache.get('chunked')
+            self.assertEqual(envelope[0], 'c', "Oversized values must be split in chunks")
+            self.assertEqual(cache_read('chunked'), large_value)
+            memcache.delete('chunked#%s#1' % envelope[2])
+            self.assertEqual(cache_read('chunked'), None, "Values with missing chunks must not be provided")
+        finally:
+            TABasics.CHUNK_SIZE = chunk_size
+
+        stats = cache_stats()
+        self.assertTrue(stats['compression_ratio'] > 1.0)
+        self.assertTrue(stats['chunked'] >= 1)
+
+    def test_local_cache(self):
+        cache = LocalCache('TAModel', size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None, "The least recently used object must be evicted")
+        self.assertEqual(cache.get('c'), 3)
+
+        TAModel.invalidate_cache()
+        self.assertEqual(cache.get('a'), None, "Objects must expire when the generation of their kind changes")
+
+        cache.ttl = -1
+        cache.set('d', 4)
+        self.assertEqual(cache.get('d'), None, "Objects must expire after the ttl")
+        self.assertEqual((cache.stats['hits'], cache.stats['misses'], cache.stats['evictions']), (2, 3, 1))
+
     def test_task_creation(self):
 
         object = TAModel.new('nl.obj')
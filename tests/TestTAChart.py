@@ -24,11 +24,14 @@
 
 import logging, unittest, json
 
+from datetime               import datetime, timedelta
 from google.appengine.api   import memcache
 from google.appengine.ext   import db, testbed
 
 from TAScheduledPoint   import TAScheduledPoint, Direction
-from TAChart            import TAChart
+from TAStop             import TAStop
+from TAChart            import TAChart, TAChartShard, ChartTables, Histogram, POINTS_PER_SHARD
+from TABasics           import clear_local_caches
 
 class TestTASeries(unittest.TestCase):
     
@@ -36,6 +39,7 @@ class TestTASeries(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         
         logger = logging.getLogger()
@@ -68,12 +72,12 @@ class TestTASeries(unittest.TestCase):
 
         chart = chart.get('nl.055_201301')
         expected = {
-            'pattern_up': {'nl.dld': {'15': 2, '17': 24, '16': 1}},
+            'pattern_up': {'nl.dld': {15: 2, 17: 24, 16: 1}},
             'platform_up': {'nl.dld': {'1': 2, '3': 1, '5a': 17}},
-            'delay_up': {'nl.dld': {'5.0': 2, '10.0': 1, '1.0': 3, '8.0': 1, '0.0': 14, '7.0': 1, '3.0': 3, '2.0': 1}},
+            'delay_up': {'nl.dld': {5: 2, 10: 1, 1: 3, 8: 1, 0: 14, 7: 1, 3: 3, 2: 1}},
             'platform_down': {'nl.dld': {'8': 11, '12': 1, '7': 12}},
-            'pattern_down': {'nl.dld': {'20': 1, '21': 24, '22': 2}}}
-        result = chart._dataDictionary
+            'pattern_down': {'nl.dld': {20: 1, 21: 24, 22: 2}}}
+        result = chart.tables_dictionary
         self.assertEqual(expected, result,
                          "FRS 11.3.1 TAChart must store operational data of the series.\nExpected: %s\nResult:   %s"
                          % (expected, result))
@@ -89,6 +93,94 @@ class TestTASeries(unittest.TestCase):
         avarage, deviation = chart.delayStats('nl.dld', Direction.up)
         self.assertAlmostEqual(avarage, 1.8846, 4,
                                "FRS 11.5.1 TAChart must provide delay stats")
-        self.assertAlmostEqual(deviation, 3.1234, 4,
+        self.assertAlmostEqual(deviation, 2.8056, 4,
                                "FRS 11.5.1 TAChart must provide delay stats")
 
+        chart.addDelay('nl.dv', Direction.down, -1.5)
+        chart.addDelay('nl.dv', Direction.down, 180.0)
+        self.assertEqual(chart.delayHist('nl.dv', Direction.down).items(), [(-2, 1), (180, 1)],
+                         "Early departures and long delays must be counted as they are")
+        self.assertEqual(chart.delayStats('nl.dv', Direction.down)[0], 89.0)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [7, 3, 5, 5, 4, 5, 9]:
+            histogram.add(value)
+        self.assertEqual(histogram.base, 3)
+        self.assertEqual(histogram.counts.tolist(), [1, 1, 3, 0, 1, 0, 1])
+        self.assertEqual(histogram.total, 7)
+        self.assertEqual(histogram.mode(), (5, 3))
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(100), 9)
+        self.assertAlmostEqual(histogram.mean(), 5.4286, 4)
+        self.assertAlmostEqual(histogram.deviation(), 1.8405, 4)
+
+        other = Histogram.fromRepr([1, 2])
+        histogram.merge(other)
+        self.assertEqual(histogram.repr, [1, 2, 0, 1, 1, 3, 0, 1, 0, 1])
+        self.assertEqual(Histogram().mean(), None)
+        self.assertEqual(Histogram().mode(), (None, 0))
+
+    def test_legacy_chart(self):
+        legacy = {'pattern_up': {'nl.dld': {'15': 2, '17': 24}},
+                  'delay_down': {'nl.dld': {'2.0': 3, '0.0': 8}},
+                  'platform_up': {'nl.dld': {'5a': 17, '3': 1}}}
+        chart = TAChart.new('nl.055_201302')
+        chart._dataDictionary = legacy
+        chart.awake_from_fetch(None)
+        expected = {'pattern_up': {'nl.dld': {15: 2, 17: 24}},
+                    'delay_down': {'nl.dld': {0: 8, 2: 3}},
+                    'platform_up': {'nl.dld': {'5a': 17, '3': 1}}}
+        self.assertEqual(chart.tables_dictionary, expected)
+
+    def test_ingest_series(self):
+        missions = []
+        for number, delay, platform in [(5521, 0.0, '5A'), (5523, 2.5, '5a'), (5525, 0.0, '6-7')]:
+            missions.append(TAMissionStub(number, [('nl.ut', 20, delay, platform), ('nl.zl', 66, 0.0, None)]))
+        chart = TAChart.new('nl.055_201303')
+        chart.ingest_series(None, missions)
+        expected = {'pattern_up': {'nl.ut': {20: 3}, 'nl.zl': {66: 3}},
+                    'delay_up': {'nl.ut': {0: 2, 2: 1}, 'nl.zl': {0: 3}},
+                    'platform_up': {'nl.ut': {'5a': 2}}}
+        self.assertEqual(chart.tables_dictionary, expected)
+
+        chart.put()
+        self.assertEqual(len(db.Query(TAChartShard).fetch(10)), 1)
+
+        chart.add_mission(missions[0])
+        self.assertEqual(chart.histogramForPoint(ChartTables.pattern, 'nl.ut', Direction.up).items(), [(20, 4)])
+
+    def test_sharding(self):
+        chart = TAChart.new('nl.055_201304')
+        point_ids = ['nl.p%d' % index for index in range(POINTS_PER_SHARD + 2)]
+        for point_id in point_ids:
+            chart.addDelay(point_id, Direction.up, 3.0)
+        chart.put()
+        self.assertEqual(len(db.Query(TAChartShard).fetch(10)), 2,
+                         "Chart data must be stored in shards of POINTS_PER_SHARD points")
+
+        memcache.flush_all()
+        chart = TAChart.get('nl.055_201304')
+        self.assertEqual(chart.delayHist(point_ids[-1], Direction.up).items(), [(3, 1)])
+        self.assertEqual(chart._shards.keys(), [1],
+                         "Reading a point must only fetch the shard in which it is stored")
+
+        chart.addDelay(point_ids[-1], Direction.up, 4.0)
+        self.assertEqual(chart.modified_objects, [chart, chart._shards[1]],
+                         "Writing a point must only store the shard in which it is stored")
+
+
+class TAMissionStub(object):
+
+    def __init__(self, number, stops_data):
+        self.offset_cet = datetime(2013, 1, 14, 8, 0)
+        self.stops = []
+        for station_id, minutes, delay, platform in stops_data:
+            stop = TAStop()
+            stop.station_id = station_id
+            stop.mission_id = 'nl.%d' % number
+            stop.departure = self.offset_cet + timedelta(minutes=minutes)
+            stop.delay_dep = delay
+            stop.platform = platform
+            self.stops.append(stop)
+
@@ -36,6 +36,8 @@ from ffe.ffe_time   import now_utc, mark_utc
 from TSStation      import TSStation
 from TASeries       import TASeries
 from TAMission      import TAMission
+from TAScheduledPoint import TAScheduledPoint
+from TABasics       import cache_read, clear_local_caches
 
 class TestTAManager(unittest.TestCase):
     
@@ -45,6 +47,7 @@ class TestTAManager(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
 
@@ -91,7 +94,7 @@ class TestTAManager(unittest.TestCase):
             series.put()
         series_list = TASeries.all_ids()
         self.assertEqual(series_list, test_series_list)
-        series_list = memcache.get('TASeries_ids')
+        series_list = cache_read(TASeries.cache_prefix() + 'TASeries_ids')
         self.assertEqual(series_list, test_series_list)
     
         response = self.testapp.get('/TAManager/new_day')
@@ -130,3 +133,27 @@ class TestTAManager(unittest.TestCase):
 
         output = db.Query(TAMission).filter('series_id =', 'orphan').fetch(1000)
         self.assertEqual(len(output), 0)
+
+    def test_alias_flush(self):
+        TASeries.import_xml('TestTASeries.data/series_313.xml')
+        taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskq.GetTasks('default')
+        self.assertEqual(len(tasks), 1, "Importing series must request a new timetable snapshot")
+        self.assertEqual(tasks[0]['url'], '/TAManager/compile_snapshot')
+        taskq.FlushQueue('default')
+
+        series = TASeries.get('nl.313')
+        TAScheduledPoint.learn_alias(series.point_for_station('nl.ed'), 'Ede-Wag.')
+        tasks = taskq.GetTasks('default')
+        self.assertEqual(len(tasks), 1, "Learning an alias must schedule a flush task")
+        self.assertEqual(tasks[0]['url'], '/TAManager/flush_aliases')
+
+        response = self.testapp.get('/TAManager/flush_aliases')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(TAScheduledPoint.get('nl.313_ed').stationName, 'Ede-Wag.')
+        clear_local_caches()
+        memcache.flush_all()
+        series = TASeries.get('nl.313')
+        self.assertEqual(series.index_for_station('Ede-Wag.'), 6,
+                         "Flushed aliases must be stored with the series timetable")
+
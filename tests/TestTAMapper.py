@@ -0,0 +1,107 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTAMapper.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTAMapper.py contains a series of tests for TAMapper"""
+
+import logging, unittest
+
+from google.appengine.ext   import db, testbed
+
+from TABasics               import TAModel, clear_local_caches
+from TAMapper               import TAMapper, TAMapperJob, JobStatuses, register_mapper, start_mapper, MAX_FAILURES
+
+
+@register_mapper
+class CountingMapper(TAMapper):
+    name = 'test_counting'
+    page_size = 3
+
+    def query(self):
+        return db.Query(TAModel, keys_only=True)
+
+    def process_batch(self, keys):
+        if self.params.get('fail'):
+            raise ValueError('failing batch')
+        self.params['ids'] = self.params.get('ids', []) + [key.name() for key in keys]
+
+    def finish(self):
+        self.params['finished'] = True
+
+
+class TestTAMapper(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+        db.put([TAModel.new(code='obj%d' % index) for index in range(7)])
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_inline_job(self):
+        job = start_mapper('test_counting')
+        self.assertEqual(job.status, JobStatuses.done)
+        self.assertEqual(job.processed, 7)
+        self.assertEqual(job.batches, 3)
+        self.assertEqual(job.params['ids'], ['nl.obj%d' % index for index in range(7)])
+        self.assertTrue(job.params['finished'])
+
+        taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.assertEqual(len(taskq.GetTasks('default')), 0)
+
+    def test_continued_job(self):
+        job = TAMapperJob.new('test_job')
+        job.mapper_name = 'test_counting'
+        job.run_slice(seconds=0)
+        self.assertEqual(job.status, JobStatuses.running)
+
+        taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskq.GetTasks('default')
+        self.assertEqual(len(tasks), 1)
+        self.assertTrue(tasks[0]['url'].startswith('/TAManager/run_mapper'))
+
+        job = TAMapperJob.get('test_job')
+        while job.status == JobStatuses.running:
+            job.run_slice(seconds=0)
+        self.assertEqual(job.processed, 7)
+        self.assertEqual(job.params['ids'], ['nl.obj%d' % index for index in range(7)],
+                         "A continued job must proceed from its checkpoint")
+
+    def test_failing_job(self):
+        job = start_mapper('test_counting', fail=True)
+        self.assertEqual(job.status, JobStatuses.running)
+        self.assertEqual(job.failures, 1)
+        self.assertEqual(job.processed, 0)
+        self.assertTrue(job.last_error.startswith('ValueError'))
+
+        for attempt in range(MAX_FAILURES):
+            job.run_slice()
+        self.assertEqual(job.status, JobStatuses.failed)
+        self.assertEqual(job.failures, MAX_FAILURES)
@@ -37,10 +37,12 @@ from google.appengine.ext   import testbed
 from ffe.gae            import read_counter
 from ffe.ffe_time       import mark_cet, now_cet
 from TASeries           import TASeries, SERIES_URL_SCHEMA
-from TAMission          import TAMission, MissionStatuses
+from TAMission          import TAMission, MissionStatuses, MissionTiming, live_statistics, live_delays, \
+                               sweep_tallies
 from TSStation          import TSStation
-from TAStop             import StopStatuses
+from TAStop             import TAStop, StopStatuses
 from TAScheduledPoint   import Direction
+from TABasics           import clear_local_caches
 
 class TestTAMission(unittest.TestCase):
 
@@ -50,6 +52,7 @@ class TestTAMission(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
 
@@ -76,6 +79,15 @@ class TestTAMission(unittest.TestCase):
         response = self.missionApp.get('/TAMission')
         self.assertEqual(response.body, '["nl.2641", "nl.2642", "nl.2643"]')
 
+        # Stream the xml catalog:
+        parts = list(TAMission.iter_xml_catalog(page_size=2))
+        self.assertEqual(len(parts), 4, "The catalog must be written in one part per batch between the root tags")
+        self.assertTrue(parts[0].endswith('<TAMission>\n'))
+        self.assertEqual(parts[-1], '</TAMission>\n')
+        self.assertEqual(''.join(parts).count('<mission '), 3)
+        response = self.missionApp.get('/TAMission?format=xml')
+        self.assertEqual(response.body, ''.join(parts))
+
     def test_mission_basics(self):
 
         # Create series
@@ -83,7 +95,7 @@ class TestTAMission(unittest.TestCase):
         series_d14.put()
         series123 = TASeries.new('nl.123')
         series123.put()
-        memcache.delete('nl.123', namespace='TASeries')
+        series123.cache_delete()
 
         # Create international train
         mission241 = TAMission.get('eu.241', create=True)
@@ -296,6 +308,85 @@ class TestTAMission(unittest.TestCase):
         self.assertEqual(MissionStatuses.s[status], 'arrived')
         self.assertEqual(delay, 0)
 
+        # The cached status must follow changes in the stops
+        now = mark_cet(datetime(2013,2,19,14,30))
+        next_stop = mission.stops[mission.next_stop_index(now)]
+        next_stop.delay_dep = 3.0
+        self.assertEqual(mission.status_at_time(now), (MissionStatuses.running, 3.0))
+        next_stop.status = StopStatuses.canceled
+        self.assertEqual(mission.status_at_time(now), (MissionStatuses.canceled, 3.0))
+
+    def test_mission_timing(self):
+        stops = []
+        for station_id, minutes, delay in (('nl.ut', 0, 0.0), ('nl.ht', 20, 12.0), ('nl.bd', 40, 2.0), ('nl.rsd', 50, 0.0)):
+            stop = TAStop()
+            stop.station_id = station_id
+            stop.arrival = mark_cet(datetime(2013, 2, 19, 14, minutes))
+            stop.departure = stop.arrival + timedelta(minutes=1)
+            stop.delay_dep = delay
+            stops.append(stop)
+        timing = MissionTiming(stops)
+        self.assertEqual(timing.station_index['nl.bd'], 2)
+        self.assertEqual(timing.departure, [0, 1200, 2400, 3000])
+        self.assertEqual(timing.next_index(mark_cet(datetime(2013, 2, 19, 14, 0))), 0)
+        self.assertEqual(timing.next_index(mark_cet(datetime(2013, 2, 19, 14, 30))), 1)
+        self.assertEqual(timing.next_index(mark_cet(datetime(2013, 2, 19, 14, 40))), 2)
+        self.assertEqual(timing.next_index(mark_cet(datetime(2013, 2, 19, 15, 0))), None)
+        timing.set_delay(1, 0.0)
+        self.assertEqual(timing.next_index(mark_cet(datetime(2013, 2, 19, 14, 30))), 2)
+
+        mission = TAMission.new('nl.1234')
+        mission.insert_stops([stops[2], stops[3]])
+        mission.insert_stops([stops[1], stops[0]])
+        self.assertEqual([stop.station_id for stop in mission.stops], ['nl.ut', 'nl.ht', 'nl.bd', 'nl.rsd'])
+        mission.insert_stops([stops[1]])
+        self.assertEqual([stop.station_id for stop in mission.stops], ['nl.ut', 'nl.ht', 'nl.ht', 'nl.bd', 'nl.rsd'],
+                         "Stops must be inserted in order of departure")
+        self.assertEqual(mission.index_for_stop(stops[2]), 3)
+
+    def test_live_statistics(self):
+        TSStation.update_stations('TestTAMission.data/stations.xml')
+        TASeries.import_xml('TestTAMission.data/series.xml')
+
+        mission = TAMission.get('nl.3046')
+        mission.activate_mission(mark_cet(datetime(2013, 2, 19, 2)))
+        mission.put()
+        self.assertEqual(live_statistics(mark_cet(datetime(2013, 2, 19, 3, 30))),
+                         {'status': {'inactive': 1}, 'delay': {}})
+
+        now = mark_cet(datetime(2013, 2, 19, 14, 30))
+        taskq = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        live_statistics(now)
+        self.assertTrue([task for task in taskq.GetTasks('default') if task['url'] == '/TAManager/sweep_tallies'],
+                        "Reading the statistics must request a sweep of the windows that have passed")
+        sweep_tallies(now)
+        self.assertEqual(live_statistics(now), {'status': {'running': 1}, 'delay': {'0': 1}},
+                         "A mission must be counted again when its status changes without updates")
+
+        mission = TAMission.get('nl.3046')
+        mission.tally_entry = None
+        mission.tally(now)
+        self.assertEqual(live_statistics(now), {'status': {'running': 1}, 'delay': {'0': 1}},
+                         "A mission that is tallied again must not be counted twice")
+
+        next_stop = mission.stops[mission.next_stop_index(now)]
+        next_stop.delay_dep = 3.0
+        mission.tally(now)
+        mission.put()
+        self.assertEqual(live_statistics(now), {'status': {'running': 1}, 'delay': {'3': 1}},
+                         "A changed delay must move the mission to another bucket")
+        self.assertEqual(live_delays(date(2013, 2, 19), now),
+                         {'nl.3046': {next_stop.station_id: (next_stop.delay_arr, 3.0)}})
+
+        later = mark_cet(datetime(2013, 2, 19, 16, 0))
+        sweep_tallies(later)
+        self.assertEqual(live_statistics(later), {'status': {'arrived': 1}, 'delay': {}})
+        self.assertEqual(live_delays(date(2013, 2, 19), later), {})
+
+        memcache.flush_all()
+        self.assertEqual(live_statistics(later), {'status': {'arrived': 1}, 'delay': {}},
+                         "Counters that were lost from memcache must be counted again from the datastore")
+
     def test_discover_mission(self):
         # Load sample data:
         TSStation.update_stations('TestTAMission.data/stations.xml')
@@ -318,7 +409,7 @@ class TestTAMission(unittest.TestCase):
         for stop in mission_orphan.stops:
             self.assertEqual(stop.status, StopStatuses.announced,       "FRS 10.6.4 Updated stops must get 'announced' as status")
 
-        memcache.delete('nl.9046', namespace='TAMission')
+        TAMission.cache_delete_multi(['nl.9046'])
         mission_orphan = TAMission.get('nl.9046')
         self.assertEqual(len(mission_orphan.stops), 3,      "FRS 10.6.5 After significant changes, missions must be stored in the datastore")
 
@@ -380,7 +471,7 @@ class TestTAMission(unittest.TestCase):
         self.assertEqual(mission_44.stops[1].status, StopStatuses.announced)
 
         # FRS 10.7.6 Update from planned to announced may not cause datastore put
-        memcache.delete('nl.3044', namespace='TAMission')
+        TAMission.cache_delete_multi(['nl.3044'])
         mission_44 = TAMission.get('nl.3044')
         self.assertEqual(len(mission_44.stops), 5)
         self.assertEqual(mission_44.stops[1].station_id, 'nl.ed')
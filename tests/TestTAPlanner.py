@@ -0,0 +1,87 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTAPlanner.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTAPlanner.py contains a series of tests for TAPlanner"""
+
+import logging, unittest
+
+from datetime               import timedelta
+from google.appengine.ext   import testbed
+
+from ffe.ffe_time           import cet_from_string
+from TASeries               import TASeries
+from TASnapshot             import TimetableSnapshot, compile_snapshot, store_snapshot
+from TAPlanner              import NetworkPlanner, plan_journeys
+from TABasics               import clear_local_caches
+
+
+class TestTAPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+        TASeries.import_xml('TestTASeries.data/series_005.xml')
+        TASeries.import_xml('TestTASeries.data/series_020.xml')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_journeys(self):
+        snapshot = TimetableSnapshot(compile_snapshot())
+        planner = NetworkPlanner(snapshot, 3)
+        self.assertEqual(planner.journey('nl.rtd', 'nl.gn', 7 * 60),
+                         [('nl.523', 'nl.rtd', 425, 'nl.gn', 584)],
+                         "A direct mission must be planned without transfers")
+        self.assertEqual(planner.journey('nl.gvc', 'nl.gn', 8 * 60),
+                         [('nl.2029', 'nl.gvc', 489, 'nl.ut', 526), ('nl.527', 'nl.ut', 530, 'nl.gn', 644)],
+                         "A journey must transfer to the next mission that can be reached")
+        self.assertEqual(planner.journey('nl.gvc', 'nl.xx', 8 * 60), None)
+
+        planner = NetworkPlanner(snapshot, 3, {'nl.ut': 5})
+        self.assertEqual(planner.journey('nl.gvc', 'nl.gn', 8 * 60)[1],
+                         ('nl.531', 'nl.ut', 590, 'nl.gn', 704),
+                         "A transfer must take the transfer time of the station")
+
+        planner = NetworkPlanner(snapshot, 3)
+        delays = {'nl.2029': {'nl.gd': (2.0, 2.0), 'nl.ut': (2.0, 0.0)}}
+        self.assertEqual(planner.journey('nl.gvc', 'nl.gn', 8 * 60, delays),
+                         [('nl.2029', 'nl.gvc', 489, 'nl.ut', 528.0), ('nl.531', 'nl.ut', 590, 'nl.gn', 704)],
+                         "A delayed mission must be planned with its delays")
+
+    def test_plan_journeys(self):
+        start_time = cet_from_string('2013-05-16T08:00:00')
+        self.assertEqual(plan_journeys('nl.gvc', 'nl.gn', start_time, timedelta(hours=1)), None,
+                         "Journeys are not available before a snapshot was compiled")
+
+        store_snapshot(compile_snapshot())
+        journeys = plan_journeys('nl.gvc', 'nl.gn', start_time, timedelta(hours=1))
+        self.assertEqual([[leg[0] for leg in legs] for legs in journeys],
+                         [['nl.2029', 'nl.527'], ['nl.2031', 'nl.531']])
+        self.assertEqual(journeys[0][1][4], start_time.replace(hour=10, minute=44))
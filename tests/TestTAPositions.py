@@ -0,0 +1,121 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTAPositions.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTAPositions.py contains a series of tests for TAPositions"""
+
+import logging, unittest
+
+from google.appengine.ext   import testbed
+
+from ffe.ffe_time           import cet_from_string
+from TASeries               import TASeries
+from TASnapshot             import TimetableSnapshot, compile_snapshot, store_snapshot
+from TAPlanner              import NetworkPlanner
+from TAPositions            import PositionEngine, mission_positions
+from TSNetwork              import NetworkGraph
+from TSStation              import TSStation
+from TSStationPosition      import TSStationPosition
+from TABasics               import clear_local_caches
+
+COORDINATES = {'nl.rtd': (51.925, 4.469), 'nl.ut': (52.089, 5.110), 'nl.zl': (52.505, 6.091), 'nl.gn': (53.211, 6.565)}
+
+
+class TestTAPositions(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+        TASeries.import_xml('TestTASeries.data/series_005.xml')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_positions(self):
+        planner = NetworkPlanner(TimetableSnapshot(compile_snapshot()), 3)
+        engine = PositionEngine(planner, COORDINATES)
+
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 24)
+        positions = dict(zip(mission_ids, zip(latitudes, longitudes)))
+        self.assertEqual(positions['nl.523'], (52.007, 4.7895),
+                         "A running mission must be placed between its previous and next stop")
+        self.assertTrue('nl.524' in positions)
+
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 45)
+        positions = dict(zip(mission_ids, zip(latitudes, longitudes)))
+        self.assertEqual(positions['nl.523'], COORDINATES['nl.ut'],
+                         "A mission that halts must be placed at its station")
+
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 24, {'nl.523': {'nl.rtd': (0.0, 19.0)}})
+        positions = dict(zip(mission_ids, zip(latitudes, longitudes)))
+        self.assertEqual(positions['nl.523'], COORDINATES['nl.rtd'],
+                         "A delayed mission must be placed with its delays")
+
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 24, {'nl.523': {'nl.rtd': (0.0, 30.0)}})
+        self.assertFalse('nl.523' in mission_ids, "A mission with a delayed departure must not be placed on schedule")
+
+        mission_ids, latitudes, longitudes = engine.positions(9 * 60 + 50)
+        self.assertFalse('nl.523' in mission_ids, "A mission that arrived must not be placed")
+
+    def test_positions_along_network(self):
+        planner = NetworkPlanner(TimetableSnapshot(compile_snapshot()), 3)
+        coordinates = dict(COORDINATES)
+        coordinates['nl.gd'] = (52.017, 4.704)
+        network = NetworkGraph({'nl.rtut': [(0.0, 'nl.rtd'), (20.0, 'nl.gd'), (56.0, 'nl.ut')]}, coordinates)
+        engine = PositionEngine(planner, COORDINATES, network)
+
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 24)
+        positions = dict(zip(mission_ids, zip(latitudes, longitudes)))
+        self.assertEqual(positions['nl.523'], (52.033, 4.79422),
+                         "A running mission must be placed by km along the railway between its stops")
+        mission_ids, latitudes, longitudes = engine.positions(7 * 60 + 45)
+        positions = dict(zip(mission_ids, zip(latitudes, longitudes)))
+        self.assertEqual(positions['nl.523'], COORDINATES['nl.ut'])
+
+    def test_mission_positions(self):
+        for station_id, coordinate in COORDINATES.iteritems():
+            station = TSStation.new(station_id)
+            position = station.create_position('xx00')
+            position.coordinate = coordinate
+            station.put()
+            position.put()
+        self.assertEqual(mission_positions(cet_from_string('2013-05-16T07:24:00')), None,
+                         "Positions are not available before a snapshot was compiled")
+
+        store_snapshot(compile_snapshot())
+        result = mission_positions(cet_from_string('2013-05-16T07:24:00'))
+        self.assertEqual(result['now'], '2013-05-16T07:24:00')
+        self.assertEqual(len(result['ids']), len(result['lat']))
+        self.assertTrue('nl.523' in result['ids'])
+
+        position = TSStation.new('nl.rtd').create_position('xx00')
+        position.coordinate = (51.9, 4.5)
+        position.put()
+        self.assertEqual(TSStationPosition.station_coordinates()['nl.rtd'], (51.9, 4.5),
+                         "A moved position must not leave stale coordinates")
@@ -32,6 +32,7 @@ from google.appengine.ext   import db, testbed
 from ffe.gae                import read_counter
 import TAPublic
 from TASeries import TASeries
+from TABasics import clear_local_caches
 
 class TestTAPublic(unittest.TestCase):
     
@@ -41,6 +42,7 @@ class TestTAPublic(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         
         logger = logging.getLogger()
@@ -0,0 +1,89 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTARollup.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTARollup.py contains a series of tests for TARollup"""
+
+import logging, unittest
+
+from google.appengine.ext   import testbed
+
+from TAScheduledPoint   import Direction
+from TAChart            import TAChart, ChartTables
+from TARollup           import TARollup, ROLLING_WEEKS, summary_from_items, add_summaries, statistics
+from TABasics           import clear_local_caches
+
+class TestTARollup(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_summaries(self):
+        summary = summary_from_items([(0, 2), (2, 1), (5, 1)])
+        self.assertEqual(summary, [4, 7, 29, 3])
+        self.assertEqual(summary_from_items([]), None)
+        self.assertEqual(add_summaries(summary, None), summary)
+        self.assertEqual(add_summaries(summary, [1, 1, 1, 0]), [5, 8, 30, 3])
+        stats = statistics(summary)
+        self.assertEqual(stats['count'], 4)
+        self.assertAlmostEqual(stats['mean'], 1.75, 4)
+        self.assertAlmostEqual(stats['deviation'], 2.0463, 4)
+        self.assertAlmostEqual(stats['punctuality'], 0.75, 4)
+        self.assertEqual(statistics(None)['mean'], None)
+
+    def test_days(self):
+        rollup = TARollup.new('nl.055')
+        delays = [{}, {}, {}, {0: 3, 4: 1}, {}, {}]
+        rollup.add_day('2013-01-15', {'nl.ut': delays})
+        rollup.add_day('2013-01-14', {'nl.ut': delays, 'nl.zl': delays})
+        rollup.add_day('2013-01-15', {'nl.ut': [{}, {}, {}, {1: 2}, {}, {}]})
+        trend = rollup.trend('nl.ut', Direction.up, 'days')
+        self.assertEqual([label for label, stats in trend], ['2013-01-14', '2013-01-15'])
+        self.assertEqual(trend[1][1]['count'], 2, 'Adding a day twice must replace its summaries')
+        self.assertEqual(rollup.trend('nl.ut', Direction.down, 'days')[0][1]['count'], 0)
+
+    def test_rolling(self):
+        rollup = TARollup.new('nl.055')
+        for week in range(1, ROLLING_WEEKS + 3):
+            chart = TAChart.new('nl.055_2013%02d' % week)
+            chart.addDelay('nl.ut', Direction.up, float(week))
+            rollup.add_week(chart)
+        trend = rollup.trend('nl.ut', Direction.up)
+        self.assertEqual(len(trend), ROLLING_WEEKS + 2)
+        self.assertEqual(trend[0][0], '201301')
+        stats = rollup.rolling_statistics('nl.ut', Direction.up)
+        self.assertEqual(stats['count'], ROLLING_WEEKS, 'Rolling summaries must only cover the last weeks')
+        self.assertAlmostEqual(stats['mean'], 8.5, 4)
+        self.assertEqual(rollup.rolling_statistics('nl.zl', Direction.up)['count'], 0)
+
+        rollup.put()
+        rollup = TARollup.get('nl.055')
+        self.assertEqual(rollup.rolling_statistics('nl.ut', Direction.up)['count'], ROLLING_WEEKS)
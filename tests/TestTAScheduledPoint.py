@@ -27,6 +27,7 @@ from google.appengine.api   import memcache
 from google.appengine.ext   import db, testbed
 from TAScheduledPoint import TAScheduledPoint, Direction
 from TASeries import TASeries
+from TABasics import clear_local_caches, kind_generation
 
 
 class TestTAScheduledPoint(unittest.TestCase):
@@ -35,6 +36,7 @@ class TestTAScheduledPoint(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
 
@@ -107,5 +109,14 @@ class TestTAScheduledPoint(unittest.TestCase):
         expected = ['nl.030', 'nl.035', 'nl.036']
         ah_ids = TAScheduledPoint.series_ids_at_station('nl.ah')
         self.assertEqual(expected, ah_ids)
-        cached_ids = memcache.get('series_ids@nl.ah')
-        self.assertEqual(cached_ids, expected)
\ No newline at end of file
+        generation = kind_generation('TAStationIndex')
+        cached_index = memcache.get('station_index_%s' % generation)
+        self.assertEqual(cached_index['nl.ah'], expected)
+        self.assertEqual(TAScheduledPoint.series_ids_at_station('nl.ut'), [])
+
+        point5 = TAScheduledPoint.new_with('nl.037', 'nl.ah')
+        point5.put()
+        TAScheduledPoint.invalidate_station_index()
+        self.assertNotEqual(kind_generation('TAStationIndex'), generation)
+        self.assertEqual(TAScheduledPoint.series_ids_at_station('nl.ah'), expected + ['nl.037'],
+                         "Invalidating the station index must cause a rebuild")
\ No newline at end of file
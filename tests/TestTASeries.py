@@ -36,6 +36,7 @@ from TSStation          import TSStation
 from TAMission          import TAMission
 from TAStop             import TAStop
 from TAChart            import TAChart
+from TABasics           import clear_local_caches
 
 class TestTASeries(unittest.TestCase):
     
@@ -44,6 +45,7 @@ class TestTASeries(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
         
@@ -100,6 +102,35 @@ class TestTASeries(unittest.TestCase):
         self.assertEqual(series.index_for_station('nonExistant'), None,
                          "FRS 9.4.7 TASeries must return None when a point or index cannot be found")
     
+    def test_packed_points(self):
+        TASeries.import_xml('TestTASeries.data/series_313.xml')
+        series = TASeries.get('nl.313')
+        expected = [(point.station_id, point.km, point.stationName, point.scheduled_times, point.platform_list)
+                    for point in series.points]
+        memcache.flush_all()
+        clear_local_caches()
+        series = TASeries.get('nl.313')
+        self.assertNotEqual(series._timetable, None)
+        result = [(point.station_id, point.km, point.stationName, point.scheduled_times, point.platform_list)
+                  for point in series.points]
+        self.assertEqual(result, expected,
+                         "TASeries must provide its points from the timetable stored with the series")
+
+        series._timetable = None
+        db.put(series)
+        memcache.flush_all()
+        series = TASeries.get('nl.313')
+        self.assertEqual(len(series.points), len(expected))
+        self.assertEqual(db.get(series.key())._timetable, None,
+                         "Reading the points must not store the series")
+
+        series.delete_point('nl.bnc')
+        memcache.flush_all()
+        clear_local_caches()
+        series = TASeries.get('nl.313')
+        self.assertEqual(len(series.points), 6)
+        self.assertEqual(series.index_for_station('nl.bnc'), None)
+
     def test_new_day(self):
         """
         FRS 9.5 Activating new day
@@ -149,13 +180,13 @@ class TestTASeries(unittest.TestCase):
 
         chart = TAChart.get('nl.020_201320')
         expected = {
-            'pattern_up': {'nl.gvc': {'9': 2}, 'nl.gd': {'30': 2}, 'nl.ut': {'46': 2}},
-            'pattern_down': {'nl.gd': {'35': 11}, 'nl.gvc': {'52': 11}, 'nl.ut': {'14': 11}},
-            'delay_up': {'nl.gvc': {'0.0': 2}, 'nl.gd': {'2.0': 2}, 'nl.ut': {'0.0': 2}},
-            'delay_down': {'nl.gd': {'0.0': 8, '2.0': 3}, 'nl.gvc': {'0.0': 11}, 'nl.ut': {'0.0': 11}},
-            'platform_up': {'nl.gvc': {'5': 2}, 'nl.gd': {'4': 2}, 'nl.ut': {}},
-            'platform_down': {'nl.gd': {'8': 10, '10': 1}, 'nl.gvc': {}, 'nl.ut': {'9': 11}}}
-        result = chart._dataDictionary
+            'pattern_up': {'nl.gvc': {9: 2}, 'nl.gd': {30: 2}, 'nl.ut': {46: 2}},
+            'pattern_down': {'nl.gd': {35: 11}, 'nl.gvc': {52: 11}, 'nl.ut': {14: 11}},
+            'delay_up': {'nl.gvc': {0: 2}, 'nl.gd': {2: 2}, 'nl.ut': {0: 2}},
+            'delay_down': {'nl.gd': {0: 8, 2: 3}, 'nl.gvc': {0: 11}, 'nl.ut': {0: 11}},
+            'platform_up': {'nl.gvc': {'5': 2}, 'nl.gd': {'4': 2}},
+            'platform_down': {'nl.gd': {'8': 10, '10': 1}, 'nl.ut': {'9': 11}}}
+        result = chart.tables_dictionary
         self.assertEqual(expected, result,
                          "FRS 9.5.1 Data over the past day must be processed in a chart.\nExpected: %s\nResult:   %s"
                          % (expected, result))
@@ -180,7 +211,7 @@ class TestTASeries(unittest.TestCase):
         self.assertEqual(response.status, '200 OK')
         series = TASeries.get('nl.020')
         self.assertEqual(len(series.points), 2)
-        tasks = taskq.GetTasks('default')
+        tasks = [task for task in taskq.GetTasks('default') if task['url'] != '/TAManager/compile_snapshot']
         self.assertEqual(len(tasks), 13)
 
     def test_mission_management(self):
@@ -210,6 +241,7 @@ class TestTASeries(unittest.TestCase):
         self.assertEqual(expected, result,
                          "FRS 9.6.4 TASeries must provide its current missions.\nExpected: %s\nResult:   %s"
                          % (expected, result))
+        self.assertEqual(series.current_mission_numbers(Direction.down, now), [528, 532, 536])
         searchStart = datetime(2011, 1, 11, 8, 8)
         searchSpan = timedelta(hours=2)
         expected = [(datetime(2011, 1, 11, 8, 50), 'nl.527'),
@@ -254,6 +286,13 @@ class TestTASeries(unittest.TestCase):
                          "FRS 9.7.2 TASeries must be able to change offset times.\nExpected: %s\nResult:   %s"
                          % (expected, result))
 
+        memcache.flush_all()
+        clear_local_caches()
+        series = TASeries.get('nl.370')
+        self.assertNotEqual(series._missionData, None)
+        self.assertEqual(series.offset_overview, expected,
+                         "TASeries must store its mission lists with the series")
+
     def update_stops_from_file(self, filename):
         stops_file = open(filename, 'r')
         array = json.load(stops_file)
@@ -0,0 +1,74 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTASnapshot.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTASnapshot.py contains a series of tests for TASnapshot"""
+
+import logging, unittest
+
+from google.appengine.api   import memcache
+from google.appengine.ext   import testbed
+
+from TASeries               import TASeries
+from TAMission              import TAMission
+from TASnapshot             import TimetableSnapshot, compile_snapshot, store_snapshot, load_snapshot
+from TABasics               import clear_local_caches
+
+
+class TestTASnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_snapshot(self):
+        TASeries.import_xml('TestTASeries.data/series_005.xml')
+        series = TASeries.get('nl.005')
+        snapshot = TimetableSnapshot(compile_snapshot())
+        self.assertEqual(snapshot.series_ids(), ['nl.005'])
+
+        result = snapshot.series('nl.005')
+        self.assertEqual([(point[0], point[3]) for point in result['points']],
+                         [(point.station_id, point.scheduled_times) for point in series.points],
+                         "The snapshot must provide the points of a series")
+        self.assertEqual(snapshot.series('nl.006'), None)
+
+        mission = TAMission.get('nl.527')
+        result = snapshot.mission('nl.527')
+        self.assertEqual(result['series_id'], 'nl.005')
+        self.assertEqual(result['offset'], mission.offset_time.hour * 60 + mission.offset_time.minute)
+        self.assertEqual(result['od_ids'], [mission.get_odIDs_for_weekday(weekday) for weekday in range(7)])
+        self.assertEqual(snapshot.mission('nl.526'), None)
+
+        store_snapshot(compile_snapshot())
+        memcache.flush_all()
+        self.assertEqual(load_snapshot().mission('nl.527'), result,
+                         "A stored snapshot must be loaded from the datastore")
@@ -28,8 +28,9 @@ from datetime import datetime
 from google.appengine.api import memcache
 from google.appengine.ext import ndb, testbed
 
-from TAStop import TAStop, StopStatuses, NSRespondsWithError
+from TAStop import TAStop, StopStatuses, NSRespondsWithError, names_for_station_ids
 from TSStation import TSStation
+from TABasics import clear_local_caches
 
 
 class TestTAStop(unittest.TestCase):
@@ -37,6 +38,7 @@ class TestTAStop(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub()
 
@@ -98,6 +100,21 @@ class TestTAStop(unittest.TestCase):
         stop.alteredDestination = 'Roosendaal'
         self.assertEqual(stop.real_destination, 'Roosendaal')
 
+    def test_station_names(self):
+        for code, name in (('asd', 'Amsterdam Centraal'), ('ut', 'Utrecht Centraal')):
+            station = TSStation.new('nl.%s' % code)
+            station.name = name
+            station.put()
+        names = names_for_station_ids(['nl.asd', 'nl.ut', 'nl.xxx'])
+        self.assertEqual(names, {'nl.asd': 'Amsterdam Centraal', 'nl.ut': 'Utrecht Centraal'})
+
+        stop = TAStop()
+        stop.station_id = 'nl.ut'
+        self.assertEqual(stop.station_name, 'Utrecht Centraal')
+
+        clear_local_caches()
+        self.assertEqual(names_for_station_ids(['nl.asd']), {'nl.asd': 'Amsterdam Centraal'})
+
     def test_stops_importer(self):
         station_stub = StationStub()
 
@@ -0,0 +1,107 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTSNetwork.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTSNetwork.py contains a series of tests for TSNetwork"""
+
+import logging, unittest
+
+from google.appengine.api   import memcache
+from google.appengine.ext   import ndb, testbed
+
+from TSStation              import TSStation
+from TSJunction             import TSJunction
+from TSNetwork              import NetworkGraph, network_graph
+from TABasics               import clear_local_caches, GENERATIONS_NAMESPACE
+
+# route_code > list of (station_code, km)
+POSITIONS = {'ht01': [('asd', 0.0), ('ut', 40.0), ('ht', 90.0)],
+             'zl02': [('ut', 0.0), ('amf', 20.0), ('zl', 90.0)],
+             'nm03': [('nm', 50.0)],
+             'xx00': [('xyz', 0.0)]}
+
+
+class TestTSNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def put_network(self):
+        for route_code, positions in POSITIONS.iteritems():
+            for station_code, km in positions:
+                position = TSStation.new('nl.' + station_code).create_position(route_code)
+                position.km = km
+                position.put()
+        junction = TSJunction.new('nl.j_001')
+        junction.route1_key = ndb.Key('TSRoute', 'nl.ht01')
+        junction.km1 = 60.0
+        junction.route2_key = ndb.Key('TSRoute', 'nl.nm03')
+        junction.km2 = 0.0
+        junction.put()
+
+    def test_graph(self):
+        graph = NetworkGraph({'nl.ab01': [(10.0, 'nl.b'), (0.0, 'nl.a'), (25.0, 'nl.c')],
+                              'nl.cd02': [(0.0, 'nl.a'), (30.0, 'nl.c')]})
+        self.assertEqual(graph.shortest_path('nl.a', 'nl.c'), (25.0, ['nl.a', 'nl.b', 'nl.c']))
+        self.assertEqual(graph.distance('nl.c', 'nl.b'), 15.0)
+        self.assertEqual(graph.distances_from('nl.b', max_km=12.0), {'nl.b': 0.0, 'nl.a': 10.0})
+        self.assertEqual(graph.distance('nl.a', 'nl.x'), None)
+
+    def test_network_graph(self):
+        self.put_network()
+        graph = network_graph()
+        self.assertEqual(graph.shortest_path('nl.asd', 'nl.zl'), (130.0, ['nl.asd', 'nl.ut', 'nl.amf', 'nl.zl']),
+                         "Routes must be linked at the stations they share")
+        self.assertEqual(graph.shortest_path('nl.asd', 'nl.nm'), (110.0, ['nl.asd', 'nl.ut', 'nl.j_001', 'nl.nm']),
+                         "Routes must be linked at their junctions")
+        self.assertEqual(graph.distance('nl.ht', 'nl.nm'), 80.0)
+        self.assertEqual(graph.distance('nl.asd', 'nl.xyz'), None,
+                         "Stations without a known route must not be linked")
+        self.assertTrue(network_graph() is graph, "The graph must be kept while the network does not change")
+
+        position = TSStation.new('nl.amf').create_position('nm03')
+        position.km = 5.0
+        position.put()
+        self.assertEqual(network_graph().shortest_path('nl.asd', 'nl.nm'),
+                         (105.0, ['nl.asd', 'nl.ut', 'nl.amf', 'nl.nm']),
+                         "The graph must be compiled again after the network changed")
+
+    def test_batched_bumps(self):
+        self.put_network()
+        network_graph()
+        generation = memcache.get('TSNetwork', namespace=GENERATIONS_NAMESPACE)
+        station = TSStation.new('nl.ut')
+        station.update_positions([{'route': 'nl.ht01', 'km': 41.0, 'lat': 52.089, 'lon': 5.110},
+                                  {'route': 'nl.zl02', 'km': 1.0, 'lat': 52.089, 'lon': 5.110},
+                                  {'route': 'nl.nm03', 'km': 10.0, 'lat': 52.089, 'lon': 5.110}])
+        self.assertEqual(memcache.get('TSNetwork', namespace=GENERATIONS_NAMESPACE), generation + 1,
+                         "A batch of positions must bump the network generation once")
+        self.assertEqual(network_graph().distance('nl.asd', 'nl.ut'), 41.0)
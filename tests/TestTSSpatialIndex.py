@@ -0,0 +1,89 @@
+# coding=utf-8
+#
+#  Copyright (c) 2013-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  TestTSSpatialIndex.py
+#  firstflamingo/treinenaapje
+#
+#  Created by Berend Schotanus on 19-Oct-15.
+#
+
+"""TestTSSpatialIndex.py contains a series of tests for TSSpatialIndex"""
+
+import logging, random, unittest
+
+from google.appengine.ext   import testbed
+
+from TSStation              import TSStation
+from TSSpatialIndex         import StationGrid, station_grid, distance_km
+from TABasics               import clear_local_caches, bump_generation
+
+COORDINATES = {'nl.asd': (52.379, 4.900), 'nl.asdz': (52.339, 4.873), 'nl.ut': (52.089, 5.110),
+               'nl.utt': (52.104, 5.122), 'nl.rtd': (51.925, 4.469), 'nl.gvc': (52.081, 4.325),
+               'nl.ehv': (51.443, 5.481), 'nl.gn': (53.211, 6.565), 'nl.mt': (50.850, 5.706)}
+
+
+class TestTSSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
+        self.testbed.init_memcache_stub()
+
+        logger = logging.getLogger()
+        logger.level = logging.DEBUG
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_nearest(self):
+        grid = StationGrid(COORDINATES)
+        self.assertEqual([station_id for distance, station_id in grid.nearest(52.09, 5.11, 2)], ['nl.ut', 'nl.utt'])
+        self.assertEqual(grid.nearest(52.09, 5.11, 3, max_km=5.0)[-1][1], 'nl.utt',
+                         "Stations beyond max_km must not be provided")
+        self.assertEqual(grid.nearest(40.0, -3.7)[0][1], 'nl.mt',
+                         "A point far outside the grid must find the nearest station")
+        self.assertEqual(grid.nearest(52.09, 5.11, 0), [])
+        self.assertEqual(StationGrid({}).nearest(52.09, 5.11), [])
+
+        generator = random.Random(49)
+        for attempt in range(100):
+            lat, lon = generator.uniform(50.7, 53.5), generator.uniform(3.3, 7.3)
+            expected = sorted((distance_km(lat, lon, station_lat, station_lon), station_id)
+                              for station_id, (station_lat, station_lon) in COORDINATES.iteritems())[:3]
+            self.assertEqual(grid.nearest(lat, lon, 3), expected,
+                             "The grid must find the same stations as a full scan")
+
+    def test_within(self):
+        grid = StationGrid(COORDINATES)
+        self.assertEqual(grid.within(52.0, 4.8, 52.5, 5.2), ['nl.asd', 'nl.asdz', 'nl.ut', 'nl.utt'])
+        self.assertEqual(grid.within(48.0, 0.0, 49.0, 1.0), [])
+        self.assertEqual(StationGrid({}).within(-90.0, -180.0, 90.0, 180.0), [],
+                         "An empty grid must not visit the cells of the box")
+
+    def test_station_grid(self):
+        for station_id, coordinate in COORDINATES.iteritems():
+            station = TSStation.new(station_id)
+            position = station.create_position('xx00')
+            position.coordinate = coordinate
+            station.put()
+            position.put()
+        grid = station_grid()
+        self.assertEqual(len(grid), len(COORDINATES))
+        self.assertTrue(station_grid() is grid, "The grid must be kept while stations do not change")
+        bump_generation('TSStation')
+        self.assertFalse(station_grid() is grid, "The grid must be rebuilt after stations changed")
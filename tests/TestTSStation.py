@@ -30,6 +30,7 @@ from TSStationPosition import TSStationPosition
 from TSAdmin import TSAdmin
 from ffe.ffe_time import rfc1123_from_utc
 from ffe.ffe_utils import auth_header
+from TABasics import clear_local_caches
 
 class TestTSStation(unittest.TestCase):
 
@@ -39,6 +40,7 @@ class TestTSStation(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        clear_local_caches()
         self.testbed.init_memcache_stub()
 
         logger = logging.getLogger()
@@ -81,6 +83,11 @@ class TestTSStation(unittest.TestCase):
         self.assertEqual(TSStation.id_for_name('name 1'), 'nl.test')
         self.assertEqual(TSStation.id_for_name('nl.test'), 'nl.test')
         self.assertIsNone(TSStation.id_for_name('name 5'))
+        station.add_alias('name 5')
+        station.put()
+        self.assertEqual(TSStation.id_for_name('name 5'), 'nl.test',
+                         "Storing a station must update the index of names")
+        self.assertEqual(TSStation.get('nl.test').names, station.names)
 
     def test_xml_parsing(self):
 
@@ -91,6 +98,10 @@ class TestTSStation(unittest.TestCase):
         rijswijk = TSStation.get('nl.rsw')
         self.assertEqual(rijswijk.name, 'Rijswijk')
         self.assertEqual(rijswijk.importance, 4)
+        self.assertEqual(TSStation.id_for_name('Rijswijk'), 'nl.rsw')
+        self.assertEqual(TSStation.id_for_name(' rijswijk'), 'nl.rsw',
+                         "TSStation must find stations by normalized name")
+        self.assertEqual(TSStation.id_for_name('Delft Zuid'), None)
         delft = TSStation.get('nl.dt')
         self.assertEqual(delft.name, 'Delft')
         self.assertEqual(delft.importance, 2)
@@ -104,6 +115,9 @@ class TestTSStation(unittest.TestCase):
         TSStation.update_stations('TestTSStation.data/NS-API-1.xml')
         self.assertEqual(TSStation.all_ids(), ['nl.dt', 'nl.dtz', 'nl.rsw', 'nl.sdm'])
         self.assertEqual(TSStation.active_ids(), ['nl.dt', 'nl.dtz', 'nl.sdm'])
+        self.assertEqual(TSStation.id_for_name('DELFT ZUID'), 'nl.dtz',
+                         "Updating stations must update the index of names")
+        self.assertEqual(TSStation.id_for_name('Delft TU-Wijk'), 'nl.dtz')
         cached_ids = memcache.get('TSStation_active_ids')
         self.assertEqual(cached_ids, ['nl.dt', 'nl.dtz', 'nl.sdm'])
 